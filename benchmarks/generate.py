@@ -0,0 +1,138 @@
+# benchmarks/generate.py
+# Синтетические данные для бенчмарков: квартиры, жильцы, тарифы, помесячные
+# показания за N лет, начисления (через настоящий run_billing) и часть оплат.
+# Пишет в базу из DATABASE_URL — только в отдельную, не рабочую!
+#
+#   DATABASE_URL=postgresql://localhost/kvartbot_bench python -m benchmarks.generate --apartments 1000 --years 3 --reset
+import argparse
+import os
+import time
+from datetime import date
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from webapp.billing import run_billing
+from webapp.ledger import rebuild_ledger
+from webapp.migrations import migrate
+from webapp.partitions import PARTITION_MONTHS_AHEAD, add_months, create_partitions
+
+# (базовая ставка, среднее потребление в месяц)
+PROFILES = {
+    "electricity": (5.5, 180),
+    "water_cold": (45.0, 6),
+    "water_hot": (210.0, 4),
+    "gas": (8.0, 25),
+}
+TELEGRAM_ID_BASE = 1_000_000
+
+_TABLES = ("payment_idempotency", "payment", "charge", "meter_reading", "tariff", "residency", "resident", "apartment_balance",
+           "consumption_monthly", "rollup_version", "apartment_region", "apartment")
+
+
+def _step(name, started):
+    print(f"{name}: {time.perf_counter() - started:.1f}s")
+    return time.perf_counter()
+
+
+def generate(conn, apartments: int, residents_per_apartment: int, years: int, paid_ratio: float, seed: float):
+    start = date(date.today().year - years, 1, 1)
+    months = years * 12
+    cur = conn.cursor()
+    cur.execute("SELECT setseed(%s)", (seed,))
+    t = time.perf_counter()
+    # История за N лет должна лечь в помесячные секции, а не в секцию по умолчанию
+    create_partitions(cur, start, add_months(date.today().replace(day=1), PARTITION_MONTHS_AHEAD))
+
+    cur.execute("INSERT INTO apartment (name) SELECT 'Квартира ' || g FROM generate_series(1, %s) g",
+                (apartments,))
+    cur.execute("""
+                INSERT INTO resident (telegram_id, full_name)
+                SELECT %s + g, 'Жилец ' || g
+                FROM generate_series(1, %s) g
+                """, (TELEGRAM_ID_BASE, apartments * residents_per_apartment))
+    # Первый жилец каждой квартиры — админ
+    cur.execute("""
+                INSERT INTO residency (resident_id, apartment_id, is_admin)
+                SELECT r.id, a.id, (r.telegram_id - %(base)s - 1) %% %(rpa)s = 0
+                FROM resident r
+                         JOIN (SELECT id, row_number() OVER (ORDER BY id) AS n FROM apartment) a
+                              ON a.n = (r.telegram_id - %(base)s - 1) / %(rpa)s + 1
+                WHERE r.telegram_id > %(base)s
+                """, {"base": TELEGRAM_ID_BASE, "rpa": residents_per_apartment})
+    t = _step("apartments/residents", t)
+
+    profiles = [(u, rate, avg) for u, (rate, avg) in PROFILES.items()]
+    # Тариф индексируется раз в год
+    cur.execute("""
+                INSERT INTO tariff (apartment_id, utility_type, rate, valid_from)
+                SELECT a.id,
+                       p.utility_type,
+                       ROUND((p.rate * (1 + 0.08 * y))::numeric, 2),
+                       (%s::date + make_interval(years => y))::date
+                FROM apartment a
+                         CROSS JOIN unnest(%s::text[], %s::float8[]) AS p(utility_type, rate)
+                         CROSS JOIN generate_series(0, %s) y
+                """, (start, [p[0] for p in profiles], [p[1] for p in profiles], years))
+    # Показания растут на случайную величину вокруг среднего потребления
+    cur.execute("""
+                INSERT INTO meter_reading (apartment_id, utility_type, reading, reading_date, submitted_by)
+                SELECT apartment_id, utility_type,
+                       ROUND(SUM(delta) OVER (PARTITION BY apartment_id, utility_type ORDER BY m)::numeric, 2),
+                       (%(start)s::date + make_interval(months => m, days => 24))::date,
+                       admin_id
+                FROM (SELECT a.id AS apartment_id, p.utility_type, m, p.avg * (0.5 + random()) AS delta,
+                             (SELECT resident_id FROM residency WHERE apartment_id = a.id AND is_admin LIMIT 1) AS admin_id
+                      FROM apartment a
+                               CROSS JOIN unnest(%(utilities)s::text[], %(avgs)s::float8[]) AS p(utility_type, avg)
+                               CROSS JOIN generate_series(0, %(months)s - 1) m) s
+                """, {"start": start, "utilities": [p[0] for p in profiles], "avgs": [p[2] for p in profiles],
+                      "months": months})
+    conn.commit()
+    t = _step("tariffs/readings", t)
+
+    stats = run_billing(conn, start, date.today())
+    t = _step(f"billing ({stats['inserted']} charges)", t)
+
+    # Оплачена доля начислений; самые свежие чаще остаются долгом
+    cur.execute("""
+                INSERT INTO payment (apartment_id, charge_id, charge_period_end, amount, date, confirmed_by)
+                SELECT c.apartment_id, c.id, c.period_end, c.amount, c.period_end + 10,
+                       (SELECT resident_id FROM residency WHERE apartment_id = c.apartment_id AND is_admin LIMIT 1)
+                FROM charge c
+                WHERE random() < %s
+                  AND c.period_end < CURRENT_DATE - 60
+                """, (paid_ratio,))
+    conn.commit()
+    rebuild_ledger(conn)
+    _step("payments/ledger", t)
+
+
+def reset(conn):
+    cur = conn.cursor()
+    cur.execute(f"TRUNCATE {', '.join(_TABLES)} RESTART IDENTITY CASCADE")
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Генерация синтетических данных для бенчмарков")
+    parser.add_argument("--apartments", type=int, default=1000)
+    parser.add_argument("--residents-per-apartment", type=int, default=3)
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--paid-ratio", type=float, default=0.8)
+    parser.add_argument("--seed", type=float, default=0.42)
+    parser.add_argument("--reset", action="store_true", help="Очистить таблицы перед генерацией")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ["DATABASE_URL"], cursor_factory=RealDictCursor)
+    migrate(conn)
+    if args.reset:
+        reset(conn)
+    generate(conn, args.apartments, args.residents_per_apartment, args.years, args.paid_ratio, args.seed)
+    conn.cursor().execute("ANALYZE")
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+# benchmarks/run.py
+# Замеры горячих путей бота и веба на данных из benchmarks.generate.
+# Результат — JSON с коммитом, объёмом данных и перцентилями по каждому замеру;
+# --compare сравнивает два таких файла и падает при регрессии сверх порога.
+#
+#   DATABASE_URL=postgresql://localhost/kvartbot_bench python -m benchmarks.run -o before.json
+#   python -m benchmarks.run --compare before.json after.json
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+from functools import partial
+from uuid import uuid4
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Модули бота импортируются как верхнеуровневые (бот запускается как bot/bot.py)
+sys.path.insert(0, os.path.join(ROOT, "bot"))
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark")
+os.environ.setdefault("FLASK_SECRET_KEY", "benchmark")
+
+BENCH_RECEIPT = "benchmark"
+
+
+def measure(func, make_args, repeat: int, warmup: int) -> dict:
+    timings = []
+    for i in range(warmup + repeat):
+        args = make_args()
+        started = time.perf_counter()
+        func(*args)
+        if i >= warmup:
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        "n": len(timings),
+        "min_ms": round(timings[0], 3),
+        "median_ms": round(timings[len(timings) // 2], 3),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        "mean_ms": round(sum(timings) / len(timings), 3),
+        "max_ms": round(timings[-1], 3),
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _dataset(cur) -> dict:
+    counts = {}
+    for table in ("apartment", "resident", "meter_reading", "charge", "payment"):
+        cur.execute(f"SELECT COUNT(*) AS n FROM {table}")
+        counts[table] = cur.fetchone()["n"]
+    return counts
+
+
+def _samples(cur, rnd: random.Random) -> dict:
+    cur.execute("SELECT DISTINCT apartment_id FROM charge WHERE amount - paid > 0.01")
+    debtors = [r["apartment_id"] for r in cur.fetchall()]
+    cur.execute("SELECT id FROM apartment")
+    apartments = [r["id"] for r in cur.fetchall()]
+    cur.execute("SELECT telegram_id FROM resident")
+    telegram_ids = [r["telegram_id"] for r in cur.fetchall()]
+    cur.execute("""
+                SELECT c.id, c.period_end, c.apartment_id, r.resident_id
+                FROM charge c
+                         JOIN residency r ON r.apartment_id = c.apartment_id AND r.is_admin
+                WHERE c.amount - c.paid > 0.01
+                """)
+    unpaid = [(r["id"], r["period_end"], r["apartment_id"], r["resident_id"]) for r in cur.fetchall()]
+    if not apartments or not unpaid:
+        raise SystemExit("Нет данных: сначала запустите python -m benchmarks.generate")
+    return {"debtors": debtors, "apartments": apartments, "telegram_ids": telegram_ids, "unpaid": unpaid,
+            "rnd": rnd}
+
+
+def bot_cases(s):
+    import bot as bot_module
+    from database import init_pool, with_connection
+    from webapp import repository
+    init_pool()
+    rnd = s["rnd"]
+    return {
+        "bot.get_unpaid_charges": (partial(with_connection, repository.get_unpaid_charges),
+                                   lambda: (rnd.choice(s["debtors"]),)),
+        "bot.get_unpaid_page": (partial(with_connection, repository.get_unpaid_page),
+                                lambda: (rnd.choice(s["debtors"]), bot_module.PAY_PAGE_SIZE)),
+        "bot.load_identity": (partial(with_connection, repository.load_identity),
+                              lambda: (rnd.choice(s["telegram_ids"]),)),
+        "bot.save_payment_for_charge": (bot_module.save_payment_for_charge,
+                                        lambda: (*_pick_charge(rnd, s["unpaid"]), BENCH_RECEIPT)),
+    }
+
+
+def _pick_charge(rnd, unpaid):
+    charge_id, period_end, apartment_id, resident_id = rnd.choice(unpaid)
+    return charge_id, period_end, apartment_id, 0.01, resident_id, uuid4().hex
+
+
+def export_cases(s, conn):
+    from webapp.utils.excel_export import export_to_excel
+    rnd = s["rnd"]
+    many = min(50, len(s["apartments"]))
+    # Выгрузки на порядок дольше точечных запросов: повторов в 10 раз меньше
+    return {
+        "export.one_apartment": (lambda ids: export_to_excel(conn, ids, io.BytesIO()),
+                                 lambda: ([rnd.choice(s["apartments"])],), 10),
+        f"export.{many}_apartments": (lambda ids: export_to_excel(conn, ids, io.BytesIO()),
+                                      lambda: (rnd.sample(s["apartments"], many),), 10),
+    }
+
+
+def web_cases(s):
+    from webapp.app import app
+    client = app.test_client()
+    rnd = s["rnd"]
+    cur_apartment = {}
+
+    def get(path):
+        # Сессия — без токена: load_session её не трогает, Redis для входа не нужен
+        apartment_id = rnd.choice(s["apartments"])
+        if cur_apartment.get("id") != apartment_id:
+            with client.session_transaction() as sess:
+                sess["apartment_id"] = apartment_id
+                sess["telegram_id"] = s["telegram_ids"][0]
+            cur_apartment["id"] = apartment_id
+        response = client.get(path)
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {path}: {response.status_code}")
+
+    paths = ["/", "/tariffs", "/residents", "/api/consumption", "/charts/electricity.svg"]
+    return {f"web.GET {path}": (get, lambda path=path: (path,)) for path in paths}
+
+
+def cleanup(conn):
+    from webapp.ledger import rebuild_ledger
+    cur = conn.cursor()
+    cur.execute("DELETE FROM payment WHERE receipt_path = %s", (BENCH_RECEIPT,))
+    conn.commit()
+    if cur.rowcount:
+        rebuild_ledger(conn)
+
+
+def run(repeat: int, warmup: int, only: str, seed: int) -> dict:
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+    conn = psycopg2.connect(os.environ["DATABASE_URL"], cursor_factory=RealDictCursor)
+    cur = conn.cursor()
+    samples = _samples(cur, random.Random(seed))
+    report = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "repeat": repeat,
+        "dataset": _dataset(cur),
+        "results": {},
+    }
+    conn.commit()
+    cases = {**bot_cases(samples), **export_cases(samples, conn), **web_cases(samples)}
+    try:
+        for name, (func, make_args, *divisor) in cases.items():
+            if only and only not in name:
+                continue
+            scale = divisor[0] if divisor else 1
+            try:
+                report["results"][name] = measure(func, make_args, max(repeat // scale, 1),
+                                                  max(warmup // scale, 1))
+            except Exception as e:
+                conn.rollback()
+                report["results"][name] = {"error": f"{type(e).__name__}: {e}"}
+            print(f"{name}: {report['results'][name]}", file=sys.stderr)
+    finally:
+        cleanup(conn)
+        conn.close()
+    return report
+
+
+def compare(base_path: str, new_path: str, threshold: float) -> int:
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{base.get('commit')} -> {new.get('commit')}")
+    regressions = 0
+    for name in sorted(set(base["results"]) | set(new["results"])):
+        old, cur = base["results"].get(name, {}), new["results"].get(name, {})
+        if "median_ms" not in old or "median_ms" not in cur:
+            print(f"{name:40} {old.get('error', old.get('median_ms', '-'))!s:>12} -> "
+                  f"{cur.get('error', cur.get('median_ms', '-'))!s}")
+            continue
+        change = cur["median_ms"] / old["median_ms"] - 1 if old["median_ms"] else 0
+        mark = ""
+        if change > threshold:
+            mark = "  REGRESSION"
+            regressions += 1
+        print(f"{name:40} {old['median_ms']:>10.2f} -> {cur['median_ms']:>10.2f} ms  {change:+.0%}{mark}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки горячих путей")
+    parser.add_argument("-o", "--output", help="Куда записать JSON (по умолчанию stdout)")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--only", help="Запускать только замеры, содержащие подстроку")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="Сравнить два JSON-отчёта")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Допустимый рост медианы (доля)")
+    args = parser.parse_args()
+
+    if args.compare:
+        raise SystemExit(compare(*args.compare, args.threshold))
+
+    logging.basicConfig(level=logging.ERROR)
+    report = run(args.repeat, args.warmup, args.only, args.seed)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
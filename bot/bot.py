@@ -1,9 +1,11 @@
 import asyncio
 import logging
 import os
+from collections import OrderedDict
 from datetime import date
 from uuid import uuid4
 
+import redis.asyncio as aioredis
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
@@ -11,332 +13,91 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from decouple import config
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.webhook.aiohttp_server import setup_application
 from aiohttp import web
 
 # import sqlite3
-from database import get_db_connection
+from database import get_db_connection, pooled_connection, run_db, run_query, init_pool, close_pool
+from webapp.ledger import pay_charge, pay_period
+from webapp.metrics import timed_query
+from webapp.repository import get_charge, get_or_create_resident, get_period_debt, get_unpaid_charges, get_unpaid_page
+from webapp.migrations import migrate
+from webapp.partitions import ensure_partitions
+from identity import get_identity, identity_cache, listen_invalidations
+from receipts import ReceiptRejected, ReceiptStore
+from webhook import OrderedRequestHandler, OrderedUpdateProcessor
+from fsm_storage import BatchedRedisStorage, FSMBatchMiddleware
+from reminders import REMINDERS_ENABLED, reminder_scheduler
+from metrics import MetricsMiddleware, TelegramTimingMiddleware, start_metrics_server
+from throttling import LoadShedMiddleware, PoolTimeoutMiddleware, SingleFlight, ThrottleMiddleware
+from webapp.auth import REDIS_URL
 
 # === CONFIG ===
 BOT_TOKEN = config('BOT_TOKEN')
-MEDIA_ROOT = "media/receipts"
-os.makedirs(MEDIA_ROOT, exist_ok=True)
 
 WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}"
 WEBHOOK_URL = f"https://{os.getenv('RAILWAY_PUBLIC_DOMAIN')}{WEBHOOK_PATH}"
 
+# BOT_MODE=webhook включает приём апдейтов через aiohttp вместо long polling
+BOT_MODE = config("BOT_MODE", default="polling")
+WEBHOOK_SECRET = config("WEBHOOK_SECRET", default="")
+WEB_SERVER_HOST = config("WEB_SERVER_HOST", default="0.0.0.0")
+WEB_SERVER_PORT = config("WEB_SERVER_PORT", default=8080, cast=int)
+WEBHOOK_MAX_CONNECTIONS = config("WEBHOOK_MAX_CONNECTIONS", default=40, cast=int)
+WEBHOOK_MAX_CONCURRENCY = config("WEBHOOK_MAX_CONCURRENCY", default=64, cast=int)
+WEBHOOK_MAX_PENDING = config("WEBHOOK_MAX_PENDING", default=5000, cast=int)
+WEBHOOK_DRAIN_TIMEOUT = config("WEBHOOK_DRAIN_TIMEOUT", default=25, cast=float)
+
+# FSM_STORAGE=redis хранит состояние оплаты в Redis; FSM_TTL — время жизни брошенного сценария
+FSM_STORAGE = config("FSM_STORAGE", default="memory")
+FSM_TTL = config("FSM_TTL", default=24 * 3600, cast=int)
+
+# Метрики Prometheus — на отдельном внутреннем порту в обоих режимах, не на сервере вебхука (0 — выкл.)
+METRICS_PORT = config("METRICS_PORT", default=0, cast=int)
+
+# Начислений на одной странице клавиатуры /pay
+PAY_PAGE_SIZE = config("PAY_PAGE_SIZE", default=8, cast=int)
+
+# Как часто (в секундах) проверять, что секции истории на следующие месяцы созданы
+PARTITION_CHECK_INTERVAL = config("PARTITION_CHECK_INTERVAL", default=6 * 3600, cast=int)
+
+logger = logging.getLogger(__name__)
+
 
 # DB_PATH = "payments.db"
 
 
 # === DATABASE ===
 def init_db():
-    # conn = sqlite3.connect(DB_PATH)
     conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-                CREATE TABLE IF NOT EXISTS apartment
-                (
-                    id
-                    INTEGER
-                    PRIMARY
-                    KEY
-                    AUTOINCREMENT,
-                    name
-                    TEXT
-                    NOT
-                    NULL
-                )
-                """)
-    cur.execute("""
-                CREATE TABLE IF NOT EXISTS resident
-                (
-                    id
-                    INTEGER
-                    PRIMARY
-                    KEY
-                    AUTOINCREMENT,
-                    telegram_id
-                    INTEGER
-                    UNIQUE
-                    NOT
-                    NULL,
-                    full_name
-                    TEXT
-                    NOT
-                    NULL
-                )
-                """)
-    cur.execute("""
-                CREATE TABLE IF NOT EXISTS residency
-                (
-                    id
-                    INTEGER
-                    PRIMARY
-                    KEY
-                    AUTOINCREMENT,
-                    resident_id
-                    INTEGER
-                    NOT
-                    NULL,
-                    apartment_id
-                    INTEGER
-                    NOT
-                    NULL,
-                    is_admin
-                    BOOLEAN
-                    DEFAULT
-                    0,
-                    FOREIGN
-                    KEY
-                (
-                    resident_id
-                ) REFERENCES resident
-                (
-                    id
-                ),
-                    FOREIGN KEY
-                (
-                    apartment_id
-                ) REFERENCES apartment
-                (
-                    id
-                ),
-                    UNIQUE
-                (
-                    resident_id,
-                    apartment_id
-                )
-                    )
-                """)
-    cur.execute("""
-                CREATE TABLE IF NOT EXISTS tariff
-                (
-                    id
-                    INTEGER
-                    PRIMARY
-                    KEY
-                    AUTOINCREMENT,
-                    apartment_id
-                    INTEGER
-                    NOT
-                    NULL,
-                    utility_type
-                    TEXT
-                    NOT
-                    NULL,
-                    rate
-                    REAL
-                    NOT
-                    NULL,
-                    valid_from
-                    TEXT
-                    NOT
-                    NULL,
-                    FOREIGN
-                    KEY
-                (
-                    apartment_id
-                ) REFERENCES apartment
-                (
-                    id
-                ),
-                    UNIQUE
-                (
-                    apartment_id,
-                    utility_type,
-                    valid_from
-                )
-                    )
-                """)
-    cur.execute("""
-                CREATE TABLE IF NOT EXISTS meter_reading
-                (
-                    id
-                    INTEGER
-                    PRIMARY
-                    KEY
-                    AUTOINCREMENT,
-                    apartment_id
-                    INTEGER
-                    NOT
-                    NULL,
-                    utility_type
-                    TEXT
-                    NOT
-                    NULL,
-                    reading
-                    REAL
-                    NOT
-                    NULL,
-                    reading_date
-                    TEXT
-                    NOT
-                    NULL,
-                    submitted_by
-                    INTEGER
-                    NOT
-                    NULL,
-                    FOREIGN
-                    KEY
-                (
-                    apartment_id
-                ) REFERENCES apartment
-                (
-                    id
-                ),
-                    FOREIGN KEY
-                (
-                    submitted_by
-                ) REFERENCES resident
-                (
-                    id
-                ),
-                    UNIQUE
-                (
-                    apartment_id,
-                    utility_type,
-                    reading_date
-                )
-                    )
-                """)
-    cur.execute("""
-                CREATE TABLE IF NOT EXISTS charge
-                (
-                    id
-                    INTEGER
-                    PRIMARY
-                    KEY
-                    AUTOINCREMENT,
-                    apartment_id
-                    INTEGER
-                    NOT
-                    NULL,
-                    utility_type
-                    TEXT
-                    NOT
-                    NULL,
-                    period_start
-                    TEXT
-                    NOT
-                    NULL,
-                    period_end
-                    TEXT
-                    NOT
-                    NULL,
-                    consumption
-                    REAL
-                    NOT
-                    NULL,
-                    tariff_used
-                    REAL
-                    NOT
-                    NULL,
-                    amount
-                    REAL
-                    NOT
-                    NULL,
-                    FOREIGN
-                    KEY
-                (
-                    apartment_id
-                ) REFERENCES apartment
-                (
-                    id
-                )
-                    )
-                """)
-    cur.execute("""
-                CREATE TABLE IF NOT EXISTS payment
-                (
-                    id
-                    INTEGER
-                    PRIMARY
-                    KEY
-                    AUTOINCREMENT,
-                    apartment_id
-                    INTEGER
-                    NOT
-                    NULL,
-                    charge_id
-                    INTEGER,
-                    amount
-                    REAL
-                    NOT
-                    NULL,
-                    date
-                    TEXT
-                    NOT
-                    NULL,
-                    created_at
-                    TEXT
-                    DEFAULT (
-                    DATETIME
-                (
-                    'now'
-                )),
-                    confirmed_by INTEGER NOT NULL,
-                    receipt_path TEXT,
-                    FOREIGN KEY
-                (
-                    apartment_id
-                ) REFERENCES apartment
-                (
-                    id
-                ),
-                    FOREIGN KEY
-                (
-                    charge_id
-                ) REFERENCES charge
-                (
-                    id
-                ),
-                    FOREIGN KEY
-                (
-                    confirmed_by
-                ) REFERENCES resident
-                (
-                    id
-                )
-                    )
-                """)
-    cur.execute("""
-                CREATE TABLE IF NOT EXISTS apartment_region
-                (
-                    apartment_id
-                    INTEGER
-                    PRIMARY
-                    KEY,
-                    region_name
-                    TEXT
-                    NOT
-                    NULL,
-                    housing_type
-                    TEXT
-                    DEFAULT
-                    'urban',
-                    last_updated
-                    TEXT,
-                    FOREIGN
-                    KEY
-                (
-                    apartment_id
-                ) REFERENCES apartment
-                (
-                    id
-                )
-                    )
-                """)
-    conn.commit()
-    conn.close()
-
-
-async def on_startup(bot: Bot):
-    await bot.set_webhook(WEBHOOK_URL)
-
-
-async def on_shutdown(bot: Bot):
-    await bot.delete_webhook(drop_pending_updates=True)
+    try:
+        migrate(conn)
+        ensure_partitions(conn)
+    finally:
+        conn.close()
+
+
+def _ensure_partitions():
+    with pooled_connection() as conn:
+        return ensure_partitions(conn)
+
+
+async def partition_maintenance():
+    """Фоновая задача: секции новых месяцев заводятся заранее, а не при следующем деплое.
+
+    Иначе строки копятся в секции по умолчанию и переносятся под эксклюзивной блокировкой.
+    """
+    while True:
+        await asyncio.sleep(PARTITION_CHECK_INTERVAL)
+        try:
+            created = await run_db(_ensure_partitions)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Partition maintenance failed, will retry")
+        else:
+            if created:
+                logger.info("Created partitions: %s", ", ".join(created))
 
 
 # === HELPERS ===
@@ -345,85 +106,21 @@ async def on_shutdown(bot: Bot):
 #     conn.row_factory = sqlite3.Row
 #     return conn
 
-def get_or_create_resident(telegram_id: int, full_name: str = "Пользователь") -> int:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM resident WHERE telegram_id = ?", (telegram_id,))
-    row = cur.fetchone()
-    if row:
-        conn.close()
-        return row["id"]
-    cur.execute("INSERT INTO resident (telegram_id, full_name) VALUES (?, ?)", (telegram_id, full_name))
-    resident_id = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return resident_id
+@timed_query
+def save_payment_for_charge(charge_id: int, period_end: date, apartment_id: int, amount: float, resident_id: int,
+                            client_key: str, receipt_path: str = None):
+    """Атомарно проверяет остаток долга и записывает платёж; повтор с тем же client_key не дублирует"""
+    with pooled_connection() as conn:
+        return pay_charge(conn.cursor(), charge_id, period_end, apartment_id, amount, resident_id, client_key,
+                          receipt_path)
 
 
-def get_resident_apartment(telegram_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-                SELECT a.id, a.name
-                FROM apartment a
-                         JOIN residency r ON a.id = r.apartment_id
-                         JOIN resident res ON r.resident_id = res.id
-                WHERE res.telegram_id = ?
-                """, (telegram_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
-
-
-def is_admin(telegram_id: int, apartment_id: int) -> bool:
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-                SELECT 1
-                FROM residency
-                WHERE resident_id = (SELECT id FROM resident WHERE telegram_id = ?)
-                  AND apartment_id = ?
-                  AND is_admin = 1
-                """, (telegram_id, apartment_id))
-    result = cur.fetchone() is not None
-    conn.close()
-    return result
-
-
-def get_unpaid_charges(apartment_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-                SELECT c.id,
-                       c.utility_type,
-                       c.period_start,
-                       c.period_end,
-                       c.amount,
-                       IFNULL(SUM(p.amount), 0) as paid
-                FROM charge c
-                         LEFT JOIN payment p ON c.id = p.charge_id
-                WHERE c.apartment_id = ?
-                GROUP BY c.id
-                HAVING (c.amount - IFNULL(SUM(p.amount), 0)) > 0.01
-                ORDER BY c.period_end ASC
-                """, (apartment_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-
-def save_payment_for_charge(charge_id: int, apartment_id: int, amount: float, resident_id: int,
-                            receipt_path: str = None):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-                INSERT INTO payment (apartment_id, charge_id, amount, date, confirmed_by, receipt_path)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """, (apartment_id, charge_id, amount, date.today().isoformat(), resident_id, receipt_path))
-    payment_id = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return payment_id
+@timed_query
+def save_period_payment(apartment_id: int, start: date, end: date, resident_id: int, client_key: str,
+                        expected: float):
+    """Гасит все долги за период, если их сумма всё ещё равна подтверждённой"""
+    with pooled_connection() as conn:
+        return pay_period(conn.cursor(), apartment_id, start, end, resident_id, client_key, expected)
 
 
 UTILITIES_RU = {
@@ -439,75 +136,189 @@ class PayForChargeStates(StatesGroup):
     choosing_charge = State()
     entering_amount = State()
     confirming = State()
+    confirming_period = State()
 
 
 # === BOT ===
+def create_dispatcher() -> Dispatcher:
+    if FSM_STORAGE == "redis":
+        # Состояние оплаты переживает рестарт и доступно всем репликам бота
+        storage = BatchedRedisStorage.from_url(REDIS_URL, FSM_TTL)
+        dispatcher = Dispatcher(storage=storage, events_isolation=storage.create_isolation())
+        dispatcher.update.outer_middleware(FSMBatchMiddleware(storage))
+        return dispatcher
+    return Dispatcher(storage=MemoryStorage())
+
+
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+bot.session.middleware(TelegramTimingMiddleware())
+dp = create_dispatcher()
 router = Router()
+throttle = ThrottleMiddleware(aioredis.from_url(REDIS_URL))
+router.message.outer_middleware(throttle)
+router.callback_query.outer_middleware(throttle)
+# Снаружи метрик: таймаут пула учитывается как ошибка хендлера, но жилец получает ответ
+router.message.middleware(PoolTimeoutMiddleware())
+router.callback_query.middleware(PoolTimeoutMiddleware())
+router.message.middleware(MetricsMiddleware())
+router.callback_query.middleware(MetricsMiddleware())
+receipt_store = ReceiptStore()
+# Одновременные /my_apartment жильцов одной квартиры читают долги одним запросом
+unpaid_flights = SingleFlight("unpaid_charges")
+
+
+def _joins_unpaid_flight(event) -> bool:
+    identity = identity_cache.peek(event.from_user.id)
+    return identity is not None and unpaid_flights.in_flight(identity.apartment_id)
+
+
+# Читающие хендлеры, которые при занятом пуле БД лучше отклонить, чем ставить в очередь
+load_shedding = LoadShedMiddleware({
+    "cmd_start": None,
+    "cmd_my_apartment": _joins_unpaid_flight,
+    "cmd_pay": None,
+    "charges_page": None,
+    "period_selected": None,
+    "charge_selected": None,
+})
+router.message.middleware(load_shedding)
+router.callback_query.middleware(load_shedding)
 
 
 @router.message(Command("start"))
 async def cmd_start(message: Message):
-    get_or_create_resident(message.from_user.id, message.from_user.full_name or "Пользователь")
-    apt = get_resident_apartment(message.from_user.id)
-    if apt:
-        await message.answer(f"🏠 Добро пожаловать в {apt['name']}!\nКоманды: /pay, /my_apartment, /web_login")
+    identity = await get_identity(message.from_user.id)
+    if identity.resident_id is None:
+        await run_query(get_or_create_resident, message.from_user.id, message.from_user.full_name or "Пользователь")
+        identity_cache.invalidate(message.from_user.id)
+    if identity.apartment_id:
+        await message.answer(f"🏠 Добро пожаловать в {identity.apartment_name}!\nКоманды: /pay, /my_apartment, /web_login")
     else:
         await message.answer("Вы не привязаны к квартире.")
 
 
 @router.message(Command("my_apartment"))
 async def cmd_my_apartment(message: Message):
-    apartment = get_resident_apartment(message.from_user.id)
-    if not apartment:
+    identity = await get_identity(message.from_user.id)
+    if not identity.apartment_id:
         await message.answer("Не привязан к квартире.")
         return
-    unpaid = get_unpaid_charges(apartment["id"])
+    unpaid = await unpaid_flights.do(identity.apartment_id, run_query, get_unpaid_charges, identity.apartment_id)
     if not unpaid:
         await message.answer("✅ Всё оплачено!")
         return
     text = "⚠️ Неоплаченные начисления:\n\n"
     for ch in unpaid:
-        debt = ch["amount"] - ch["paid"]
-        util = UTILITIES_RU.get(ch["utility_type"], ch["utility_type"])
-        text += f"• {util} ({ch['period_end']}) — {debt:.2f} руб\n"
+        util = UTILITIES_RU.get(ch.utility_type, ch.utility_type)
+        text += f"• {util} ({ch.period_end}) — {ch.amount - ch.paid:.2f} руб\n"
     await message.answer(text)
 
 
+def _month_bounds(period: str):
+    year, month = map(int, period.split("-"))
+    start = date(year, month, 1)
+    return start, date(year + month // 12, month % 12 + 1, 1)
+
+
+def _pay_keyboard(rows, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    """Долги страницы, сгруппированные по услуге, «оплатить всё» по месяцам и листание"""
+    groups = OrderedDict()
+    for ch in rows:
+        groups.setdefault(ch.utility_type, []).append(ch)
+    buttons = []
+    for utility, charges in groups.items():
+        buttons.append([InlineKeyboardButton(text=f"— {UTILITIES_RU.get(utility, utility)} —", callback_data="noop")])
+        buttons += [[InlineKeyboardButton(text=f"{ch.period_end} — {ch.debt:.2f} руб",
+                                          callback_data=f"pay1_{ch.id}_{ch.period_end}")] for ch in charges]
+    months = sorted({ch.period_end.strftime("%Y-%m") for ch in rows})
+    buttons += [[InlineKeyboardButton(text=f"💰 Оплатить всё за {m[5:]}.{m[:4]}", callback_data=f"payall_{m}")]
+                for m in months]
+    nav = []
+    if has_prev:
+        first = rows[0]
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"pgp_{first.period_end}_{first.id}"))
+    if has_next:
+        last = rows[-1]
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"pgn_{last.period_end}_{last.id}"))
+    if nav:
+        buttons.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
 @router.message(Command("pay"))
 async def cmd_pay(message: Message, state: FSMContext):
-    apartment = get_resident_apartment(message.from_user.id)
-    if not apartment:
+    identity = await get_identity(message.from_user.id)
+    if not identity.apartment_id:
         await message.answer("Сначала привяжитесь к квартире.")
         return
-    unpaid = get_unpaid_charges(apartment["id"])
-    if not unpaid:
+    rows, has_next = await run_query(get_unpaid_page, identity.apartment_id, PAY_PAGE_SIZE)
+    if not rows:
         await message.answer("Нет долгов!")
         return
-    buttons = [[InlineKeyboardButton(
-        text=f"{UTILITIES_RU[ch['utility_type']]} ({ch['period_end']}) — {ch['amount'] - ch['paid']:.2f} руб",
-        callback_data=f"pay1_{ch['id']}"
-    )] for ch in unpaid]
-    await message.answer("Выберите начисление:", reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+    await message.answer("Выберите начисление:", reply_markup=_pay_keyboard(rows, False, has_next))
     await state.set_state(PayForChargeStates.choosing_charge)
 
 
+@router.callback_query(PayForChargeStates.choosing_charge, F.data.regexp(r"^pg[np]_"))
+async def charges_page(callback: CallbackQuery):
+    # Читается только запрошенная страница: ключ (period_end, id) граничной кнопки в callback_data
+    direction, period_end, charge_id = callback.data.split("_")
+    key = (date.fromisoformat(period_end), int(charge_id))
+    identity = await get_identity(callback.from_user.id)
+    if direction == "pgn":
+        rows, has_next = await run_query(get_unpaid_page, identity.apartment_id, PAY_PAGE_SIZE, after=key)
+        has_prev = True
+    else:
+        rows, has_prev = await run_query(get_unpaid_page, identity.apartment_id, PAY_PAGE_SIZE, before=key)
+        has_next = True
+    if not rows:
+        # Долги страницы успели оплатить — начинаем сначала
+        rows, has_next = await run_query(get_unpaid_page, identity.apartment_id, PAY_PAGE_SIZE)
+        has_prev = False
+    if not rows:
+        await callback.message.edit_text("Нет долгов!")
+        return
+    await callback.message.edit_reply_markup(reply_markup=_pay_keyboard(rows, has_prev, has_next))
+    await callback.answer()
+
+
+@router.callback_query(F.data == "noop")
+async def noop_button(callback: CallbackQuery):
+    await callback.answer()
+
+
+@router.callback_query(PayForChargeStates.choosing_charge, F.data.startswith("payall_"))
+async def period_selected(callback: CallbackQuery, state: FSMContext):
+    period = callback.data.split("_")[-1]
+    identity = await get_identity(callback.from_user.id)
+    totals = await run_query(get_period_debt, identity.apartment_id, *_month_bounds(period))
+    if not totals.count:
+        await callback.answer("Долгов за этот месяц уже нет.")
+        return
+    await state.update_data(period=period, total=totals.debt, client_key=uuid4().hex)
+    await callback.message.edit_text(
+        f"Оплатить {totals.count} начисл. за {period[5:]}.{period[:4]} на {totals.debt:.2f} руб?",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm_all")]
+        ])
+    )
+    await state.set_state(PayForChargeStates.confirming_period)
+
+
 @router.callback_query(PayForChargeStates.choosing_charge, F.data.startswith("pay1_"))
 async def charge_selected(callback: CallbackQuery, state: FSMContext):
-    charge_id = int(callback.data.split("_")[-1])
-    await state.update_data(charge_id=charge_id)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT amount, utility_type, period_end FROM charge WHERE id = ?", (charge_id,))
-    ch = cur.fetchone()
-    cur.execute("SELECT IFNULL(SUM(amount), 0) FROM payment WHERE charge_id = ?", (charge_id,))
-    paid = cur.fetchone()[0]
-    conn.close()
-    debt = ch["amount"] - paid
-    util = UTILITIES_RU.get(ch["utility_type"], ch["utility_type"])
+    # Ключ начисления — (id, period_end): period_end указывает секцию charge
+    _, charge_id, period_end = callback.data.split("_")
+    ch = await run_query(get_charge, int(charge_id), date.fromisoformat(period_end))
+    if ch is None:
+        await callback.answer("Начисление не найдено.")
+        return
+    debt = ch.amount - ch.paid
+    # Долг запоминается для подсказки; окончательная проверка — при записи платежа
+    await state.update_data(charge_id=ch.id, period_end=period_end, debt=debt)
+    util = UTILITIES_RU.get(ch.utility_type, ch.utility_type)
     await callback.message.edit_text(
-        f"{util} ({ch['period_end']})\nДолг: {debt:.2f} руб\nВведите сумму:",
+        f"{util} ({ch.period_end})\nДолг: {debt:.2f} руб\nВведите сумму:",
         reply_markup=None
     )
     await state.set_state(PayForChargeStates.entering_amount)
@@ -522,36 +333,61 @@ async def amount_entered(message: Message, state: FSMContext):
         await message.answer("Некорректная сумма. Попробуйте снова:")
         return
     data = await state.get_data()
-    charge_id = data["charge_id"]
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT amount FROM charge WHERE id = ?", (charge_id,))
-    total = cur.fetchone()["amount"]
-    cur.execute("SELECT IFNULL(SUM(amount), 0) FROM payment WHERE charge_id = ?", (charge_id,))
-    paid = cur.fetchone()[0]
-    debt = total - paid
-    conn.close()
+    debt = data["debt"]
     if amount > debt + 0.01:
         await message.answer(f"Сумма превышает долг ({debt:.2f} руб).")
         return
-    await state.update_data(amount=amount)
+    # Ключ идемпотентности: повторное нажатие «Подтвердить» не создаст второй платёж
+    await state.update_data(amount=amount, client_key=uuid4().hex)
     await message.answer(
         f"Сумма: {amount:.2f} руб\nПодтвердить?",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton("✅ Подтвердить", callback_data="confirm1")],
-            [InlineKeyboardButton("📎 Прикрепить квитанцию", callback_data="attach_receipt")]
+            [InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm1")],
+            [InlineKeyboardButton(text="📎 Прикрепить квитанцию", callback_data="attach_receipt")]
         ])
     )
     await state.set_state(PayForChargeStates.confirming)
 
 
+PAYMENT_REPLIES = {
+    "ok": "✅ Оплата сохранена!",
+    "duplicate": "✅ Оплата уже сохранена.",
+    "not_found": "Начисление не найдено.",
+}
+
+
+async def _record_payment(callback: CallbackQuery, state: FSMContext, success_text: str):
+    data = await state.get_data()
+    identity = await get_identity(callback.from_user.id)
+    result = await run_db(save_payment_for_charge, data["charge_id"], date.fromisoformat(data["period_end"]),
+                          identity.apartment_id, data["amount"], identity.resident_id, data["client_key"],
+                          data.get("receipt_path"))
+    if result.status == "overpay":
+        text = f"Сумма превышает текущий долг ({result.debt:.2f} руб) — возможно, начисление уже оплатили."
+    else:
+        text = success_text if result.status == "ok" else PAYMENT_REPLIES[result.status]
+    await callback.message.edit_text(text)
+    await state.clear()
+
+
 @router.callback_query(PayForChargeStates.confirming, F.data == "confirm1")
 async def confirm_payment(callback: CallbackQuery, state: FSMContext):
+    await _record_payment(callback, state, PAYMENT_REPLIES["ok"])
+
+
+@router.callback_query(PayForChargeStates.confirming_period, F.data == "confirm_all")
+async def confirm_period_payment(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    resident_id = get_or_create_resident(callback.from_user.id)
-    apartment = get_resident_apartment(callback.from_user.id)
-    save_payment_for_charge(data["charge_id"], apartment["id"], data["amount"], resident_id)
-    await callback.message.edit_text("✅ Оплата сохранена!")
+    identity = await get_identity(callback.from_user.id)
+    result = await run_db(save_period_payment, identity.apartment_id, *_month_bounds(data["period"]),
+                          identity.resident_id, data["client_key"], data["total"])
+    if result.status == "ok":
+        text = f"✅ Оплачено начислений: {result.count}, на {result.total:.2f} руб."
+    elif result.status == "changed":
+        text = f"Долг за период изменился ({result.debt:.2f} руб) — выберите оплату заново: /pay"
+    else:
+        text = "✅ Всё за период уже оплачено."
+    await callback.message.edit_text(text)
     await state.clear()
 
 
@@ -562,35 +398,24 @@ async def request_receipt(callback: CallbackQuery):
 
 @router.message(F.content_type.in_({'photo', 'document'}), PayForChargeStates.confirming)
 async def receive_receipt(message: Message, state: FSMContext):
-    if message.document:
-        file = await bot.get_file(message.document.file_id)
-        ext = os.path.splitext(message.document.file_name or "")[1] or ".pdf"
-    else:
-        photo = message.photo[-1]
-        file = await bot.get_file(photo.file_id)
-        ext = ".jpg"
-    filename = f"{uuid4().hex}{ext}"
-    filepath = os.path.join(MEDIA_ROOT, filename)
-    await bot.download_file(file.file_path, filepath)
-    await state.update_data(receipt_path=filepath)
+    media = message.document or message.photo[-1]
+    try:
+        receipt = await receipt_store.save(bot, media.file_id, media.file_size)
+    except ReceiptRejected as e:
+        await message.answer(f"Квитанция не принята: {e}")
+        return
+    await state.update_data(receipt_path=receipt.path)
     await message.answer("Квитанция получена! Подтвердите оплату:",
                          reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                             [InlineKeyboardButton("✅ Подтвердить с квитанцией", callback_data="confirm1_receipt")]
+                             [InlineKeyboardButton(text="✅ Подтвердить с квитанцией",
+                                                   callback_data="confirm1_receipt")]
                          ])
                          )
 
 
-@router.callback_query(F.data == "confirm1_receipt")
+@router.callback_query(PayForChargeStates.confirming, F.data == "confirm1_receipt")
 async def confirm_with_receipt(callback: CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    resident_id = get_or_create_resident(callback.from_user.id)
-    apartment = get_resident_apartment(callback.from_user.id)
-    save_payment_for_charge(
-        data["charge_id"], apartment["id"], data["amount"], resident_id,
-        receipt_path=data.get("receipt_path")
-    )
-    await callback.message.edit_text("✅ Оплата с квитанцией сохранена!")
-    await state.clear()
+    await _record_payment(callback, state, "✅ Оплата с квитанцией сохранена!")
 
 
 # === ВЕБ-ЛОГИН ===
@@ -600,50 +425,69 @@ from webapp.auth import create_session
 @router.message(Command("web_login"))
 async def cmd_web_login(message: Message):
     telegram_id = message.from_user.id
-    apartment = get_resident_apartment(telegram_id)
-    if not apartment or not is_admin(telegram_id, apartment["id"]):
+    identity = await get_identity(telegram_id)
+    if not identity.apartment_id or not identity.is_admin:
         await message.answer("Только админ может получить доступ к веб-панели.")
         return
-    token = create_session(telegram_id, apartment["id"])
+    token = create_session(telegram_id, identity.apartment_id)
     url = f"http://localhost:5000/?token={token}"  # Для локального запуска
     await message.answer(f"Ссылка для входа:\n{url}\n(Действует 24 часа)")
 
 
-# === WEBHOOK SETUP ===
-async def on_startup(bot: Bot):
-    await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+# === LIFECYCLE ===
+async def on_db_startup(dispatcher: Dispatcher, bot: Bot):
+    init_pool()
+    dispatcher["identity_listener"] = asyncio.create_task(listen_invalidations())
+    dispatcher["partitions"] = asyncio.create_task(partition_maintenance())
+    dispatcher["reminders"] = (asyncio.create_task(reminder_scheduler(bot, REDIS_URL, UTILITIES_RU))
+                               if REMINDERS_ENABLED else None)
 
 
-async def on_shutdown(bot: Bot):
-    await bot.delete_webhook(drop_pending_updates=True)
+async def on_db_shutdown(dispatcher: Dispatcher):
+    dispatcher["identity_listener"].cancel()
+    dispatcher["partitions"].cancel()
+    if dispatcher["reminders"] is not None:
+        dispatcher["reminders"].cancel()
+    await receipt_store.close()
+    await close_pool()
 
 
-def main():
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher()
-    dp.include_router(router)
+# === WEBHOOK SETUP ===
+async def on_webhook_startup(bot: Bot):
+    await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+                          max_connections=WEBHOOK_MAX_CONNECTIONS)
 
-    app = web.Application()
-    SimpleRequestHandler(
-        dispatcher=dp,
-        bot=bot,
-        secret_token=WEBHOOK_SECRET,
-    ).register(app, path=WEBHOOK_PATH)
-    setup_application(app, dp, bot=bot)
 
-    app.on_startup.append(lambda app: on_startup(bot))
-    app.on_shutdown.append(lambda app: on_shutdown(bot))
+def run_webhook():
+    dp.startup.register(on_webhook_startup)
+    processor = OrderedUpdateProcessor(dp, bot, WEBHOOK_MAX_CONCURRENCY, WEBHOOK_MAX_PENDING)
+
+    async def drain(app):
+        await processor.drain(WEBHOOK_DRAIN_TIMEOUT)
 
+    app = web.Application()
+    # Порядок важен: сначала дожидаемся апдейтов, потом закрываются сессия бота и пул БД.
+    # Вебхук при остановке не удаляем — Telegram доставит апдейты следующему инстансу.
+    app.on_shutdown.append(drain)
+    OrderedRequestHandler(processor, secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
     web.run_app(app, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
 
 
 # === MAIN ===
-async def main():
+def main():
     init_db()
     dp.include_router(router)
-    await dp.start_polling(bot)
+    dp.startup.register(on_db_startup)
+    dp.shutdown.register(on_db_shutdown)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(dp.start_polling(bot))
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    asyncio.run(main())
+    main()
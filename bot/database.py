@@ -1,10 +1,144 @@
 # bot/database.py
+import asyncio
+import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
 import psycopg2
+from psycopg2 import extensions
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from webapp.metrics import DB_POOL_IN_USE, DB_POOL_TIMEOUTS, DB_POOL_WAIT_SECONDS, InstrumentedCursor
+from webapp.repository import RepositoryConnection
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Настройки пула: размер, таймаут ожидания свободного соединения (сек)
+# и через сколько секунд простоя соединение проверяется запросом SELECT 1
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "5"))
+DB_HEALTHCHECK_AFTER = float(os.getenv("DB_HEALTHCHECK_AFTER", "30"))
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_executor = None
+_slots = None
+_last_used = {}
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за DB_ACQUIRE_TIMEOUT"""
+
+
 def get_db_connection():
+    """Отдельное соединение вне пула (миграции, скрипты)"""
     conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    return conn
\ No newline at end of file
+    return conn
+
+
+def init_pool(minconn: int = DB_POOL_MIN, maxconn: int = DB_POOL_MAX):
+    """Создаёт пул соединений; вызывается один раз при старте диспетчера"""
+    global _pool, _executor, _slots
+    if _pool is not None:
+        return
+    _pool = ThreadedConnectionPool(minconn, maxconn, DATABASE_URL, cursor_factory=InstrumentedCursor,
+                                   connection_factory=RepositoryConnection)
+    # Потоков столько же, сколько соединений: запрос никогда не ждёт соединение внутри потока
+    _executor = ThreadPoolExecutor(max_workers=maxconn, thread_name_prefix="db")
+    _slots = asyncio.Semaphore(maxconn)
+    logger.info("DB pool started (min=%s, max=%s)", minconn, maxconn)
+
+
+async def close_pool():
+    """Дожидается запросов в потоках БД и закрывает пул, не блокируя event loop"""
+    global _pool, _executor, _slots
+    if _pool is None:
+        return
+    await asyncio.to_thread(_executor.shutdown, wait=True)
+    _pool.closeall()
+    _pool = _executor = _slots = None
+    _last_used.clear()
+
+
+def pool_saturated() -> bool:
+    """Все соединения пула заняты: новый запрос встанет в очередь run_db"""
+    return _slots is not None and _slots.locked()
+
+
+def _is_healthy(conn) -> bool:
+    if conn.closed:
+        return False
+    if conn.get_transaction_status() not in (extensions.TRANSACTION_STATUS_IDLE,
+                                             extensions.TRANSACTION_STATUS_INTRANS):
+        return False
+    if time.monotonic() - _last_used.get(id(conn), 0) < DB_HEALTHCHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def pooled_connection():
+    """Берёт соединение из пула; коммит при успехе, откат при ошибке"""
+    conn = _pool.getconn()
+    while not _is_healthy(conn):
+        logger.warning("Dropping broken DB connection")
+        _last_used.pop(id(conn), None)
+        _pool.putconn(conn, close=True)
+        conn = _pool.getconn()
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except psycopg2.OperationalError:
+        broken = True
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if broken or conn.closed:
+            _last_used.pop(id(conn), None)
+        else:
+            _last_used[id(conn)] = time.monotonic()
+        _pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+def with_connection(func, *args, **kwargs):
+    """Вызывает функцию webapp.repository на соединении из пула"""
+    with pooled_connection() as conn:
+        return func(conn, *args, **kwargs)
+
+
+async def run_query(func, *args, **kwargs):
+    """run_db для функции webapp.repository: соединение из пула подставляется первым аргументом"""
+    return await run_db(with_connection, func, *args, **kwargs)
+
+
+async def run_db(func, *args, **kwargs):
+    """Выполняет синхронную функцию работы с БД в пуле потоков, не блокируя event loop"""
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(_slots.acquire(), DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        DB_POOL_TIMEOUTS.labels("bot").inc()
+        raise PoolTimeout(f"no free DB connection in {DB_ACQUIRE_TIMEOUT}s") from None
+    DB_POOL_WAIT_SECONDS.labels("bot").observe(time.monotonic() - started)
+    DB_POOL_IN_USE.labels("bot").inc()
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+    finally:
+        DB_POOL_IN_USE.labels("bot").dec()
+        _slots.release()
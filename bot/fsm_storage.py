@@ -0,0 +1,126 @@
+# bot/fsm_storage.py
+# FSM-хранилище в Redis для нескольких реплик бота. Состояние и данные одного
+# пользователя лежат в одном hash; в пределах апдейта чтения кэшируются, а все
+# записи копятся и уходят одним pipeline (с EXPIRE для брошенных сценариев).
+import json
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.redis import RedisEventIsolation
+from redis.asyncio import Redis
+
+from webapp.metrics import REDIS_SECONDS
+
+_batch: ContextVar = ContextVar("fsm_batch", default=None)
+
+_STATE = "s"
+_DATA = "d"
+
+
+def _dumps(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+class _Entry:
+    __slots__ = ("state", "data", "dirty")
+
+    def __init__(self, state, data):
+        self.state = state
+        self.data = data
+        self.dirty = False
+
+
+class BatchedRedisStorage(BaseStorage):
+    def __init__(self, redis: Redis, ttl: int, key_builder=None):
+        self.redis = redis
+        self.ttl = ttl
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    @classmethod
+    def from_url(cls, url: str, ttl: int) -> "BatchedRedisStorage":
+        return cls(Redis.from_url(url), ttl)
+
+    def create_isolation(self) -> RedisEventIsolation:
+        return RedisEventIsolation(self.redis, key_builder=self.key_builder)
+
+    async def _load(self, redis_key: str) -> _Entry:
+        with REDIS_SECONDS.labels("FSM_LOAD").time():
+            state, data = await self.redis.hmget(redis_key, _STATE, _DATA)
+        return _Entry(state.decode() if state else None, json.loads(data) if data else {})
+
+    async def _entry(self, key) -> _Entry:
+        redis_key = self.key_builder.build(key)
+        batch = _batch.get()
+        if batch is None:
+            return await self._load(redis_key)
+        entry = batch.get(redis_key)
+        if entry is None:
+            entry = batch[redis_key] = await self._load(redis_key)
+        return entry
+
+    async def _write(self, key, entry: _Entry):
+        batch = _batch.get()
+        if batch is not None:
+            entry.dirty = True
+            batch[self.key_builder.build(key)] = entry
+            return
+        await self.flush({self.key_builder.build(key): entry})
+
+    async def flush(self, entries: dict):
+        pipe = self.redis.pipeline(transaction=False)
+        for redis_key, entry in entries.items():
+            if entry.state is None and not entry.data:
+                pipe.delete(redis_key)
+                continue
+            mapping = {_DATA: _dumps(entry.data)}
+            if entry.state is not None:
+                mapping[_STATE] = entry.state
+            else:
+                pipe.hdel(redis_key, _STATE)
+            pipe.hset(redis_key, mapping=mapping)
+            pipe.expire(redis_key, self.ttl)
+        with REDIS_SECONDS.labels("FSM_FLUSH").time():
+            await pipe.execute()
+
+    async def get_state(self, key):
+        return (await self._entry(key)).state
+
+    async def set_state(self, key, state=None):
+        entry = await self._entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        await self._write(key, entry)
+
+    async def get_data(self, key):
+        return dict((await self._entry(key)).data)
+
+    async def set_data(self, key, data):
+        entry = await self._entry(key)
+        entry.data = dict(data)
+        await self._write(key, entry)
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+class FSMBatchMiddleware(BaseMiddleware):
+    """Outer-middleware апдейта: собирает записи FSM и сбрасывает их одним pipeline.
+
+    Регистрируется после FSMContextMiddleware диспетчера, поэтому запись выполняется
+    под его блокировкой событий.
+    """
+
+    def __init__(self, storage: BatchedRedisStorage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        token = _batch.set({})
+        try:
+            return await handler(event, data)
+        finally:
+            batch = _batch.get()
+            _batch.reset(token)
+            dirty = {k: e for k, e in batch.items() if e.dirty}
+            if dirty:
+                await self.storage.flush(dirty)
@@ -0,0 +1,97 @@
+# bot/identity.py
+# Кэш «кто пишет боту»: id жильца, квартира и флаг админа по telegram_id.
+# Одна запись заменяет три запроса (resident, join квартиры, is_admin) на каждое сообщение.
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import redis.asyncio as aioredis
+from decouple import config
+
+from database import run_query
+from metrics import IDENTITY_CACHE_ENTRIES, IDENTITY_CACHE_INVALIDATIONS, IDENTITY_CACHE_LOOKUPS
+from webapp.auth import REDIS_URL
+from webapp.events import IDENTITY_CHANNEL
+from webapp.repository import Identity, load_identity
+
+IDENTITY_CACHE_SIZE = config("IDENTITY_CACHE_SIZE", default=10000, cast=int)
+IDENTITY_CACHE_TTL = config("IDENTITY_CACHE_TTL", default=300, cast=float)
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN = Identity(None, None, None, False)
+
+
+class IdentityCache:
+    """LRU с TTL; не потокобезопасен — используется только из event loop"""
+
+    def __init__(self, maxsize: int = IDENTITY_CACHE_SIZE, ttl: float = IDENTITY_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, telegram_id: int):
+        entry = self._data.get(telegram_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[telegram_id]
+                IDENTITY_CACHE_ENTRIES.set(len(self._data))
+            IDENTITY_CACHE_LOOKUPS.labels("miss").inc()
+            return None
+        self._data.move_to_end(telegram_id)
+        IDENTITY_CACHE_LOOKUPS.labels("hit").inc()
+        return entry[1]
+
+    def peek(self, telegram_id: int):
+        """Запись без учёта в метриках и без продвижения в LRU"""
+        entry = self._data.get(telegram_id)
+        return entry[1] if entry is not None and entry[0] >= time.monotonic() else None
+
+    def put(self, telegram_id: int, identity: Identity):
+        self._data[telegram_id] = (time.monotonic() + self.ttl, identity)
+        self._data.move_to_end(telegram_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        IDENTITY_CACHE_ENTRIES.set(len(self._data))
+
+    def invalidate(self, telegram_id: int = None):
+        IDENTITY_CACHE_INVALIDATIONS.inc()
+        if telegram_id is None:
+            self._data.clear()
+        else:
+            self._data.pop(telegram_id, None)
+        IDENTITY_CACHE_ENTRIES.set(len(self._data))
+
+
+identity_cache = IdentityCache()
+
+
+async def get_identity(telegram_id: int) -> Identity:
+    identity = identity_cache.get(telegram_id)
+    if identity is None:
+        identity = await run_query(load_identity, telegram_id) or UNKNOWN
+        identity_cache.put(telegram_id, identity)
+    return identity
+
+
+async def listen_invalidations(cache: IdentityCache = identity_cache):
+    """Фоновая задача: сбрасывает записи по сообщениям из webapp.events"""
+    client = aioredis.from_url(REDIS_URL)
+    while True:
+        try:
+            pubsub = client.pubsub()
+            await pubsub.subscribe(IDENTITY_CHANNEL)
+            # Пока не были подписаны, сообщения могли потеряться
+            cache.invalidate()
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                payload = message["data"].decode()
+                cache.invalidate(None if payload == "*" else int(payload))
+        except asyncio.CancelledError:
+            await client.aclose()
+            raise
+        except Exception:
+            logger.warning("Identity invalidation listener failed, reconnecting", exc_info=True)
+            await asyncio.sleep(1)
@@ -0,0 +1,71 @@
+# bot/metrics.py
+# Инструментирование бота: время хендлеров и переходы FSM (middleware роутера),
+# время вызовов Bot API (middleware сессии), попадания в кэш жильцов и отдача /metrics на отдельном порту.
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StateType
+from prometheus_client import Counter, Gauge, start_http_server
+
+from webapp.metrics import FSM_TRANSITIONS, HANDLER_ERRORS, HANDLER_SECONDS, TELEGRAM_SECONDS
+
+IDENTITY_CACHE_LOOKUPS = Counter("bot_identity_cache_lookups_total", "Обращения к кэшу жильцов", ["result"])
+IDENTITY_CACHE_INVALIDATIONS = Counter("bot_identity_cache_invalidations_total", "Сбросы кэша жильцов")
+IDENTITY_CACHE_ENTRIES = Gauge("bot_identity_cache_size", "Записей в кэше жильцов", multiprocess_mode="livesum")
+
+
+class _TrackedContext(FSMContext):
+    """FSMContext, запоминающий последнее записанное состояние — чтобы не перечитывать его из хранилища"""
+
+    def __init__(self, context: FSMContext):
+        super().__init__(context.storage, context.key)
+        self.changed = False
+        self.current = None
+
+    async def set_state(self, state: StateType = None) -> None:
+        await super().set_state(state)
+        self.changed = True
+        self.current = state.state if isinstance(state, State) else state
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: вызывается уже для выбранного хендлера.
+
+    Состояние «до» берётся из raw_state, уже прочитанного FSMContextMiddleware,
+    «после» — из записи хендлера: лишних обращений к хранилищу FSM нет.
+    """
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        state = data.get("state")
+        if state is not None:
+            state = data["state"] = _TrackedContext(state)
+        before = data.get("raw_state")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_SECONDS.labels(name, type(event).__name__).observe(time.perf_counter() - started)
+            if state is not None and state.changed and state.current != before:
+                FSM_TRANSITIONS.labels(before or "none", state.current or "none").inc()
+
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            TELEGRAM_SECONDS.labels(type(method).__name__).observe(time.perf_counter() - started)
+
+
+def start_metrics_server(port: int):
+    """Отдельный HTTP-сервер метрик; на публичный сервер вебхука /metrics не вешаем"""
+    start_http_server(port)
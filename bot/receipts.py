@@ -0,0 +1,181 @@
+# bot/receipts.py
+# Хранилище квитанций с адресацией по содержимому: файл скачивается потоком с
+# подсчётом sha256, одинаковые квитанции хранятся один раз. Превью и
+# нормализованный JPEG строятся в пуле процессов, не занимая event loop.
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from decouple import config
+
+RECEIPT_BACKEND = config("RECEIPT_BACKEND", default="local")
+RECEIPT_ROOT = config("RECEIPT_ROOT", default="media/receipts")
+RECEIPT_MAX_BYTES = config("RECEIPT_MAX_BYTES", default=10 * 1024 * 1024, cast=int)
+RECEIPT_WORKERS = config("RECEIPT_WORKERS", default=2, cast=int)
+
+NORMALIZED_MAX_SIDE = 2000
+THUMBNAIL_SIDE = 320
+
+# Сигнатуры разрешённых форматов -> расширение при хранении
+_SIGNATURES = (
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"%PDF", ".pdf"),
+)
+_IMAGE_EXTENSIONS = {".jpg", ".png"}
+
+logger = logging.getLogger(__name__)
+
+Receipt = namedtuple("Receipt", "key path sha256 size duplicate")
+
+
+class ReceiptRejected(Exception):
+    """Файл не прошёл проверку размера или типа; текст показывается пользователю"""
+
+
+class LocalBackend:
+    """Локальный диск; путь квитанции — RECEIPT_ROOT/<key>"""
+
+    def __init__(self, root: str = RECEIPT_ROOT):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def location(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.location(key))
+
+    def put_file(self, key: str, src_path: str):
+        dst = self.location(key)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.replace(src_path, dst)
+
+    def temp_dir(self) -> str:
+        return self.root
+
+
+_BACKENDS = {"local": LocalBackend}
+
+
+def get_backend(name: str = RECEIPT_BACKEND):
+    try:
+        return _BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown receipt backend: {name}") from None
+
+
+class _HashingWriter:
+    """Файловый объект для bot.download_file: считает хэш и режет по лимиту на лету"""
+
+    def __init__(self, fileobj, limit: int):
+        self.fileobj = fileobj
+        self.limit = limit
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.limit:
+            raise ReceiptRejected(f"Файл больше {self.limit // (1024 * 1024)} МБ.")
+        if len(self.head) < 16:
+            self.head += chunk[:16 - len(self.head)]
+        self.sha256.update(chunk)
+        return self.fileobj.write(chunk)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def _detect_extension(head: bytes):
+    for signature, ext in _SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+
+def make_derivatives(src_path: str, sha: str, out_dir: str) -> list:
+    """Выполняется в дочернем процессе: нормализованный JPEG и превью"""
+    from PIL import Image, ImageOps
+
+    results = []
+    with Image.open(src_path) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        normalized = img.copy()
+        normalized.thumbnail((NORMALIZED_MAX_SIDE, NORMALIZED_MAX_SIDE))
+        path = os.path.join(out_dir, f"{sha}.norm.jpg")
+        normalized.save(path, "JPEG", quality=85, optimize=True)
+        results.append((f"{sha[:2]}/{sha}.norm.jpg", path))
+        img.thumbnail((THUMBNAIL_SIDE, THUMBNAIL_SIDE))
+        path = os.path.join(out_dir, f"{sha}.thumb.jpg")
+        img.save(path, "JPEG", quality=80)
+        results.append((f"{sha[:2]}/{sha}.thumb.jpg", path))
+    return results
+
+
+class ReceiptStore:
+    def __init__(self, backend=None, max_bytes: int = RECEIPT_MAX_BYTES):
+        self.backend = backend or get_backend()
+        self.max_bytes = max_bytes
+        self._executor = None
+        self._tasks = set()
+
+    async def save(self, bot, file_id: str, declared_size: int = None) -> Receipt:
+        if declared_size and declared_size > self.max_bytes:
+            raise ReceiptRejected(f"Файл больше {self.max_bytes // (1024 * 1024)} МБ.")
+        file = await bot.get_file(file_id)
+        tmp = tempfile.NamedTemporaryFile(dir=self.backend.temp_dir(), suffix=".part", delete=False)
+        try:
+            with tmp:
+                writer = _HashingWriter(tmp, self.max_bytes)
+                await bot.download_file(file.file_path, writer, seek=False)
+            ext = _detect_extension(writer.head)
+            if ext is None:
+                raise ReceiptRejected("Поддерживаются только JPEG, PNG и PDF.")
+            sha = writer.sha256.hexdigest()
+            key = f"{sha[:2]}/{sha}{ext}"
+            duplicate = self.backend.exists(key)
+            if duplicate:
+                os.unlink(tmp.name)
+            else:
+                self.backend.put_file(key, tmp.name)
+        except BaseException:
+            if os.path.exists(tmp.name):
+                os.unlink(tmp.name)
+            raise
+        if not duplicate and ext in _IMAGE_EXTENSIONS:
+            self._postprocess(key, sha)
+        return Receipt(key, self.backend.location(key), sha, writer.size, duplicate)
+
+    def _postprocess(self, key: str, sha: str):
+        if self._executor is None:
+            # spawn, а не fork: у бота уже работают потоки БД и Redis, и форк мог бы
+            # унести в дочерний процесс захваченную ими блокировку
+            self._executor = ProcessPoolExecutor(max_workers=RECEIPT_WORKERS,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        task = asyncio.create_task(self._derive(key, sha))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _derive(self, key: str, sha: str):
+        loop = asyncio.get_running_loop()
+        try:
+            derived = await loop.run_in_executor(
+                self._executor, make_derivatives, self.backend.location(key), sha, self.backend.temp_dir())
+            for derived_key, path in derived:
+                self.backend.put_file(derived_key, path)
+        except Exception:
+            logger.warning("Receipt post-processing failed for %s", key, exc_info=True)
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
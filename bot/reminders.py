@@ -0,0 +1,196 @@
+# bot/reminders.py
+# Рассылка напоминаний о долгах. Должники по всем квартирам выбираются одним
+# запросом, сообщения уходят через token bucket с запасом до лимита Telegram,
+# чтобы интерактивным хендлерам хватало квоты. Прогресс рассылки хранится в
+# Redis: после перезапуска она продолжается с того же места, без повторов.
+import asyncio
+import logging
+import time
+from datetime import datetime
+from itertools import groupby
+
+import redis.asyncio as aioredis
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from decouple import config
+
+from database import pooled_connection, run_db
+from webapp.metrics import timed_query
+
+# Рассылка раз в месяц в REMINDER_DAY числа после REMINDER_HOUR; выключена по умолчанию
+REMINDERS_ENABLED = config("REMINDERS_ENABLED", default=False, cast=bool)
+REMINDER_DAY = config("REMINDER_DAY", default=5, cast=int)
+REMINDER_HOUR = config("REMINDER_HOUR", default=12, cast=int)
+# Глобальный лимит Telegram ~30 сообщений/с; часть оставляем ответам на команды
+REMINDER_RATE = config("REMINDER_RATE", default=20, cast=float)
+REMINDER_BURST = config("REMINDER_BURST", default=5, cast=int)
+REMINDER_CHAT_INTERVAL = config("REMINDER_CHAT_INTERVAL", default=1.0, cast=float)
+REMINDER_MAX_RETRIES = config("REMINDER_MAX_RETRIES", default=3, cast=int)
+REMINDER_PROGRESS_TTL = 14 * 24 * 3600
+# Блокировка продлевается с каждым сообщением; упавшая реплика отпустит её через этот срок
+REMINDER_LOCK_TTL = 300
+REMINDER_CHECK_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+# Та же семантика, что у get_unpaid_charges, но сразу по всем квартирам
+DEBTORS_SQL = """
+    SELECT res.telegram_id, a.name AS apartment_name, c.utility_type, c.period_end, c.amount - c.paid AS debt
+    FROM charge c
+             JOIN apartment a ON a.id = c.apartment_id
+             JOIN residency r ON r.apartment_id = c.apartment_id
+             JOIN resident res ON res.id = r.resident_id
+    WHERE c.amount - c.paid > 0.01
+      AND c.period_end >= (SELECT boundary FROM archive_state)
+    ORDER BY res.telegram_id, a.name, c.period_end
+"""
+
+
+@timed_query
+def load_debtors():
+    """[(telegram_id, [строки долга])], по одному элементу на жильца"""
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(DEBTORS_SQL)
+        rows = cur.fetchall()
+    return [(telegram_id, list(group)) for telegram_id, group in groupby(rows, key=lambda r: r["telegram_id"])]
+
+
+def render_reminder(rows, utility_names: dict) -> str:
+    text = "🔔 Напоминание о неоплаченных начислениях:\n"
+    apartment = None
+    total = 0
+    for row in rows:
+        if row["apartment_name"] != apartment:
+            apartment = row["apartment_name"]
+            text += f"\n🏠 {apartment}\n"
+        util = utility_names.get(row["utility_type"], row["utility_type"])
+        text += f"• {util} ({row['period_end']}) — {row['debt']:.2f} руб\n"
+        total += row["debt"]
+    text += f"\nИтого: {total:.2f} руб. Оплатить: /pay"
+    return text
+
+
+class TokenBucket:
+    """Глобальный лимит отправки; pause() останавливает всех при flood-ограничении"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class ReminderBroadcaster:
+    def __init__(self, bot: Bot, redis, utility_names: dict, rate: float = REMINDER_RATE,
+                 burst: int = REMINDER_BURST):
+        self.bot = bot
+        self.redis = redis
+        self.utility_names = utility_names
+        self.bucket = TokenBucket(rate, burst)
+        self._last_sent = {}
+
+    @staticmethod
+    def _keys(run_id: str):
+        return f"reminders:{run_id}:done", f"reminders:{run_id}:stats", f"reminders:{run_id}:lock"
+
+    async def _chat_slot(self, chat_id: int):
+        # Telegram не даёт писать в один чат чаще раза в секунду
+        wait = self._last_sent.get(chat_id, 0) + REMINDER_CHAT_INTERVAL - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self._last_sent[chat_id] = time.monotonic()
+
+    async def _send(self, chat_id: int, text: str, stats_key: str) -> str:
+        """Отправляет одно сообщение; возвращает итог для статистики"""
+        for attempt in range(REMINDER_MAX_RETRIES + 1):
+            await self.bucket.acquire()
+            await self._chat_slot(chat_id)
+            try:
+                await self.bot.send_message(chat_id, text)
+                return "sent"
+            except TelegramRetryAfter as e:
+                logger.warning("Flood limit, pausing reminders for %ss", e.retry_after)
+                self.bucket.pause(e.retry_after)
+                await self.redis.hincrby(stats_key, "retried", 1)
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramBadRequest:
+                logger.warning("Reminder to %s rejected", chat_id, exc_info=True)
+                return "failed"
+        return "failed"
+
+    async def run(self, run_id: str) -> dict:
+        """Рассылка с идентификатором run_id; уже получившие сообщение пропускаются"""
+        done_key, stats_key, lock_key = self._keys(run_id)
+        debtors = await run_db(load_debtors)
+        done = {int(x) for x in await self.redis.smembers(done_key)}
+        await self.redis.hset(stats_key, mapping={"debtors": len(debtors), "started_at": time.time()})
+        await self.redis.expire(stats_key, REMINDER_PROGRESS_TTL)
+        logger.info("Reminder run %s: %s debtors, %s already notified", run_id, len(debtors), len(done))
+        for telegram_id, rows in debtors:
+            if telegram_id in done:
+                continue
+            outcome = await self._send(telegram_id, render_reminder(rows, self.utility_names), stats_key)
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.sadd(done_key, telegram_id)
+            pipe.expire(done_key, REMINDER_PROGRESS_TTL)
+            pipe.hincrby(stats_key, outcome, 1)
+            pipe.expire(lock_key, REMINDER_LOCK_TTL)
+            await pipe.execute()
+        await self.redis.hset(stats_key, "finished_at", time.time())
+        stats = {k.decode(): v.decode() for k, v in (await self.redis.hgetall(stats_key)).items()}
+        logger.info("Reminder run %s finished: %s", run_id, stats)
+        return stats
+
+    async def is_finished(self, run_id: str) -> bool:
+        return bool(await self.redis.hexists(self._keys(run_id)[1], "finished_at"))
+
+
+async def reminder_scheduler(bot: Bot, redis_url: str, utility_names: dict):
+    """Фоновая задача бота: раз в минуту проверяет, не пора ли (до)отправить рассылку месяца.
+
+    Между репликами рассылку разводит Redis-блокировка.
+    """
+    redis = aioredis.from_url(redis_url)
+    broadcaster = ReminderBroadcaster(bot, redis, utility_names)
+    try:
+        while True:
+            now = datetime.now()
+            run_id = now.strftime("%Y-%m")
+            lock_key = broadcaster._keys(run_id)[2]
+            try:
+                if ((now.day, now.hour) >= (REMINDER_DAY, REMINDER_HOUR)
+                        and not await broadcaster.is_finished(run_id)
+                        and await redis.set(lock_key, "1", nx=True, ex=REMINDER_LOCK_TTL)):
+                    try:
+                        await broadcaster.run(run_id)
+                    finally:
+                        await redis.delete(lock_key)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Reminder run %s failed, will resume", run_id)
+            await asyncio.sleep(REMINDER_CHECK_INTERVAL)
+    finally:
+        await redis.aclose()
@@ -0,0 +1,162 @@
+# bot/throttling.py
+# Защита БД от всплесков. Каждый апдейт сначала берёт токен из двух вёдер в Redis —
+# своего (telegram_id) и общего на бота; вёдра общие для всех реплик. Если пул
+# соединений занят целиком, читающие хендлеры отклоняются сразу, а не ждут в
+# очереди run_db, а одинаковые одновременные запросы склеиваются в один.
+import asyncio
+import logging
+
+import redis
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+from decouple import config
+
+from database import PoolTimeout, pool_saturated
+from webapp.metrics import BOT_COALESCED, BOT_SHED, BOT_THROTTLED
+
+THROTTLE_ENABLED = config("THROTTLE_ENABLED", default=True, cast=bool)
+# Жилец: всплеск до THROTTLE_USER_BURST апдейтов, дальше THROTTLE_USER_RATE в секунду
+THROTTLE_USER_RATE = config("THROTTLE_USER_RATE", default=1.0, cast=float)
+THROTTLE_USER_BURST = config("THROTTLE_USER_BURST", default=5, cast=int)
+THROTTLE_GLOBAL_RATE = config("THROTTLE_GLOBAL_RATE", default=50.0, cast=float)
+THROTTLE_GLOBAL_BURST = config("THROTTLE_GLOBAL_BURST", default=100, cast=int)
+# Предупреждение «слишком часто» — не чаще раза за интервал, чтобы не тратить квоту Telegram
+THROTTLE_NOTICE_INTERVAL = config("THROTTLE_NOTICE_INTERVAL", default=10, cast=int)
+
+logger = logging.getLogger(__name__)
+
+# Токен списывается, только если он есть в обоих вёдрах. Время — часы Redis,
+# одинаковые для всех реплик. Возвращает 0 (пропустить), 1 (лимит жильца), 2 (общий).
+_TAKE = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local capacity = tonumber(ARGV[i * 2])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local level = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens[i] = math.min(capacity, level + math.max(0, now - ts) * rate)
+end
+local denied = 0
+for i = 1, #KEYS do
+    if tokens[i] < 1 and denied == 0 then denied = i end
+end
+for i, key in ipairs(KEYS) do
+    if denied == 0 then tokens[i] = tokens[i] - 1 end
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local capacity = tonumber(ARGV[i * 2])
+    redis.call('HSET', key, 'tokens', tostring(tokens[i]), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return denied
+"""
+
+_SCOPES = {1: "user", 2: "global"}
+
+REPLIES = {
+    "user": "Слишком часто, подождите немного.",
+    "global": "Бот сейчас перегружен, попробуйте через минуту.",
+    "shed": "Сервис перегружен, попробуйте через минуту.",
+    "pool_timeout": "База данных сейчас занята, попробуйте позже.",
+}
+
+
+class PoolTimeoutMiddleware(BaseMiddleware):
+    """Inner-middleware: хендлер не дождался соединения из пула — отвечаем жильцу, а не падаем"""
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        except PoolTimeout:
+            logger.warning("DB pool timeout in %s", type(event).__name__)
+            await event.answer(REPLIES["pool_timeout"])
+            return None
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    """Outer-middleware: лимит частоты до фильтров и хендлеров.
+
+    Redis недоступен — апдейт пропускается: лимитер не должен останавливать бота.
+    """
+
+    def __init__(self, client, user_rate: float = THROTTLE_USER_RATE, user_burst: int = THROTTLE_USER_BURST,
+                 global_rate: float = THROTTLE_GLOBAL_RATE, global_burst: int = THROTTLE_GLOBAL_BURST):
+        self.redis = client
+        self.take = client.register_script(_TAKE)
+        self.args = [user_rate, user_burst, global_rate, global_burst]
+
+    async def __call__(self, handler, event, data):
+        user = getattr(event, "from_user", None)
+        if not THROTTLE_ENABLED or user is None:
+            return await handler(event, data)
+        try:
+            denied = await self.take(keys=[f"throttle:user:{user.id}", "throttle:global"], args=self.args)
+            # Одно предупреждение за интервал; нажатие кнопки гасим всегда, иначе крутятся «часики»
+            notify = denied and (isinstance(event, CallbackQuery) or await self.redis.set(
+                f"throttle:notice:{user.id}", 1, nx=True, ex=THROTTLE_NOTICE_INTERVAL))
+        except redis.RedisError:
+            logger.warning("Throttle buckets unavailable, letting update through")
+            return await handler(event, data)
+        if not denied:
+            return await handler(event, data)
+        scope = _SCOPES[denied]
+        BOT_THROTTLED.labels(scope).inc()
+        if notify:
+            # Message.answer — сообщение в чат, CallbackQuery.answer — всплывающая подсказка
+            await event.answer(REPLIES[scope])
+        return None
+
+
+class LoadShedMiddleware(BaseMiddleware):
+    """Inner-middleware: при занятом пуле БД отклоняет читающие хендлеры.
+
+    handlers — {имя хендлера: joinable или None}; joinable(event) истинно, если
+    хендлер присоединится к уже идущему запросу и новой нагрузки не даст.
+    Платежи в handlers не входят и всегда ждут соединение.
+    """
+
+    def __init__(self, handlers: dict):
+        self.handlers = handlers
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else None
+        if name not in self.handlers or not pool_saturated():
+            return await handler(event, data)
+        joinable = self.handlers[name]
+        if joinable is not None and joinable(event):
+            return await handler(event, data)
+        BOT_SHED.labels(name).inc()
+        await event.answer(REPLIES["shed"])
+        return None
+
+
+class SingleFlight:
+    """Одновременные вызовы с одним ключом получают результат одного запроса.
+
+    Не потокобезопасен — используется только из event loop.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights = {}
+
+    def in_flight(self, key) -> bool:
+        return key in self._flights
+
+    def _done(self, key, future):
+        if self._flights.get(key) is future:
+            del self._flights[key]
+
+    async def do(self, key, func, *args, **kwargs):
+        future = self._flights.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self._flights[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        else:
+            BOT_COALESCED.labels(self.name).inc()
+        # Отмена одного ожидающего не должна отменять запрос остальных
+        return await asyncio.shield(future)
@@ -0,0 +1,107 @@
+# bot/webhook.py
+# Обработка вебхука: Telegram сразу получает 200, апдейты обрабатываются в фоне
+# с общим лимитом параллельности и строгим порядком внутри одного чата.
+import asyncio
+import logging
+from collections import deque
+
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+_CHAT_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post",
+                "business_message", "edited_business_message")
+
+
+def chat_key(update: dict):
+    """Ключ упорядочивания: id чата, а если его нет — id пользователя"""
+    for field in _CHAT_FIELDS:
+        if field in update:
+            return update[field]["chat"]["id"]
+    callback = update.get("callback_query")
+    if callback is not None:
+        message = callback.get("message")
+        return message["chat"]["id"] if message else callback["from"]["id"]
+    for value in update.values():
+        if isinstance(value, dict) and "from" in value:
+            return value["from"]["id"]
+    return ("update", update.get("update_id"))
+
+
+class OrderedUpdateProcessor:
+    """Очередь на каждый чат + семафор на общее число одновременно обрабатываемых апдейтов"""
+
+    def __init__(self, dispatcher, bot, max_concurrency: int, max_pending: int, **data):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.data = data
+        self.max_pending = max_pending
+        self.pending = 0
+        self.closing = False
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._queues = {}
+        self._tasks = set()
+
+    def submit(self, update: dict) -> bool:
+        """Ставит апдейт в очередь; False — перегрузка или остановка, пусть Telegram повторит"""
+        if self.closing or self.pending >= self.max_pending:
+            return False
+        key = chat_key(update)
+        self.pending += 1
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(update)
+            return True
+        self._queues[key] = deque([update])
+        task = asyncio.create_task(self._run_chat(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _run_chat(self, key):
+        queue = self._queues[key]
+        try:
+            while queue:
+                async with self._slots:
+                    try:
+                        await self._feed(queue[0])
+                    except Exception:
+                        logger.exception("Failed to process update for chat %s", key)
+                queue.popleft()
+                self.pending -= 1
+        finally:
+            del self._queues[key]
+
+    async def _feed(self, update: dict):
+        result = await self.dispatcher.feed_raw_update(bot=self.bot, update=update, **self.data)
+        if isinstance(result, TelegramMethod):
+            await self.dispatcher.silent_call_request(bot=self.bot, result=result)
+
+    async def drain(self, timeout: float):
+        """Перестаёт принимать апдейты и ждёт уже принятые не дольше timeout"""
+        self.closing = True
+        if not self._tasks:
+            return
+        logger.info("Draining %s pending updates", self.pending)
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        if pending:
+            logger.warning("Drain timeout: %s updates dropped", self.pending)
+            for task in pending:
+                task.cancel()
+
+
+class OrderedRequestHandler(SimpleRequestHandler):
+    def __init__(self, processor: OrderedUpdateProcessor, **kwargs):
+        super().__init__(dispatcher=processor.dispatcher, bot=processor.bot, **kwargs)
+        self.processor = processor
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+        update = await request.json(loads=bot.session.json_loads)
+        if not self.processor.submit(update):
+            return web.Response(status=503)
+        return web.json_response({}, dumps=bot.session.json_dumps)
@@ -0,0 +1,47 @@
+# tests/test_importer.py
+import unittest
+from datetime import date
+
+from webapp.importer import KINDS, StagedReading, monotonic_rejects, validate_batch
+
+
+def _rows(*values, prev_value=None, next_value=None):
+    return [StagedReading(line, 1, "water", date(2024, line, 1), value, prev_value, next_value)
+            for line, value in enumerate(values, start=1)]
+
+
+class MonotonicRejectsTest(unittest.TestCase):
+    def test_bad_row_between_good_ones(self):
+        self.assertEqual(list(monotonic_rejects(_rows(100, 50, 120))), [(2, "показание меньше предыдущего")])
+
+    def test_spike_between_good_ones(self):
+        self.assertEqual(list(monotonic_rejects(_rows(100, 900, 120, 130))), [(2, "показание больше следующего")])
+        self.assertEqual(list(monotonic_rejects(_rows(100, 900, 120, next_value=200))),
+                         [(2, "показание больше следующего")])
+
+    def test_good_rows_kept(self):
+        self.assertEqual(list(monotonic_rejects(_rows(100, 100, 120, 130))), [])
+
+    def test_existing_neighbours(self):
+        self.assertEqual(list(monotonic_rejects(_rows(90, 110, prev_value=100))),
+                         [(1, "показание меньше предыдущего")])
+        self.assertEqual(list(monotonic_rejects(_rows(110, 130, prev_value=100, next_value=120))),
+                         [(2, "показание больше следующего")])
+
+    def test_pairs_checked_separately(self):
+        rows = _rows(100) + [StagedReading(2, 2, "water", date(2024, 2, 1), 10, None, None)]
+        self.assertEqual(list(monotonic_rejects(rows)), [])
+
+
+class ValidateBatchTest(unittest.TestCase):
+    def test_non_finite_values_rejected(self):
+        batch = [(line, {"apartment_id": "1", "utility_type": "electricity", "reading_date": f"2024-0{line}-01",
+                         "reading": value})
+                 for line, value in enumerate(["nan", "inf", "-inf", "100"], start=1)]
+        good, rejects = validate_batch(KINDS["readings"], batch, {1}, set())
+        self.assertEqual([row[0] for row in good], [4])
+        self.assertEqual(rejects, [(1, "некорректное число"), (2, "некорректное число"), (3, "некорректное число")])
+
+
+if __name__ == "__main__":
+    unittest.main()
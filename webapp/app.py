@@ -6,6 +6,28 @@ def create_app():
     app = Flask(__name__)
     app.secret_key = config("FLASK_SECRET_KEY")
 
+    from .database import init_app as init_db
+    init_db(app)
+
+    from .metrics import init_app as init_metrics
+    init_metrics(app)
+
+    # Подписка на отзыв сессий нужна только процессу, который обслуживает запросы:
+    # flask-команды и воркер выгрузок запросов не получают и поток не запускают
+    from .auth import start_revocation_listener
+    app.before_request(start_revocation_listener)
+
+    from .billing import billing_cli
+    app.cli.add_command(billing_cli)
+    from .ledger import ledger_cli
+    app.cli.add_command(ledger_cli)
+    from .migrations import db_cli
+    app.cli.add_command(db_cli)
+    from .rollups import rollup_cli
+    app.cli.add_command(rollup_cli)
+    from .partitions import partitions_cli
+    app.cli.add_command(partitions_cli)
+
     from .views import main as main_blueprint
     app.register_blueprint(main_blueprint)
 
@@ -1,12 +1,35 @@
 # webapp/auth.py
+import logging
+import threading
+import time
+from collections import OrderedDict
+
 import redis
 import json
 from datetime import datetime, timedelta
 from decouple import config
 
+from .metrics import InstrumentedRedis
+
 # Получаем URL Redis из .env или используем локальный по умолчанию
 REDIS_URL = config("REDIS_URL", default="redis://localhost:6379/0")
-redis_client = redis.from_url(REDIS_URL)
+redis_client = InstrumentedRedis.from_url(REDIS_URL)
+
+# Сессии кэшируются в процессе на SESSION_CACHE_TTL секунд; отзыв приходит через pub/sub.
+# SESSION_MODE=cookie: проверенные данные сессии лежат в подписанной cookie Flask и
+# сверяются с Redis не чаще раза в SESSION_RECHECK_SECONDS.
+SESSION_CACHE_TTL = config("SESSION_CACHE_TTL", default=30, cast=float)
+SESSION_CACHE_SIZE = config("SESSION_CACHE_SIZE", default=10000, cast=int)
+SESSION_MODE = config("SESSION_MODE", default="redis")
+SESSION_RECHECK_SECONDS = config("SESSION_RECHECK_SECONDS", default=300, cast=float)
+
+logger = logging.getLogger(__name__)
+
+# LRU: при переполнении вытесняется самая давно запрошенная сессия, а не весь кэш
+_cache = OrderedDict()
+_revoked = {}
+_cache_lock = threading.Lock()
+_listener = None
 
 
 def create_session(telegram_id: int, apartment_id: int) -> str:
@@ -22,13 +45,82 @@ def create_session(telegram_id: int, apartment_id: int) -> str:
     return token
 
 
-def get_session(token: str):
-    """Возвращает данные сессии или None, если недействительна"""
+def _load_session(token: str):
     data = redis_client.get(f"session:{token}")
     if not data:  # ← вот правильное завершённое условие
         return None
     payload = json.loads(data)
-    if datetime.fromisoformat(payload["expires"]) < datetime.utcnow():
+    expires = datetime.fromisoformat(payload["expires"])
+    if expires < datetime.utcnow():
         redis_client.delete(f"session:{token}")
         return None
+    # Храним время истечения как unix-время, чтобы не разбирать дату на каждом запросе
+    payload["expires_at"] = time.time() + (expires - datetime.utcnow()).total_seconds()
+    return payload
+
+
+def get_session(token: str):
+    """Возвращает данные сессии или None, если недействительна"""
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(token)
+        if cached is not None:
+            _cache.move_to_end(token)
+    if cached is not None and cached[0] > now:
+        payload = cached[1]
+        if payload is None or payload["expires_at"] > time.time():
+            return payload
+    payload = _load_session(token)
+    with _cache_lock:
+        _cache[token] = (now + SESSION_CACHE_TTL, payload)
+        _cache.move_to_end(token)
+        while len(_cache) > SESSION_CACHE_SIZE:
+            _cache.popitem(last=False)
     return payload
+
+
+def revoke_session(token: str):
+    """Удаляет сессию и сообщает всем процессам веб-панели"""
+    from .events import SESSION_CHANNEL, publish
+    redis_client.delete(f"session:{token}")
+    _forget(token)
+    publish(SESSION_CHANNEL, token)
+
+
+def is_revoked(token: str) -> bool:
+    with _cache_lock:
+        return token in _revoked
+
+
+def _forget(token: str):
+    with _cache_lock:
+        _cache.pop(token, None)
+        # Помним отзыв, пока его не перекроет перепроверка cookie-сессий
+        _revoked[token] = time.monotonic() + SESSION_RECHECK_SECONDS
+        expired = [t for t, until in _revoked.items() if until < time.monotonic()]
+        for t in expired:
+            del _revoked[t]
+
+
+def _listen_revocations():
+    from .events import SESSION_CHANNEL
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(SESSION_CHANNEL)
+            for message in pubsub.listen():
+                _forget(message["data"].decode())
+        except redis.RedisError:
+            logger.warning("Session revocation listener disconnected, reconnecting", exc_info=True)
+            # Пока подписки не было, отзывы могли потеряться — доверять кэшу нельзя
+            with _cache_lock:
+                _cache.clear()
+            time.sleep(1)
+
+
+def start_revocation_listener():
+    """Запускает фоновый поток подписки (в gevent-воркере — гринлет) при первом запросе процесса"""
+    global _listener
+    if _listener is None:
+        _listener = threading.Thread(target=_listen_revocations, name="session-revocations", daemon=True)
+        _listener.start()
@@ -0,0 +1,229 @@
+# webapp/billing.py
+# Начисление строится на паре соседних показаний (apartment, utility): период —
+# от предыдущего показания до текущего. Тариф берётся из tariff_index: если в
+# период попала смена тарифа, потребление делится между тарифами пропорционально
+# дням; дни до самого раннего тарифа не оцениваются. tariff_used — средняя по дням ставка.
+# Ключ идемпотентности — (apartment_id, utility_type, period_end): повторный
+# запуск за тот же период ничего не дублирует, а лишь обновляет изменившиеся суммы.
+from collections import defaultdict, namedtuple
+from datetime import date, timedelta
+from itertools import islice
+
+import click
+from flask.cli import AppGroup
+from psycopg2.extras import execute_values
+
+from .database import get_db
+from .ledger import refresh_charged
+from .page_cache import bump_data_version
+from .partitions import ensure_partitions, get_archive_boundary
+from .rollups import refresh_rollups
+from .tariff_index import TariffIndex
+
+BATCH_SIZE = 5000
+
+PricedReading = namedtuple("PricedReading",
+                           "apartment_id utility_type period_start period_end consumption rate amount")
+
+# Пары соседних показаний одним set-based запросом: предыдущее показание ищется
+# по индексу через LATERAL, без запроса на каждую квартиру
+_READING_PAIRS = """
+    SELECT cur.apartment_id,
+           cur.utility_type,
+           prev.reading_date          AS period_start,
+           cur.reading_date           AS period_end,
+           cur.reading - prev.reading AS consumption
+    FROM meter_reading cur
+             JOIN LATERAL (
+        SELECT p.reading, p.reading_date
+        FROM meter_reading p
+        WHERE p.apartment_id = cur.apartment_id
+          AND p.utility_type = cur.utility_type
+          AND p.reading_date < cur.reading_date
+        ORDER BY p.reading_date DESC
+        LIMIT 1
+        ) prev ON TRUE
+    WHERE cur.reading_date BETWEEN %(start)s AND %(end)s
+      AND cur.reading >= prev.reading
+      {scope}
+"""
+
+_UPSERT_CHARGES = """
+    INSERT INTO charge (apartment_id, utility_type, period_start, period_end, consumption, tariff_used, amount)
+    VALUES %s
+    ON CONFLICT (apartment_id, utility_type, period_end) DO UPDATE
+        SET period_start = EXCLUDED.period_start,
+            consumption  = EXCLUDED.consumption,
+            tariff_used  = EXCLUDED.tariff_used,
+            amount       = EXCLUDED.amount
+    WHERE (charge.period_start, charge.consumption, charge.tariff_used, charge.amount)
+              IS DISTINCT FROM
+          (EXCLUDED.period_start, EXCLUDED.consumption, EXCLUDED.tariff_used, EXCLUDED.amount)
+    RETURNING apartment_id, utility_type, period_end, (xmax = 0) AS inserted
+"""
+
+# Начисления, чьё закрывающее показание удалили или перенесли; оплаченные не трогаем
+_DELETE_STALE = """
+    DELETE
+    FROM charge c
+    WHERE c.apartment_id = %(apartment_id)s
+      AND c.utility_type = %(utility_type)s
+      AND c.period_end >= %(start)s
+      AND NOT EXISTS (SELECT 1
+                      FROM meter_reading m
+                      WHERE m.apartment_id = c.apartment_id
+                        AND m.utility_type = c.utility_type
+                        AND m.reading_date = c.period_end)
+      AND NOT EXISTS (SELECT 1 FROM payment p WHERE p.charge_id = c.id AND p.charge_period_end = c.period_end)
+    RETURNING c.apartment_id, c.utility_type, c.period_end
+"""
+
+_SCOPE = "AND cur.apartment_id = %(apartment_id)s AND cur.utility_type = %(utility_type)s"
+
+# Набор (квартира, ресурс, с какой даты) передаётся массивами — один запрос на всю пачку
+_SCOPE_MANY = """
+      AND EXISTS (SELECT 1
+                  FROM unnest(%(apartment_ids)s::int[], %(utility_types)s::text[], %(sinces)s::date[])
+                           AS s(apartment_id, utility_type, since)
+                  WHERE s.apartment_id = cur.apartment_id
+                    AND s.utility_type = cur.utility_type
+                    AND cur.reading_date >= s.since)
+"""
+
+
+def priced_readings(conn, index: TariffIndex, params: dict, scope: str = ""):
+    """Пары показаний, оценённые по индексу тарифов; amount None — период не покрыт тарифом"""
+    with conn.cursor(name="reading_pairs") as cur:
+        cur.itersize = BATCH_SIZE
+        cur.execute(_READING_PAIRS.format(scope=scope), params)
+        for row in cur:
+            rate = index.average_rate(row["apartment_id"], row["utility_type"],
+                                      row["period_start"], row["period_end"])
+            amount = None if rate is None else round(row["consumption"] * rate, 2)
+            yield PricedReading(row["apartment_id"], row["utility_type"], row["period_start"],
+                                row["period_end"], row["consumption"], rate, amount)
+
+
+def _upsert(conn, cur, index: TariffIndex, params, scope=""):
+    # Начисления без тарифа не создаются
+    priced = (r for r in priced_readings(conn, index, params, scope) if r.amount is not None)
+    rows = []
+    while True:
+        batch = list(islice(priced, BATCH_SIZE))
+        if not batch:
+            break
+        rows.extend(execute_values(cur, _UPSERT_CHARGES, batch, page_size=BATCH_SIZE, fetch=True))
+    inserted = sum(1 for r in rows if r["inserted"])
+    refresh_charged(cur, (r["apartment_id"] for r in rows))
+    refresh_rollups(cur, ((r["apartment_id"], r["utility_type"], r["period_end"]) for r in rows))
+    bump_data_version(cur, (r["apartment_id"] for r in rows))
+    return {"inserted": inserted, "updated": len(rows) - inserted}
+
+
+def _open_since(cur, since: date) -> date:
+    # Архивные (закрытые) периоды не перерасчитываются
+    return max(since, get_archive_boundary(cur))
+
+
+def run_billing(conn, period_start: date, period_end: date) -> dict:
+    """Начисления по всем квартирам и ресурсам за период одним запросом"""
+    cur = conn.cursor()
+    index = TariffIndex()
+    index.load(conn)
+    stats = _upsert(conn, cur, index, {"start": _open_since(cur, period_start), "end": period_end})
+    conn.commit()
+    return stats
+
+
+def recompute_charges(conn, apartment_id: int, utility_type: str, since: date) -> dict:
+    """Пересчёт после исправления показания или тарифа, действующего с даты since.
+
+    Затрагивает начисления, закрывающиеся в since или позже. Коммит — на вызывающем.
+    В индекс тарифов читается только эта пара — уже с только что записанным тарифом.
+    """
+    cur = conn.cursor()
+    index = TariffIndex()
+    index.refresh(conn, [(apartment_id, utility_type)])
+    params = {"apartment_id": apartment_id, "utility_type": utility_type,
+              "start": _open_since(cur, since), "end": date.max}
+    stats = _upsert(conn, cur, index, params, scope=_SCOPE)
+    cur.execute(_DELETE_STALE, params)
+    deleted = cur.fetchall()
+    stats["deleted"] = len(deleted)
+    if deleted:
+        refresh_charged(cur, [apartment_id])
+        refresh_rollups(cur, ((r["apartment_id"], r["utility_type"], r["period_end"]) for r in deleted))
+        bump_data_version(cur, [apartment_id])
+    return stats
+
+
+def recompute_many(conn, scopes) -> dict:
+    """Пересчёт для набора (apartment_id, utility_type, since) после массовой загрузки.
+
+    Коммит — на вызывающем.
+    """
+    scopes = list(scopes)
+    if not scopes:
+        return {"inserted": 0, "updated": 0}
+    apartment_ids, utility_types, sinces = zip(*scopes)
+    cur = conn.cursor()
+    index = TariffIndex()
+    index.refresh(conn, zip(apartment_ids, utility_types))
+    params = {"apartment_ids": list(apartment_ids), "utility_types": list(utility_types),
+              "sinces": list(sinces), "start": _open_since(cur, min(sinces)), "end": date.max}
+    return _upsert(conn, cur, index, params, scope=_SCOPE_MANY)
+
+
+def previous_month(today: date = None):
+    today = today or date.today()
+    end = today.replace(day=1) - timedelta(days=1)
+    return end.replace(day=1), end
+
+
+billing_cli = AppGroup("billing", help="Расчёт начислений")
+
+
+@billing_cli.command("run")
+@click.option("--start", type=click.DateTime(["%Y-%m-%d"]), help="Начало периода (по умолчанию прошлый месяц)")
+@click.option("--end", type=click.DateTime(["%Y-%m-%d"]), help="Конец периода")
+def run_command(start, end):
+    default_start, default_end = previous_month()
+    start = start.date() if start else default_start
+    end = end.date() if end else default_end
+    # Ежемесячный запуск заодно заводит секции на следующие месяцы
+    ensure_partitions(get_db())
+    stats = run_billing(get_db(), start, end)
+    click.echo(f"{start} – {end}: создано {stats['inserted']}, обновлено {stats['updated']}")
+
+
+@billing_cli.command("recompute")
+@click.argument("apartment_id", type=int)
+@click.argument("utility_type")
+@click.argument("since", type=click.DateTime(["%Y-%m-%d"]))
+def recompute_command(apartment_id, utility_type, since):
+    conn = get_db()
+    stats = recompute_charges(conn, apartment_id, utility_type, since.date())
+    conn.commit()
+    click.echo(f"создано {stats['inserted']}, обновлено {stats['updated']}, удалено {stats['deleted']}")
+
+
+@billing_cli.command("price-history")
+@click.option("--start", type=click.DateTime(["%Y-%m-%d"]), required=True)
+@click.option("--end", type=click.DateTime(["%Y-%m-%d"]), required=True)
+def price_history_command(start, end):
+    """Оценка показаний за период по индексу тарифов (с делением по смене тарифа)"""
+    conn = get_db()
+    index = TariffIndex()
+    index.load(conn)
+    totals = defaultdict(float)
+    unpriced = 0
+    for row in priced_readings(conn, index, {"start": start.date(), "end": end.date()}):
+        if row.amount is None:
+            unpriced += 1
+        else:
+            totals[row.utility_type] += row.amount
+    for utility_type, amount in sorted(totals.items()):
+        click.echo(f"{utility_type}: {amount:.2f}")
+    if unpriced:
+        click.echo(f"без тарифа: {unpriced}")
+    conn.rollback()
@@ -0,0 +1,129 @@
+# webapp/charts.py
+# Графики потребления из помесячных итогов. Готовая картинка кладётся в Redis
+# под ключом с версией итогов квартиры: пока итоги не менялись, график не
+# перерисовывается и сырые показания не читаются вовсе.
+import io
+import logging
+from xml.sax.saxutils import escape
+
+import redis
+from decouple import config
+from PIL import Image, ImageDraw, ImageFont
+
+from .auth import redis_client
+from .rollups import get_series, months_back
+
+CHART_CACHE_TTL = config("CHART_CACHE_TTL", default=7 * 24 * 3600, cast=int)
+# Для кириллицы в PNG нужен TTF-шрифт; без него Pillow возьмёт встроенный
+CHART_FONT = config("CHART_FONT", default="DejaVuSans.ttf")
+CHART_WIDTH = 720
+CHART_HEIGHT = 260
+_PAD_LEFT, _PAD_RIGHT, _PAD_TOP, _PAD_BOTTOM = 56, 12, 24, 36
+
+MIMETYPES = {"svg": "image/svg+xml", "png": "image/png"}
+
+logger = logging.getLogger(__name__)
+
+
+def _layout(points):
+    """Координаты столбиков: (подпись, значение, x, y, ширина, высота)"""
+    top = max((v for _, v in points), default=0) or 1
+    plot_w = CHART_WIDTH - _PAD_LEFT - _PAD_RIGHT
+    plot_h = CHART_HEIGHT - _PAD_TOP - _PAD_BOTTOM
+    step = plot_w / max(len(points), 1)
+    bars = []
+    for i, (label, value) in enumerate(points):
+        h = plot_h * max(value, 0) / top
+        x = _PAD_LEFT + i * step + step * 0.15
+        bars.append((label, value, x, _PAD_TOP + plot_h - h, step * 0.7, h))
+    return top, bars
+
+
+def _label_every(count: int) -> int:
+    return max(1, count // 12)
+
+
+def render_svg(points, title: str) -> bytes:
+    top, bars = _layout(points)
+    base = CHART_HEIGHT - _PAD_BOTTOM
+    every = _label_every(len(bars))
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{CHART_WIDTH}" height="{CHART_HEIGHT}" '
+        f'viewBox="0 0 {CHART_WIDTH} {CHART_HEIGHT}" font-family="sans-serif" font-size="11">',
+        f'<text x="{_PAD_LEFT}" y="15" font-size="13">{escape(title)}</text>',
+        f'<line x1="{_PAD_LEFT}" y1="{base}" x2="{CHART_WIDTH - _PAD_RIGHT}" y2="{base}" stroke="#999"/>',
+        f'<text x="{_PAD_LEFT - 6}" y="{_PAD_TOP + 4}" text-anchor="end">{top:g}</text>',
+    ]
+    for i, (label, value, x, y, w, h) in enumerate(bars):
+        parts.append(f'<rect x="{x:.1f}" y="{y:.1f}" width="{w:.1f}" height="{h:.1f}" fill="#0d6efd">'
+                     f'<title>{escape(label)}: {value:g}</title></rect>')
+        if i % every == 0:
+            parts.append(f'<text x="{x + w / 2:.1f}" y="{base + 14}" text-anchor="middle">{escape(label)}</text>')
+    parts.append("</svg>")
+    return "".join(parts).encode()
+
+
+_font = None
+
+
+def _png_font():
+    global _font
+    if _font is None:
+        try:
+            _font = ImageFont.truetype(CHART_FONT, 11)
+        except OSError:
+            _font = ImageFont.load_default()
+    return _font
+
+
+def render_png(points, title: str) -> bytes:
+    top, bars = _layout(points)
+    base = CHART_HEIGHT - _PAD_BOTTOM
+    every = _label_every(len(bars))
+    image = Image.new("RGB", (CHART_WIDTH, CHART_HEIGHT), "white")
+    draw = ImageDraw.Draw(image)
+    font = _png_font()
+    draw.text((_PAD_LEFT, 4), title, fill="black", font=font)
+    draw.line((_PAD_LEFT, base, CHART_WIDTH - _PAD_RIGHT, base), fill="#999999")
+    draw.text((4, _PAD_TOP - 4), f"{top:g}", fill="black", font=font)
+    for i, (label, value, x, y, w, h) in enumerate(bars):
+        if h > 0:
+            draw.rectangle((x, y, x + w, base), fill="#0d6efd")
+        if i % every == 0:
+            draw.text((x, base + 6), label, fill="black", font=font)
+    buf = io.BytesIO()
+    image.save(buf, "PNG", optimize=True)
+    return buf.getvalue()
+
+
+_RENDERERS = {"svg": render_svg, "png": render_png}
+
+
+def series_points(rows, metric: str = "consumption"):
+    return [(row["month"].strftime("%m.%y"), round(row[metric], 2)) for row in rows]
+
+
+def chart_key(apartment_id: int, utility_type: str, since, metric: str, fmt: str, version: int) -> str:
+    # since в ключе: с началом нового месяца окно сдвигается, хотя версия та же
+    return f"chart:{apartment_id}:{utility_type}:{metric}:{since:%Y%m}:{fmt}:v{version}"
+
+
+def get_chart(cur, apartment_id: int, utility_type: str, months: int, metric: str, fmt: str, title: str,
+              version: int) -> bytes:
+    """Картинка графика для версии итогов; рисуется только при промахе кэша"""
+    since = months_back(months)
+    key = chart_key(apartment_id, utility_type, since, metric, fmt, version)
+    try:
+        cached = redis_client.get(key)
+    except redis.RedisError:
+        logger.warning("Chart cache unavailable", exc_info=True)
+        cached = None
+    if cached is not None:
+        return cached
+    rows = get_series(cur, apartment_id, since, utility_type)
+    body = _RENDERERS[fmt](series_points(rows, metric), title)
+    try:
+        redis_client.setex(key, CHART_CACHE_TTL, body)
+    except redis.RedisError:
+        logger.warning("Chart cache unavailable", exc_info=True)
+    return body
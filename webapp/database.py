@@ -1,12 +1,153 @@
 # webapp/database.py
+import logging
 import os
+import threading
+import time
+
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from flask import g
+from psycopg2 import extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+from .metrics import DB_POOL_IN_USE, DB_POOL_TIMEOUTS, DB_POOL_WAIT_SECONDS, InstrumentedCursor
+from .repository import RepositoryConnection
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Пул на процесс воркера: размер и сколько секунд ждать свободное соединение
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "5"))
 
-def get_db():
-    """Возвращает подключение к PostgreSQL"""
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+logger = logging.getLogger(__name__)
+
+_pool = None
+_slots = None
+_init_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {
+    "in_use": 0,
+    "max_in_use": 0,
+    "waiting": 0,
+    "acquired_total": 0,
+    "timeouts_total": 0,
+    "wait_seconds_total": 0.0,
+}
+
+
+class PoolExhausted(Exception):
+    """Свободное соединение не появилось за DB_ACQUIRE_TIMEOUT"""
+
+
+def _gevent_wait_callback(conn, timeout=None):
+    """Ожидание ответа libpq через хаб gevent вместо блокирующего вызова"""
+    from gevent.socket import wait_read, wait_write
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"Bad result from poll: {state!r}")
+
+
+def _gevent_patched() -> bool:
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+
+def _ensure_pool():
+    # Пул создаётся лениво, чтобы каждый воркер gunicorn получил свой после fork
+    global _pool, _slots
+    if _pool is not None:
+        return
+    with _init_lock:
+        if _pool is None:
+            _pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, cursor_factory=InstrumentedCursor,
+                                           connection_factory=RepositoryConnection)
+            _slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+
+def acquire_connection():
+    """Берёт соединение из пула, ожидая не дольше DB_ACQUIRE_TIMEOUT"""
+    _ensure_pool()
+    started = time.monotonic()
+    with _stats_lock:
+        _stats["waiting"] += 1
+    got_slot = _slots.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    waited = time.monotonic() - started
+    DB_POOL_WAIT_SECONDS.labels("web").observe(waited)
+    with _stats_lock:
+        _stats["waiting"] -= 1
+        _stats["wait_seconds_total"] += waited
+        if not got_slot:
+            _stats["timeouts_total"] += 1
+    if not got_slot:
+        DB_POOL_TIMEOUTS.labels("web").inc()
+        logger.warning("DB pool exhausted: no connection after %.1fs", waited)
+        raise PoolExhausted(f"no free DB connection in {DB_ACQUIRE_TIMEOUT}s")
+    try:
+        conn = _pool.getconn()
+        if conn.closed:
+            _pool.putconn(conn, close=True)
+            conn = _pool.getconn()
+    except Exception:
+        _slots.release()
+        raise
+    with _stats_lock:
+        _stats["in_use"] += 1
+        _stats["acquired_total"] += 1
+        _stats["max_in_use"] = max(_stats["max_in_use"], _stats["in_use"])
+    DB_POOL_IN_USE.labels("web").inc()
     return conn
+
+
+def release_connection(conn, discard: bool = False):
+    """Возвращает соединение в пул (битое — закрывает)"""
+    discard = discard or bool(conn.closed)
+    if not discard and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            discard = True
+    _pool.putconn(conn, close=discard)
+    _slots.release()
+    DB_POOL_IN_USE.labels("web").dec()
+    with _stats_lock:
+        _stats["in_use"] -= 1
+
+
+def get_db():
+    """Возвращает подключение к PostgreSQL, закреплённое за текущим запросом"""
+    if "db" not in g:
+        g.db = acquire_connection()
+    return g.db
+
+
+def close_db(exc=None):
+    """teardown: возвращает соединение запроса в пул"""
+    conn = g.pop("db", None)
+    if conn is not None:
+        release_connection(conn, discard=isinstance(exc, psycopg2.OperationalError))
+
+
+def pool_stats() -> dict:
+    """Метрики заполненности пула текущего процесса"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["size"] = DB_POOL_MAX
+    stats["saturation"] = stats["in_use"] / DB_POOL_MAX if DB_POOL_MAX else 0.0
+    return stats
+
+
+def init_app(app):
+    if _gevent_patched():
+        extensions.set_wait_callback(_gevent_wait_callback)
+        logger.info("psycopg2 switched to gevent wait callback")
+    app.teardown_appcontext(close_db)
@@ -0,0 +1,25 @@
+# webapp/events.py
+# Межпроцессные уведомления через Redis pub/sub (веб -> бот и между воркерами)
+import logging
+
+import redis
+
+from .auth import redis_client
+
+IDENTITY_CHANNEL = "identity:invalidate"
+SESSION_CHANNEL = "session:revoke"
+
+logger = logging.getLogger(__name__)
+
+
+def publish(channel: str, message: str):
+    # Доставка best-effort: кэши подписчиков всё равно ограничены TTL
+    try:
+        redis_client.publish(channel, message)
+    except redis.RedisError:
+        logger.warning("Failed to publish to %s", channel, exc_info=True)
+
+
+def publish_identity_change(telegram_id):
+    """Сбрасывает закэшированные в боте данные жильца"""
+    publish(IDENTITY_CHANNEL, str(telegram_id))
@@ -0,0 +1,165 @@
+# webapp/export_jobs.py
+# Фоновая выгрузка Excel: веб кладёт задачу в очередь Redis, export_worker её
+# выполняет. Готовый файл кэшируется по версии данных (квартиры + последние
+# изменения начислений/оплат), поэтому повторный запрос без изменений не
+# генерирует файл заново. Файл хранится в Redis: веб и воркер выгрузок — разные
+# процессы (на Railway — разные контейнеры) без общего диска. Ни воркер, ни веб
+# не держат его в памяти целиком: запись — APPEND кусками из временного файла,
+# отдача — GETRANGE кусками. Размер ограничен EXPORT_MAX_BYTES, срок — EXPORT_CACHE_TTL.
+import hashlib
+import json
+import time
+from secrets import token_urlsafe
+
+from decouple import config
+
+from .auth import redis_client
+
+EXPORT_CACHE_TTL = config("EXPORT_CACHE_TTL", default=3600, cast=int)
+EXPORT_MAX_BYTES = config("EXPORT_MAX_BYTES", default=50 * 1024 * 1024, cast=int)
+EXPORT_CHUNK_BYTES = 1024 * 1024
+EXPORT_JOB_TTL = config("EXPORT_JOB_TTL", default=24 * 3600, cast=int)
+
+QUEUE_KEY = "export:queue"
+
+
+def _job_key(job_id: str) -> str:
+    return f"export:job:{job_id}"
+
+
+def _inflight_key(cache_key: str) -> str:
+    return f"export:inflight:{cache_key}"
+
+
+def _result_key(cache_key: str) -> str:
+    return f"export:result:{cache_key}"
+
+
+def store_result(cache_key: str, stream):
+    """Копирует готовый xlsx из файлового объекта в Redis кусками.
+
+    Куски пишутся в отдельный ключ и переименовываются в конце — читатели
+    никогда не видят недописанный файл.
+    """
+    key = _result_key(cache_key)
+    part = f"{key}:part"
+    redis_client.delete(part)
+    while True:
+        chunk = stream.read(EXPORT_CHUNK_BYTES)
+        if not chunk:
+            break
+        redis_client.append(part, chunk)
+    pipe = redis_client.pipeline()
+    pipe.rename(part, key)
+    pipe.expire(key, EXPORT_CACHE_TTL)
+    pipe.execute()
+
+
+def result_size(cache_key: str) -> int:
+    """Размер готового xlsx в байтах; 0 — его ещё нет или TTL истёк"""
+    return redis_client.strlen(_result_key(cache_key))
+
+
+def iter_result(cache_key: str, size: int):
+    """Содержимое готового xlsx кусками по EXPORT_CHUNK_BYTES"""
+    key = _result_key(cache_key)
+    for start in range(0, size, EXPORT_CHUNK_BYTES):
+        chunk = redis_client.getrange(key, start, min(start + EXPORT_CHUNK_BYTES, size) - 1)
+        if not chunk:
+            # Ключ истёк посреди отдачи
+            return
+        yield chunk
+
+
+def has_result(cache_key: str) -> bool:
+    return bool(redis_client.exists(_result_key(cache_key)))
+
+
+_DATA_VERSION = """
+    SELECT (SELECT MAX(id) FROM charge WHERE apartment_id = ANY (%(ids)s))  AS last_charge,
+           (SELECT MAX(id) FROM payment WHERE apartment_id = ANY (%(ids)s)) AS last_payment,
+           SUM(charged)                                                     AS charged,
+           SUM(paid)                                                        AS paid
+    FROM apartment_balance
+    WHERE apartment_id = ANY (%(ids)s)
+"""
+
+
+def data_version(conn, apartment_ids) -> str:
+    """Отпечаток данных выгрузки: меняется при любом новом/изменённом начислении или оплате"""
+    cur = conn.cursor()
+    cur.execute(_DATA_VERSION, {"ids": list(apartment_ids)})
+    row = cur.fetchone()
+    conn.commit()
+    if row["last_charge"] is None:
+        # Начислений нет — выгружать нечего
+        return None
+    return f"{row['last_charge']}:{row['last_payment']}:{row['charged']}:{row['paid']}"
+
+
+def cache_key(apartment_ids, version: str) -> str:
+    ids = ",".join(str(i) for i in sorted(apartment_ids))
+    return hashlib.sha1(f"{ids}|{version}".encode()).hexdigest()
+
+
+def submit_export(conn, apartment_ids, telegram_id: int, download_name: str) -> str:
+    """Ставит выгрузку в очередь (или сразу отдаёт готовый файл из кэша); возвращает id задачи.
+
+    None — у квартир нет начислений, выгружать нечего.
+    """
+    apartment_ids = sorted(set(apartment_ids))
+    version = data_version(conn, apartment_ids)
+    if version is None:
+        return None
+    key = cache_key(apartment_ids, version)
+    job_id = token_urlsafe(12)
+    job = {
+        "status": "queued",
+        "cache_key": key,
+        "apartment_ids": json.dumps(apartment_ids),
+        "telegram_id": telegram_id,
+        "download_name": download_name,
+        "created_at": time.time(),
+    }
+    if has_result(key):
+        job["status"] = "done"
+        redis_client.hset(_job_key(job_id), mapping=job)
+        redis_client.expire(_job_key(job_id), EXPORT_JOB_TTL)
+        return job_id
+
+    # Если такой же файл уже генерируется, новую задачу не ставим — ждём существующую
+    if not redis_client.set(_inflight_key(key), job_id, nx=True, ex=EXPORT_JOB_TTL):
+        existing = redis_client.get(_inflight_key(key))
+        if existing:
+            existing = existing.decode()
+            if redis_client.exists(_job_key(existing)):
+                return existing
+        redis_client.set(_inflight_key(key), job_id, ex=EXPORT_JOB_TTL)
+
+    pipe = redis_client.pipeline()
+    pipe.hset(_job_key(job_id), mapping=job)
+    pipe.expire(_job_key(job_id), EXPORT_JOB_TTL)
+    pipe.lpush(QUEUE_KEY, job_id)
+    pipe.execute()
+    return job_id
+
+
+def get_job(job_id: str):
+    raw = redis_client.hgetall(_job_key(job_id))
+    if not raw:
+        return None
+    job = {k.decode(): v.decode() for k, v in raw.items()}
+    job["id"] = job_id
+    job["telegram_id"] = int(job["telegram_id"])
+    job["apartment_ids"] = json.loads(job["apartment_ids"])
+    return job
+
+
+def update_job(job_id: str, **fields):
+    redis_client.hset(_job_key(job_id), mapping=fields)
+
+
+def finish_job(job_id: str, job: dict, status: str, **fields):
+    update_job(job_id, status=status, **fields)
+    redis_client.delete(_inflight_key(job["cache_key"]))
+
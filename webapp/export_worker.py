@@ -0,0 +1,79 @@
+# webapp/export_worker.py
+# Пул процессов, разбирающих очередь выгрузок: python -m webapp.export_worker
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+import redis
+from decouple import config
+
+from .auth import redis_client
+from .export_jobs import (EXPORT_MAX_BYTES, QUEUE_KEY, finish_job, get_job, has_result, store_result,
+                          update_job)
+
+EXPORT_WORKERS = config("EXPORT_WORKERS", default=2, cast=int)
+
+logger = logging.getLogger(__name__)
+
+
+def process_job(app, job_id: str):
+    from .database import get_db
+    from .utils.excel_export import export_to_excel
+
+    job = get_job(job_id)
+    if job is None:
+        return
+    if has_result(job["cache_key"]):
+        finish_job(job_id, job, "done")
+        return
+    update_job(job_id, status="running", started_at=time.time())
+    try:
+        # Книга пишется во временный файл, а не в память: её размер не ограничен ОЗУ воркера
+        with tempfile.TemporaryFile() as out:
+            with app.app_context():
+                rows = export_to_excel(get_db(), job["apartment_ids"], out)
+            if not rows:
+                # Начисления успели удалить после постановки задачи
+                finish_job(job_id, job, "empty", rows=0, finished_at=time.time())
+                return
+            size = out.seek(0, os.SEEK_END)
+            if size > EXPORT_MAX_BYTES:
+                finish_job(job_id, job, "failed", error=f"файл больше {EXPORT_MAX_BYTES // 1024 ** 2} МБ")
+                return
+            out.seek(0)
+            store_result(job["cache_key"], out)
+    except Exception as e:
+        logger.exception("Export job %s failed", job_id)
+        finish_job(job_id, job, "failed", error=str(e))
+        return
+    finish_job(job_id, job, "done", rows=rows, finished_at=time.time())
+
+
+def worker_loop():
+    from .app import app
+
+    logger.info("Export worker %s started", os.getpid())
+    while True:
+        try:
+            item = redis_client.brpop(QUEUE_KEY, timeout=5)
+        except redis.ConnectionError:
+            logger.warning("Redis unavailable, retrying")
+            time.sleep(1)
+            continue
+        if item:
+            process_job(app, item[1].decode())
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    processes = [multiprocessing.Process(target=worker_loop, daemon=True) for _ in range(EXPORT_WORKERS)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired, FileAllowed
 from wtforms import StringField, FloatField, DateField, SelectField, SubmitField, BooleanField
 from wtforms.validators import DataRequired, NumberRange
 
@@ -22,3 +23,10 @@ class ResidentForm(FlaskForm):
     full_name = StringField("Имя", validators=[DataRequired()])
     is_admin = BooleanField("Админ")
     submit = SubmitField("Добавить")
+
+
+class ImportForm(FlaskForm):
+    kind = SelectField("Что загружаем", choices=[("readings", "Показания счётчиков"), ("tariffs", "Тарифы")],
+                       validators=[DataRequired()])
+    file = FileField("Файл CSV или XLSX", validators=[FileRequired(), FileAllowed(["csv", "xlsx"])])
+    submit = SubmitField("Загрузить")
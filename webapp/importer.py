@@ -0,0 +1,274 @@
+# webapp/importer.py
+# Массовая загрузка показаний и тарифов из CSV/XLSX. Файл читается потоково,
+# строки проверяются пачками и через COPY попадают во временную staging-таблицу;
+# проверки против базы и слияние — по одному SQL-запросу на всю загрузку.
+# Монотонность показаний проверяется одним потоковым проходом по staging с
+# ближайшими показаниями из базы.
+import csv
+import io
+import math
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import date
+from itertools import groupby, islice
+
+from openpyxl import load_workbook
+from psycopg2.extras import execute_values
+
+from .billing import recompute_many
+from .forms import UTILITY_CHOICES
+from .page_cache import bump_data_version
+
+BATCH_SIZE = 5000
+MAX_REPORTED_REJECTS = 500
+
+UTILITIES = {code for code, _ in UTILITY_CHOICES}
+
+ImportKind = namedtuple("ImportKind", "table date_column value_column")
+
+KINDS = {
+    "readings": ImportKind("meter_reading", "reading_date", "reading"),
+    "tariffs": ImportKind("tariff", "valid_from", "rate"),
+}
+
+ImportReport = namedtuple("ImportReport", "total loaded rejected rejects")
+
+StagedReading = namedtuple("StagedReading", "line apartment_id utility_type day value prev_value next_value")
+
+
+def iter_rows(stream, filename: str):
+    """Строки файла как словари {колонка: значение} с номером строки"""
+    if filename.lower().endswith(".xlsx"):
+        wb = load_workbook(stream, read_only=True, data_only=True)
+        rows = wb.active.iter_rows(values_only=True)
+        header = [str(h).strip().lower() if h is not None else "" for h in next(rows, ())]
+        for line, values in enumerate(rows, start=2):
+            if any(v is not None for v in values):
+                yield line, dict(zip(header, values))
+        wb.close()
+    else:
+        text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+        reader = csv.DictReader(text)
+        reader.fieldnames = [f.strip().lower() for f in reader.fieldnames or ()]
+        for line, row in enumerate(reader, start=2):
+            yield line, row
+
+
+def _parse_date(value) -> date:
+    if isinstance(value, date):
+        return value if type(value) is date else value.date()
+    return date.fromisoformat(str(value).strip())
+
+
+def validate_batch(kind: ImportKind, batch, allowed_apartments: set, seen: set):
+    """Проверка формата пачки; возвращает (годные строки, отказы)"""
+    good, rejects = [], []
+    for line, row in batch:
+        try:
+            apartment_id = int(row.get("apartment_id") or 0)
+            utility_type = str(row.get("utility_type") or "").strip()
+            day = _parse_date(row.get(kind.date_column))
+            value = float(str(row.get(kind.value_column)).replace(",", "."))
+        except (TypeError, ValueError):
+            rejects.append((line, "некорректный формат строки"))
+            continue
+        if apartment_id not in allowed_apartments:
+            rejects.append((line, f"нет доступа к квартире {apartment_id}"))
+        elif utility_type not in UTILITIES:
+            rejects.append((line, f"неизвестный ресурс {utility_type}"))
+        elif not math.isfinite(value):
+            rejects.append((line, "некорректное число"))
+        elif value < 0:
+            rejects.append((line, "отрицательное значение"))
+        elif (apartment_id, utility_type, day) in seen:
+            rejects.append((line, "дата повторяется в файле"))
+        else:
+            seen.add((apartment_id, utility_type, day))
+            good.append((line, apartment_id, utility_type, day, value))
+    return good, rejects
+
+
+def _copy_batch(cur, rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows((line, apt, util, day.isoformat(), value) for line, apt, util, day, value in rows)
+    buf.seek(0)
+    cur.copy_expert("COPY import_staging (line, apartment_id, utility_type, day, value) FROM STDIN WITH (FORMAT csv)",
+                    buf)
+
+
+_CREATE_STAGING = """
+    CREATE TEMP TABLE import_staging
+    (
+        line          INTEGER PRIMARY KEY,
+        apartment_id  INTEGER NOT NULL,
+        utility_type  TEXT NOT NULL,
+        day           DATE NOT NULL,
+        value         DOUBLE PRECISION NOT NULL,
+        reject_reason TEXT
+    ) ON COMMIT DROP
+"""
+
+# Показания архивных месяцев не принимаются: по ним уже нельзя пересчитать начисления
+_REJECT_ARCHIVED = """
+    UPDATE import_staging
+    SET reject_reason = 'период закрыт (архив)'
+    WHERE day < (SELECT boundary FROM archive_state)
+"""
+
+# Показание за дату, уже занятую в базе
+_REJECT_TAKEN = """
+    UPDATE import_staging s
+    SET reject_reason = 'показание за эту дату уже есть'
+    FROM meter_reading m
+    WHERE m.apartment_id = s.apartment_id
+      AND m.utility_type = s.utility_type
+      AND m.reading_date = s.day
+      AND s.reject_reason IS NULL
+"""
+
+# Оставшиеся строки с ближайшими показаниями из базы до и после своей даты
+_NEIGHBOURS = """
+    SELECT s.line, s.apartment_id, s.utility_type, s.day, s.value, p.reading AS prev_value, n.reading AS next_value
+    FROM import_staging s
+             LEFT JOIN LATERAL (SELECT reading
+                                FROM meter_reading m
+                                WHERE m.apartment_id = s.apartment_id
+                                  AND m.utility_type = s.utility_type
+                                  AND m.reading_date < s.day
+                                ORDER BY m.reading_date DESC
+                                LIMIT 1) p ON TRUE
+             LEFT JOIN LATERAL (SELECT reading
+                                FROM meter_reading m
+                                WHERE m.apartment_id = s.apartment_id
+                                  AND m.utility_type = s.utility_type
+                                  AND m.reading_date > s.day
+                                ORDER BY m.reading_date
+                                LIMIT 1) n ON TRUE
+    WHERE s.reject_reason IS NULL
+    ORDER BY s.apartment_id, s.utility_type, s.day
+"""
+
+_SET_REJECTS = """
+    UPDATE import_staging s
+    SET reject_reason = v.reason
+    FROM (VALUES %s) AS v(line, reason)
+    WHERE s.line = v.line
+"""
+
+
+def _longest_growth(values) -> set:
+    """Индексы самой длинной неубывающей подпоследовательности; при равной длине — самой ранней"""
+    # Длина лучшей цепочки, начинающейся с каждого элемента (проход справа налево)
+    tails, best = [], [0] * len(values)
+    for i in range(len(values) - 1, -1, -1):
+        pos = bisect_right(tails, -values[i])
+        tails[pos:pos + 1] = [-values[i]]
+        best[i] = pos + 1
+    keep, need, last = set(), len(tails), None
+    for i, value in enumerate(values):
+        if need and best[i] >= need and (last is None or value >= last):
+            keep.add(i)
+            need, last = need - 1, value
+    return keep
+
+
+def monotonic_rejects(rows):
+    """Строки, нарушающие рост счётчика; rows — по парам (квартира, ресурс) в порядке дат.
+
+    Строка должна укладываться между ближайшими показаниями из базы, а среди
+    строк файла принимается самая длинная неубывающая цепочка — одно ошибочное
+    показание отклоняется само, не утягивая за собой верных соседей.
+    Возвращает (строка, причина).
+    """
+    for _, group in groupby(rows, key=lambda r: (r.apartment_id, r.utility_type)):
+        candidates = []
+        for row in group:
+            if row.prev_value is not None and row.value < row.prev_value:
+                yield row.line, "показание меньше предыдущего"
+            elif row.next_value is not None and row.value > row.next_value:
+                yield row.line, "показание больше следующего"
+            else:
+                candidates.append(row)
+        keep = _longest_growth([row.value for row in candidates])
+        last = None
+        for i, row in enumerate(candidates):
+            if i in keep:
+                last = row.value
+            elif last is not None and row.value < last:
+                yield row.line, "показание меньше предыдущего"
+            else:
+                yield row.line, "показание больше следующего"
+
+
+def _reject_readings(conn, cur):
+    with conn.cursor(name="import_neighbours") as neighbours:
+        neighbours.itersize = BATCH_SIZE
+        neighbours.execute(_NEIGHBOURS)
+        rejects = list(monotonic_rejects(StagedReading(**row) for row in neighbours))
+    if rejects:
+        execute_values(cur, _SET_REJECTS, rejects, page_size=BATCH_SIZE)
+
+
+_MERGE = {
+    "readings": """
+        INSERT INTO meter_reading (apartment_id, utility_type, reading_date, reading, submitted_by)
+        SELECT apartment_id, utility_type, day, value, (SELECT id FROM resident WHERE telegram_id = %(telegram_id)s)
+        FROM import_staging
+        WHERE reject_reason IS NULL
+        ON CONFLICT (apartment_id, utility_type, reading_date) DO NOTHING
+    """,
+    "tariffs": """
+        INSERT INTO tariff (apartment_id, utility_type, valid_from, rate)
+        SELECT apartment_id, utility_type, day, value
+        FROM import_staging
+        WHERE reject_reason IS NULL
+        ON CONFLICT (apartment_id, utility_type, valid_from) DO UPDATE SET rate = EXCLUDED.rate
+    """,
+}
+
+
+def import_file(conn, kind_name: str, stream, filename: str, allowed_apartments: set,
+                telegram_id: int) -> ImportReport:
+    """Загружает файл одной транзакцией; отклонённые строки возвращаются в отчёте"""
+    kind = KINDS[kind_name]
+    cur = conn.cursor()
+    cur.execute(_CREATE_STAGING)
+    total = 0
+    rejects = []
+    seen = set()
+    rows = iter_rows(stream, filename)
+    while True:
+        batch = list(islice(rows, BATCH_SIZE))
+        if not batch:
+            break
+        total += len(batch)
+        good, bad = validate_batch(kind, batch, allowed_apartments, seen)
+        rejects.extend(bad)
+        if good:
+            _copy_batch(cur, good)
+
+    cur.execute("ANALYZE import_staging")
+    if kind_name == "readings":
+        cur.execute(_REJECT_ARCHIVED)
+        cur.execute(_REJECT_TAKEN)
+        _reject_readings(conn, cur)
+    cur.execute("SELECT line, reject_reason FROM import_staging WHERE reject_reason IS NOT NULL")
+    rejects.extend((r["line"], r["reject_reason"]) for r in cur.fetchall())
+
+    cur.execute(_MERGE[kind_name], {"telegram_id": telegram_id})
+    loaded = cur.rowcount
+
+    # Начисления пересчитываются с самой ранней загруженной даты по каждой паре
+    cur.execute("""
+                SELECT apartment_id, utility_type, MIN(day) AS since
+                FROM import_staging
+                WHERE reject_reason IS NULL
+                GROUP BY apartment_id, utility_type
+                """)
+    scopes = [(r["apartment_id"], r["utility_type"], r["since"]) for r in cur.fetchall()]
+    recompute_many(conn, scopes)
+    bump_data_version(cur, (apartment_id for apartment_id, _, _ in scopes))
+    conn.commit()
+
+    rejects.sort()
+    return ImportReport(total, loaded, len(rejects), rejects[:MAX_REPORTED_REJECTS])
@@ -0,0 +1,260 @@
+# webapp/ledger.py
+# Материализованный учёт оплат: charge.paid — сумма платежей по начислению,
+# apartment_balance — итоги начислено/оплачено по квартире. Обновляются в той же
+# транзакции, что и платёж/начисление; verify/rebuild сверяют их с payment.
+from collections import namedtuple
+
+import click
+from flask.cli import AppGroup
+
+from .database import get_db
+from .page_cache import bump_all_versions
+
+EPSILON = 0.01
+
+
+PaymentResult = namedtuple("PaymentResult", "status payment_id debt")
+
+# Проверка долга, вставка платежа и обновление charge.paid/баланса/версии данных
+# квартиры (page_cache) — один оператор.
+# FOR UPDATE сериализует платежи по начислению: второй ждёт первого и видит уже
+# уменьшенный долг. Ключ client_key сначала занимается в payment_idempotency
+# (первичный ключ; хранится до архивации месяца платежа) вместе с заранее
+# выданным id платежа; повтор с тем же ключом ключ не займёт и ничего не вставит.
+# Начисление адресуется парой (id, period_end) — читается одна секция charge.
+_PAY_CHARGE = """
+    WITH existing AS (SELECT payment_id AS id FROM payment_idempotency WHERE client_key = %(client_key)s),
+         target AS (SELECT id, period_end, apartment_id, amount - paid AS debt
+                    FROM charge
+                    WHERE id = %(charge_id)s
+                      AND period_end = %(period_end)s
+                      AND apartment_id = %(apartment_id)s
+                      AND NOT EXISTS (SELECT 1 FROM existing)
+                        FOR UPDATE),
+         claim AS (INSERT INTO payment_idempotency (client_key, payment_id, payment_date)
+             SELECT %(client_key)s, nextval('payment_id_seq'), CURRENT_DATE
+             FROM target
+             WHERE %(amount)s <= debt + %(epsilon)s
+             ON CONFLICT DO NOTHING
+             RETURNING payment_id),
+         ins AS (INSERT INTO payment (id, apartment_id, charge_id, charge_period_end, amount, date, confirmed_by,
+                                      receipt_path, client_key)
+             SELECT claim.payment_id, apartment_id, id, period_end, %(amount)s, CURRENT_DATE, %(resident_id)s,
+                    %(receipt_path)s, %(client_key)s
+             FROM target, claim
+             RETURNING id, charge_id, charge_period_end, apartment_id, amount),
+         upd AS (UPDATE charge c
+             SET paid = c.paid + ins.amount
+             FROM ins
+             WHERE c.id = ins.charge_id
+               AND c.period_end = ins.charge_period_end
+             RETURNING c.amount - c.paid AS debt),
+         bal AS (INSERT INTO apartment_balance (apartment_id, charged, paid)
+             SELECT apartment_id, 0, amount FROM ins
+             ON CONFLICT (apartment_id) DO UPDATE SET paid = apartment_balance.paid + EXCLUDED.paid),
+         ver AS (INSERT INTO apartment_version (apartment_id, version, updated_at)
+             SELECT apartment_id, 1, now() FROM ins
+             ON CONFLICT (apartment_id) DO UPDATE SET version    = apartment_version.version + 1,
+                                                      updated_at = now())
+    SELECT (SELECT id FROM ins)        AS payment_id,
+           (SELECT id FROM existing)   AS existing_id,
+           (SELECT debt FROM upd)      AS debt_left,
+           (SELECT debt FROM target)   AS debt
+"""
+
+
+_KEY_PAYMENT = "SELECT payment_id FROM payment_idempotency WHERE client_key = %s"
+
+
+def pay_charge(cur, charge_id: int, period_end, apartment_id: int, amount: float, resident_id: int,
+               client_key: str, receipt_path: str = None) -> PaymentResult:
+    """Записывает платёж по начислению, если он не превышает остаток долга (без коммита).
+
+    status: ok, duplicate (платёж с этим client_key уже есть), overpay, not_found.
+    """
+    cur.execute(_PAY_CHARGE, {"charge_id": charge_id, "period_end": period_end, "apartment_id": apartment_id,
+                              "amount": amount,
+                              "resident_id": resident_id, "receipt_path": receipt_path,
+                              "client_key": client_key, "epsilon": EPSILON})
+    row = cur.fetchone()
+    if row["payment_id"] is not None:
+        return PaymentResult("ok", row["payment_id"], row["debt_left"])
+    if row["existing_id"] is None:
+        # Параллельный повтор с тем же ключом мог закоммититься после снимка оператора
+        cur.execute(_KEY_PAYMENT, (client_key,))
+        duplicate = cur.fetchone()
+        row["existing_id"] = duplicate["payment_id"] if duplicate else None
+    if row["existing_id"] is not None:
+        return PaymentResult("duplicate", row["existing_id"], None)
+    if row["debt"] is None:
+        return PaymentResult("not_found", None, None)
+    return PaymentResult("overpay", None, row["debt"])
+
+
+PeriodPaymentResult = namedtuple("PeriodPaymentResult", "status count total debt")
+
+# «Оплатить всё за период»: каждое неоплаченное начисление месяца гасится целиком.
+# Сумма сверяется с подтверждённой жильцом — если долг успел измениться, ничего не пишем.
+# Условие долга — литерал, чтобы планировщик взял частичный индекс charge_unpaid_keyset_idx.
+_PAY_PERIOD = """
+    WITH target AS (SELECT id, period_end, apartment_id, amount - paid AS debt
+                    FROM charge
+                    WHERE apartment_id = %(apartment_id)s
+                      AND period_end >= %(start)s
+                      AND period_end < %(end)s
+                      AND amount - paid > 0.01
+                    ORDER BY id
+                        FOR UPDATE),
+         total AS (SELECT COALESCE(SUM(debt), 0) AS debt FROM target),
+         claim AS (INSERT INTO payment_idempotency (client_key, payment_id, payment_date)
+             SELECT %(client_key)s || ':' || id, nextval('payment_id_seq'), CURRENT_DATE
+             FROM target
+             WHERE ABS((SELECT debt FROM total) - %(expected)s) <= %(epsilon)s
+             ON CONFLICT DO NOTHING
+             RETURNING client_key, payment_id),
+         ins AS (INSERT INTO payment (id, apartment_id, charge_id, charge_period_end, amount, date, confirmed_by,
+                                      client_key)
+             SELECT claim.payment_id, apartment_id, id, period_end, debt, CURRENT_DATE, %(resident_id)s,
+                    claim.client_key
+             FROM target
+                      JOIN claim ON claim.client_key = %(client_key)s || ':' || target.id
+             RETURNING charge_id, charge_period_end, apartment_id, amount),
+         upd AS (UPDATE charge c
+             SET paid = c.paid + ins.amount
+             FROM ins
+             WHERE c.id = ins.charge_id
+               AND c.period_end = ins.charge_period_end),
+         bal AS (INSERT INTO apartment_balance (apartment_id, charged, paid)
+             SELECT apartment_id, 0, SUM(amount) FROM ins GROUP BY apartment_id
+             ON CONFLICT (apartment_id) DO UPDATE SET paid = apartment_balance.paid + EXCLUDED.paid),
+         ver AS (INSERT INTO apartment_version (apartment_id, version, updated_at)
+             SELECT DISTINCT apartment_id, 1, now() FROM ins
+             ON CONFLICT (apartment_id) DO UPDATE SET version    = apartment_version.version + 1,
+                                                      updated_at = now())
+    SELECT (SELECT COUNT(*) FROM ins)                  AS count,
+           (SELECT COALESCE(SUM(amount), 0) FROM ins)  AS total,
+           (SELECT debt FROM total)                    AS debt
+"""
+
+
+def pay_period(cur, apartment_id: int, start, end, resident_id: int, client_key: str,
+               expected: float) -> PeriodPaymentResult:
+    """Гасит все долги квартиры с period_end в [start, end) (без коммита).
+
+    status: ok, nothing (долгов уже нет), changed (долг не совпал с expected).
+    """
+    cur.execute(_PAY_PERIOD, {"apartment_id": apartment_id, "start": start, "end": end,
+                              "resident_id": resident_id, "client_key": client_key,
+                              "expected": expected, "epsilon": EPSILON})
+    row = cur.fetchone()
+    if row["count"]:
+        return PeriodPaymentResult("ok", row["count"], row["total"], row["debt"])
+    if row["debt"] <= EPSILON:
+        return PeriodPaymentResult("nothing", 0, 0, 0)
+    return PeriodPaymentResult("changed", 0, 0, row["debt"])
+
+
+def refresh_charged(cur, apartment_ids):
+    """Пересчитывает «начислено» для квартир, чьи начисления изменились"""
+    apartment_ids = sorted(set(apartment_ids))
+    if not apartment_ids:
+        return
+    cur.execute("""
+                INSERT INTO apartment_balance (apartment_id, charged, paid)
+                SELECT a.id, COALESCE(SUM(c.amount), 0), 0
+                FROM apartment a
+                         LEFT JOIN charge c ON c.apartment_id = a.id
+                WHERE a.id = ANY (%s)
+                GROUP BY a.id
+                ON CONFLICT (apartment_id) DO UPDATE SET charged = EXCLUDED.charged
+                """, (apartment_ids,))
+
+
+def get_balance(cur, apartment_id: int):
+    cur.execute("SELECT charged, paid, charged - paid AS debt FROM apartment_balance WHERE apartment_id = %s",
+                (apartment_id,))
+    return cur.fetchone()
+
+
+def verify_ledger(conn) -> dict:
+    """Находит расхождения материализованных сумм с таблицей payment"""
+    cur = conn.cursor()
+    cur.execute("""
+                SELECT c.id, c.paid, COALESCE(p.total, 0) AS actual
+                FROM charge c
+                         LEFT JOIN (SELECT charge_id, charge_period_end, SUM(amount) AS total
+                                    FROM payment
+                                    GROUP BY charge_id, charge_period_end) p
+                                   ON p.charge_id = c.id AND p.charge_period_end = c.period_end
+                WHERE ABS(c.paid - COALESCE(p.total, 0)) > %s
+                """, (EPSILON,))
+    charges = cur.fetchall()
+    cur.execute("""
+                SELECT a.id AS apartment_id, b.charged, b.paid, c.total AS actual_charged, p.total AS actual_paid
+                FROM apartment a
+                         LEFT JOIN apartment_balance b ON b.apartment_id = a.id
+                         LEFT JOIN (SELECT apartment_id, SUM(amount) AS total
+                                    FROM charge
+                                    GROUP BY apartment_id) c ON c.apartment_id = a.id
+                         LEFT JOIN (SELECT apartment_id, SUM(amount) AS total
+                                    FROM payment
+                                    GROUP BY apartment_id) p ON p.apartment_id = a.id
+                WHERE ABS(COALESCE(b.charged, 0) - COALESCE(c.total, 0)) > %s
+                   OR ABS(COALESCE(b.paid, 0) - COALESCE(p.total, 0)) > %s
+                """, (EPSILON, EPSILON))
+    apartments = cur.fetchall()
+    conn.rollback()
+    return {"charges": charges, "apartments": apartments}
+
+
+def rebuild_ledger(conn):
+    """Полностью пересчитывает charge.paid и apartment_balance из payment"""
+    cur = conn.cursor()
+    # Блокируем запись платежей на время пересчёта, чтобы не потерять параллельные
+    cur.execute("LOCK TABLE payment IN SHARE MODE")
+    cur.execute("""
+                WITH totals AS (SELECT c.id, c.period_end, COALESCE(SUM(p.amount), 0) AS total
+                                FROM charge c
+                                         LEFT JOIN payment p
+                                                   ON p.charge_id = c.id AND p.charge_period_end = c.period_end
+                                GROUP BY c.id, c.period_end)
+                UPDATE charge c
+                SET paid = t.total
+                FROM totals t
+                WHERE c.id = t.id
+                  AND c.period_end = t.period_end
+                  AND c.paid IS DISTINCT FROM t.total
+                """)
+    cur.execute("""
+                INSERT INTO apartment_balance (apartment_id, charged, paid)
+                SELECT a.id,
+                       COALESCE((SELECT SUM(amount) FROM charge WHERE apartment_id = a.id), 0),
+                       COALESCE((SELECT SUM(amount) FROM payment WHERE apartment_id = a.id), 0)
+                FROM apartment a
+                ON CONFLICT (apartment_id) DO UPDATE SET charged = EXCLUDED.charged,
+                                                         paid    = EXCLUDED.paid
+                """)
+    bump_all_versions(cur)
+    conn.commit()
+
+
+ledger_cli = AppGroup("ledger", help="Сверка оплат и балансов")
+
+
+@ledger_cli.command("verify")
+def verify_command():
+    problems = verify_ledger(get_db())
+    for row in problems["charges"]:
+        click.echo(f"charge {row['id']}: paid={row['paid']} actual={row['actual']}")
+    for row in problems["apartments"]:
+        click.echo(f"apartment {row['apartment_id']}: charged={row['charged']}/{row['actual_charged']} "
+                   f"paid={row['paid']}/{row['actual_paid']}")
+    if problems["charges"] or problems["apartments"]:
+        raise SystemExit(1)
+    click.echo("OK")
+
+
+@ledger_cli.command("rebuild")
+def rebuild_command():
+    rebuild_ledger(get_db())
+    click.echo("Ledger rebuilt")
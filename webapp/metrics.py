@@ -0,0 +1,139 @@
+# webapp/metrics.py
+# Метрики Prometheus, общие для бота и веба: время обработчиков и вьюх, вызовов
+# Bot API, запросы к БД (по имени функции доступа к данным), ожидание пула и Redis.
+# Запросы считает курсор InstrumentedCursor, имя запроса задаёт @timed_query.
+# Под gunicorn с несколькими воркерами задайте PROMETHEUS_MULTIPROC_DIR.
+import logging
+import os
+import time
+from contextvars import ContextVar
+from functools import wraps
+
+import redis
+from decouple import config
+from flask import g, request
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest)
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+
+# Запросы дольше SLOW_QUERY_MS пишутся в лог с текстом SQL; 0 — не писать
+SLOW_QUERY_MS = config("SLOW_QUERY_MS", default=0, cast=float)
+
+logger = logging.getLogger(__name__)
+
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработчика бота", ["handler", "event"],
+                            buckets=_BUCKETS)
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках бота", ["handler"])
+TELEGRAM_SECONDS = Histogram("bot_telegram_api_seconds", "Время вызова Bot API", ["method"], buckets=_BUCKETS)
+FSM_TRANSITIONS = Counter("bot_fsm_transitions_total", "Переходы FSM", ["from_state", "to_state"])
+HTTP_SECONDS = Histogram("web_request_seconds", "Время обработки запроса веб-панели",
+                         ["endpoint", "method", "status"], buckets=_BUCKETS)
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Время SQL-запроса", ["query"], buckets=_BUCKETS)
+DB_QUERY_ROWS = Histogram("db_query_rows", "Строк затронуто/возвращено запросом", ["query"],
+                          buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 100000))
+DB_POOL_WAIT_SECONDS = Histogram("db_pool_wait_seconds", "Ожидание соединения из пула", ["pool"],
+                                 buckets=_BUCKETS)
+DB_POOL_TIMEOUTS = Counter("db_pool_timeouts_total", "Не дождались соединения из пула", ["pool"])
+DB_POOL_IN_USE = Gauge("db_pool_in_use", "Соединений пула занято", ["pool"], multiprocess_mode="livesum")
+REDIS_SECONDS = Histogram("redis_command_seconds", "Время команды Redis", ["command"], buckets=_BUCKETS)
+BOT_THROTTLED = Counter("bot_throttled_total", "Апдейты, отброшенные лимитом частоты", ["scope"])
+BOT_SHED = Counter("bot_shed_total", "Хендлеры, отклонённые при насыщенном пуле БД", ["handler"])
+BOT_COALESCED = Counter("bot_coalesced_total", "Запросы, присоединившиеся к уже идущему", ["query"])
+
+_query_name: ContextVar = ContextVar("query_name", default="other")
+
+
+def timed_query(func):
+    """Помечает запросы внутри функции её именем в метриках db_query_*"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _query_name.set(func.__name__)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _query_name.reset(token)
+
+    return wrapper
+
+
+class _InstrumentedMixin:
+    """Замер каждого execute курсора"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._observe(query, time.perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._observe(query, time.perf_counter() - started)
+
+    def _observe(self, query, elapsed: float):
+        name = _query_name.get()
+        DB_QUERY_SECONDS.labels(name).observe(elapsed)
+        if self.rowcount >= 0:
+            DB_QUERY_ROWS.labels(name).observe(self.rowcount)
+        if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+            text = query.decode() if isinstance(query, bytes) else str(query)
+            logger.warning("Slow query %s: %.1f ms, %s rows: %s", name, elapsed * 1000, self.rowcount,
+                           " ".join(text.split())[:1000])
+
+
+class InstrumentedCursor(_InstrumentedMixin, RealDictCursor):
+    """RealDictCursor с замером запросов"""
+
+
+class InstrumentedTupleCursor(_InstrumentedMixin, extensions.cursor):
+    """Курсор с обычными кортежами строк (слой repository) и замером запросов"""
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        with REDIS_SECONDS.labels("PIPELINE").time():
+            return super().execute(raise_on_error)
+
+
+class InstrumentedRedis(redis.Redis):
+    """Синхронный клиент Redis с замером каждой команды"""
+
+    def execute_command(self, *args, **options):
+        with REDIS_SECONDS.labels(str(args[0]).upper()).time():
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def render_latest():
+    """(тело, content-type) для эндпоинта /metrics"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+
+
+def _after_request(response):
+    started = g.pop("metrics_started", None)
+    if started is not None:
+        HTTP_SECONDS.labels(request.endpoint or "unknown", request.method,
+                            response.status_code).observe(time.perf_counter() - started)
+    return response
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
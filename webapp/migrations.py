@@ -0,0 +1,457 @@
+# webapp/migrations.py
+# Версионированные миграции схемы. Каждый шаг применяется один раз и фиксируется
+# в schema_version; шаги с concurrent=True выполняются вне транзакции
+# (CREATE INDEX CONCURRENTLY не блокирует запись в таблицы). Оператор миграции —
+# строка SQL или функция от курсора.
+import logging
+from collections import namedtuple
+
+import click
+from flask.cli import AppGroup
+
+from .partitions import SCHEMA_LOCK_KEY, ensure_partitions, history_partitions
+
+logger = logging.getLogger(__name__)
+
+Migration = namedtuple("Migration", "version name statements concurrent")
+
+# Бот и веб не должны мигрировать одновременно (ключ общий с созданием секций)
+_LOCK_KEY = SCHEMA_LOCK_KEY
+
+MIGRATIONS = [
+    Migration(1, "baseline schema", [
+        """
+        CREATE TABLE IF NOT EXISTS apartment
+        (
+            id   SERIAL PRIMARY KEY,
+            name TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS resident
+        (
+            id          SERIAL PRIMARY KEY,
+            telegram_id BIGINT UNIQUE NOT NULL,
+            full_name   TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS residency
+        (
+            id           SERIAL PRIMARY KEY,
+            resident_id  INTEGER NOT NULL REFERENCES resident (id),
+            apartment_id INTEGER NOT NULL REFERENCES apartment (id),
+            is_admin     BOOLEAN NOT NULL DEFAULT FALSE,
+            UNIQUE (resident_id, apartment_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tariff
+        (
+            id           SERIAL PRIMARY KEY,
+            apartment_id INTEGER NOT NULL REFERENCES apartment (id),
+            utility_type TEXT NOT NULL,
+            rate         DOUBLE PRECISION NOT NULL,
+            valid_from   DATE NOT NULL,
+            UNIQUE (apartment_id, utility_type, valid_from)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS meter_reading
+        (
+            id           SERIAL PRIMARY KEY,
+            apartment_id INTEGER NOT NULL REFERENCES apartment (id),
+            utility_type TEXT NOT NULL,
+            reading      DOUBLE PRECISION NOT NULL,
+            reading_date DATE NOT NULL,
+            submitted_by INTEGER NOT NULL REFERENCES resident (id),
+            UNIQUE (apartment_id, utility_type, reading_date)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS charge
+        (
+            id           SERIAL PRIMARY KEY,
+            apartment_id INTEGER NOT NULL REFERENCES apartment (id),
+            utility_type TEXT NOT NULL,
+            period_start DATE NOT NULL,
+            period_end   DATE NOT NULL,
+            consumption  DOUBLE PRECISION NOT NULL,
+            tariff_used  DOUBLE PRECISION NOT NULL,
+            amount       DOUBLE PRECISION NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS payment
+        (
+            id           SERIAL PRIMARY KEY,
+            apartment_id INTEGER NOT NULL REFERENCES apartment (id),
+            charge_id    INTEGER REFERENCES charge (id),
+            amount       DOUBLE PRECISION NOT NULL,
+            date         DATE NOT NULL,
+            created_at   TIMESTAMP NOT NULL DEFAULT now(),
+            confirmed_by INTEGER NOT NULL REFERENCES resident (id),
+            receipt_path TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS apartment_region
+        (
+            apartment_id INTEGER PRIMARY KEY REFERENCES apartment (id),
+            region_name  TEXT NOT NULL,
+            housing_type TEXT DEFAULT 'urban',
+            last_updated DATE
+        )
+        """,
+    ], False),
+    Migration(2, "payment ledger", [
+        "ALTER TABLE charge ADD COLUMN IF NOT EXISTS paid DOUBLE PRECISION NOT NULL DEFAULT 0",
+        """
+        CREATE TABLE IF NOT EXISTS apartment_balance
+        (
+            apartment_id INTEGER PRIMARY KEY REFERENCES apartment (id),
+            charged      DOUBLE PRECISION NOT NULL DEFAULT 0,
+            paid         DOUBLE PRECISION NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        UPDATE charge c
+        SET paid = p.total
+        FROM (SELECT charge_id, SUM(amount) AS total FROM payment GROUP BY charge_id) p
+        WHERE p.charge_id = c.id
+        """,
+        """
+        INSERT INTO apartment_balance (apartment_id, charged, paid)
+        SELECT a.id,
+               COALESCE((SELECT SUM(amount) FROM charge WHERE apartment_id = a.id), 0),
+               COALESCE((SELECT SUM(amount) FROM payment WHERE apartment_id = a.id), 0)
+        FROM apartment a
+        ON CONFLICT (apartment_id) DO NOTHING
+        """,
+    ], False),
+    # residency.resident_id, meter_reading(apartment_id, utility_type, reading_date)
+    # и tariff(apartment_id, utility_type, valid_from) уже покрыты UNIQUE-ограничениями
+    Migration(3, "hot path indexes", [
+        """
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS charge_apartment_utility_period_end_key
+            ON charge (apartment_id, utility_type, period_end)
+        """,
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS charge_apartment_period_end_idx ON charge (apartment_id, period_end)",
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS charge_unpaid_idx
+            ON charge (apartment_id, period_end) WHERE amount - paid > 0.01
+        """,
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS payment_charge_id_idx ON payment (charge_id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS payment_apartment_id_idx ON payment (apartment_id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS residency_apartment_id_idx ON residency (apartment_id)",
+    ], True),
+    Migration(4, "consumption rollups", [
+        """
+        CREATE TABLE IF NOT EXISTS consumption_monthly
+        (
+            apartment_id INTEGER NOT NULL REFERENCES apartment (id),
+            utility_type TEXT NOT NULL,
+            month        DATE NOT NULL,
+            consumption  DOUBLE PRECISION NOT NULL,
+            amount       DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (apartment_id, utility_type, month)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS rollup_version
+        (
+            apartment_id INTEGER PRIMARY KEY REFERENCES apartment (id),
+            version      BIGINT NOT NULL DEFAULT 1
+        )
+        """,
+        """
+        INSERT INTO consumption_monthly (apartment_id, utility_type, month, consumption, amount)
+        SELECT apartment_id, utility_type, date_trunc('month', period_end)::date, SUM(consumption), SUM(amount)
+        FROM charge
+        GROUP BY 1, 2, 3
+        ON CONFLICT DO NOTHING
+        """,
+        "INSERT INTO rollup_version (apartment_id) SELECT id FROM apartment ON CONFLICT DO NOTHING",
+    ], False),
+    # Keyset-пагинация API по (apartment_id, дата, id); новые индексы начислений и
+    # платежей заменяют свои префиксы charge_apartment_period_end_idx и payment_apartment_id_idx
+    Migration(5, "api keyset indexes", [
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS charge_apartment_period_end_id_idx
+            ON charge (apartment_id, period_end, id)
+        """,
+        "DROP INDEX CONCURRENTLY IF EXISTS charge_apartment_period_end_idx",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS payment_apartment_date_id_idx ON payment (apartment_id, date, id)",
+        "DROP INDEX CONCURRENTLY IF EXISTS payment_apartment_id_idx",
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS meter_reading_apartment_date_id_idx
+            ON meter_reading (apartment_id, reading_date, id)
+        """,
+    ], True),
+    # Ключ идемпотентности платежа из бота; у старых платежей NULL (уникальность не нарушает)
+    Migration(6, "payment client key", [
+        "ALTER TABLE payment ADD COLUMN IF NOT EXISTS client_key TEXT",
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS payment_client_key_key ON payment (client_key)",
+    ], True),
+    # Постраничный выбор долга в /pay идёт по keyset (period_end, id) внутри частичного индекса
+    Migration(7, "unpaid keyset index", [
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS charge_unpaid_keyset_idx
+            ON charge (apartment_id, period_end, id) WHERE amount - paid > 0.01
+        """,
+        "DROP INDEX CONCURRENTLY IF EXISTS charge_unpaid_idx",
+    ], True),
+    # Версия данных квартиры для ETag и кэша фрагментов веб-панели (см. page_cache)
+    Migration(8, "apartment data version", [
+        """
+        CREATE TABLE IF NOT EXISTS apartment_version
+        (
+            apartment_id INTEGER PRIMARY KEY REFERENCES apartment (id),
+            version      BIGINT NOT NULL DEFAULT 1,
+            updated_at   TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        """,
+        "INSERT INTO apartment_version (apartment_id) SELECT id FROM apartment ON CONFLICT DO NOTHING",
+    ], False),
+    # История секционируется помесячно (см. partitions). Ключ секционирования входит в
+    # первичный ключ и в уникальные индексы, поэтому payment ссылается на начисление
+    # парой (charge_id, charge_period_end), а client_key уникален вместе с датой платежа.
+    # Таблицы пересобираются в одной транзакции: на время миграции запись в них стоит.
+    Migration(9, "monthly partitions", [
+        "ALTER TABLE payment RENAME TO payment_unpartitioned",
+        "ALTER TABLE charge RENAME TO charge_unpartitioned",
+        "ALTER TABLE meter_reading RENAME TO meter_reading_unpartitioned",
+        """
+        CREATE TABLE charge
+        (
+            id           INTEGER NOT NULL DEFAULT nextval('charge_id_seq'),
+            apartment_id INTEGER NOT NULL REFERENCES apartment (id),
+            utility_type TEXT NOT NULL,
+            period_start DATE NOT NULL,
+            period_end   DATE NOT NULL,
+            consumption  DOUBLE PRECISION NOT NULL,
+            tariff_used  DOUBLE PRECISION NOT NULL,
+            amount       DOUBLE PRECISION NOT NULL,
+            paid         DOUBLE PRECISION NOT NULL DEFAULT 0
+        ) PARTITION BY RANGE (period_end)
+        """,
+        """
+        CREATE TABLE payment
+        (
+            id                INTEGER NOT NULL DEFAULT nextval('payment_id_seq'),
+            apartment_id      INTEGER NOT NULL REFERENCES apartment (id),
+            charge_id         INTEGER,
+            charge_period_end DATE,
+            amount            DOUBLE PRECISION NOT NULL,
+            date              DATE NOT NULL,
+            created_at        TIMESTAMP NOT NULL DEFAULT now(),
+            confirmed_by      INTEGER NOT NULL REFERENCES resident (id),
+            receipt_path      TEXT,
+            client_key        TEXT
+        ) PARTITION BY RANGE (date)
+        """,
+        """
+        CREATE TABLE meter_reading
+        (
+            id           INTEGER NOT NULL DEFAULT nextval('meter_reading_id_seq'),
+            apartment_id INTEGER NOT NULL REFERENCES apartment (id),
+            utility_type TEXT NOT NULL,
+            reading      DOUBLE PRECISION NOT NULL,
+            reading_date DATE NOT NULL,
+            submitted_by INTEGER NOT NULL REFERENCES resident (id)
+        ) PARTITION BY RANGE (reading_date)
+        """,
+        "CREATE TABLE charge_default PARTITION OF charge DEFAULT",
+        "CREATE TABLE payment_default PARTITION OF payment DEFAULT",
+        "CREATE TABLE meter_reading_default PARTITION OF meter_reading DEFAULT",
+        history_partitions,
+        """
+        INSERT INTO charge (id, apartment_id, utility_type, period_start, period_end, consumption, tariff_used,
+                            amount, paid)
+        SELECT id, apartment_id, utility_type, period_start, period_end, consumption, tariff_used, amount, paid
+        FROM charge_unpartitioned
+        """,
+        """
+        INSERT INTO payment (id, apartment_id, charge_id, charge_period_end, amount, date, created_at, confirmed_by,
+                             receipt_path, client_key)
+        SELECT p.id, p.apartment_id, p.charge_id, c.period_end, p.amount, p.date, p.created_at, p.confirmed_by,
+               p.receipt_path, p.client_key
+        FROM payment_unpartitioned p
+                 LEFT JOIN charge_unpartitioned c ON c.id = p.charge_id
+        """,
+        """
+        INSERT INTO meter_reading (id, apartment_id, utility_type, reading, reading_date, submitted_by)
+        SELECT id, apartment_id, utility_type, reading, reading_date, submitted_by
+        FROM meter_reading_unpartitioned
+        """,
+        # Последовательности id переживают удаление старых таблиц
+        "ALTER SEQUENCE charge_id_seq OWNED BY NONE",
+        "ALTER SEQUENCE payment_id_seq OWNED BY NONE",
+        "ALTER SEQUENCE meter_reading_id_seq OWNED BY NONE",
+        "DROP TABLE payment_unpartitioned",
+        "DROP TABLE charge_unpartitioned",
+        "DROP TABLE meter_reading_unpartitioned",
+        "ALTER SEQUENCE charge_id_seq OWNED BY charge.id",
+        "ALTER SEQUENCE payment_id_seq OWNED BY payment.id",
+        "ALTER SEQUENCE meter_reading_id_seq OWNED BY meter_reading.id",
+        "ALTER TABLE charge ADD PRIMARY KEY (id, period_end)",
+        """
+        CREATE UNIQUE INDEX charge_apartment_utility_period_end_key
+            ON charge (apartment_id, utility_type, period_end)
+        """,
+        "CREATE INDEX charge_apartment_period_end_id_idx ON charge (apartment_id, period_end, id)",
+        """
+        CREATE INDEX charge_unpaid_keyset_idx
+            ON charge (apartment_id, period_end, id) WHERE amount - paid > 0.01
+        """,
+        "ALTER TABLE payment ADD PRIMARY KEY (id, date)",
+        "ALTER TABLE payment ADD FOREIGN KEY (charge_id, charge_period_end) REFERENCES charge (id, period_end)",
+        "CREATE INDEX payment_charge_id_idx ON payment (charge_id, charge_period_end)",
+        "CREATE INDEX payment_apartment_date_id_idx ON payment (apartment_id, date, id)",
+        "CREATE UNIQUE INDEX payment_client_key_key ON payment (client_key, date)",
+        "ALTER TABLE meter_reading ADD PRIMARY KEY (id, reading_date)",
+        "ALTER TABLE meter_reading ADD UNIQUE (apartment_id, utility_type, reading_date)",
+        "CREATE INDEX meter_reading_apartment_date_id_idx ON meter_reading (apartment_id, reading_date, id)",
+        # Начисления с period_end раньше границы закрыты и архивированы
+        """
+        CREATE TABLE IF NOT EXISTS archive_state
+        (
+            id       BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            boundary DATE NOT NULL DEFAULT '0001-01-01'
+        )
+        """,
+        "INSERT INTO archive_state DEFAULT VALUES ON CONFLICT DO NOTHING",
+    ], False),
+    # Ключи идемпотентности платежей — в обычной таблице: уникальность в payment
+    # действует только вместе с датой, а этот ключ уникален за всю историю
+    Migration(10, "payment idempotency keys", [
+        """
+        CREATE TABLE IF NOT EXISTS payment_idempotency
+        (
+            client_key   TEXT PRIMARY KEY,
+            payment_id   INTEGER NOT NULL,
+            payment_date DATE NOT NULL
+        )
+        """,
+        """
+        INSERT INTO payment_idempotency (client_key, payment_id, payment_date)
+        SELECT client_key, id, date
+        FROM payment
+        WHERE client_key IS NOT NULL
+        ON CONFLICT DO NOTHING
+        """,
+    ], False),
+    # Ключ ссылается на свой платёж: удаление платежа удаляет и ключ. Проверка отложена
+    # до коммита — ключ занимается раньше, чем вставляется платёж (см. ledger)
+    Migration(11, "payment idempotency foreign key", [
+        """
+        DELETE FROM payment_idempotency k
+        WHERE NOT EXISTS (SELECT 1 FROM payment p WHERE p.id = k.payment_id AND p.date = k.payment_date)
+        """,
+        """
+        ALTER TABLE payment_idempotency
+            ADD FOREIGN KEY (payment_id, payment_date) REFERENCES payment (id, date)
+                ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED
+        """,
+    ], False),
+]
+
+
+def _drop_invalid_indexes(cur):
+    # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс, и IF NOT EXISTS его пропустит
+    cur.execute("""
+                SELECT c.relname
+                FROM pg_index i
+                         JOIN pg_class c ON c.oid = i.indexrelid
+                         JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE NOT i.indisvalid
+                  AND n.nspname = current_schema()
+                """)
+    for row in cur.fetchall():
+        logger.warning("Dropping invalid index %s", row["relname"])
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{row["relname"]}"')
+
+
+def _apply(cur, statement):
+    if callable(statement):
+        statement(cur)
+    else:
+        cur.execute(statement)
+
+
+def current_version(cur) -> int:
+    cur.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_version")
+    return cur.fetchone()["version"]
+
+
+def migrate(conn) -> list:
+    """Применяет недостающие миграции; возвращает номера применённых"""
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version
+                (
+                    version    INTEGER PRIMARY KEY,
+                    name       TEXT NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT now()
+                )
+                """)
+    cur.execute("SELECT pg_advisory_lock(%s)", (_LOCK_KEY,))
+    applied = []
+    try:
+        version = current_version(cur)
+        for migration in MIGRATIONS:
+            if migration.version <= version:
+                continue
+            logger.info("Applying migration %s: %s", migration.version, migration.name)
+            if migration.concurrent:
+                _drop_invalid_indexes(cur)
+                for statement in migration.statements:
+                    _apply(cur, statement)
+                cur.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                            (migration.version, migration.name))
+            else:
+                conn.autocommit = False
+                try:
+                    for statement in migration.statements:
+                        _apply(cur, statement)
+                    cur.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                                (migration.version, migration.name))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.autocommit = True
+            applied.append(migration.version)
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (_LOCK_KEY,))
+        conn.autocommit = False
+    return applied
+
+
+db_cli = AppGroup("db", help="Схема базы данных")
+
+
+@db_cli.command("upgrade")
+def upgrade_command():
+    from .database import acquire_connection, release_connection
+    conn = acquire_connection()
+    try:
+        applied = migrate(conn)
+        ensure_partitions(conn)
+    finally:
+        release_connection(conn)
+    click.echo(f"Применены миграции: {applied}" if applied else "Схема актуальна")
+
+
+@db_cli.command("check-indexes")
+def check_indexes_command():
+    from .database import get_db
+    from .query_check import check_hot_queries
+    problems = check_hot_queries(get_db())
+    for name, relations in problems.items():
+        click.echo(f"{name}: seq scan on {', '.join(relations)}")
+    if problems:
+        raise SystemExit(1)
+    click.echo("Все горячие запросы используют индексы")
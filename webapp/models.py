@@ -1,4 +1,8 @@
+from .billing import recompute_charges
 from .database import get_db
+from .events import publish_identity_change
+from .page_cache import bump_data_version
+from . import repository
 
 
 #
@@ -13,61 +17,41 @@ from .database import get_db
 #     return conn
 
 def get_apartment(apartment_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM apartment WHERE id = ?", (apartment_id,))
-    return cur.fetchone()
+    return repository.get_apartment(get_db(), apartment_id)
 
 
 def get_tariffs(apartment_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM tariff WHERE apartment_id = ? ORDER BY utility_type, valid_from DESC", (apartment_id,))
-    return cur.fetchall()
+    return repository.get_tariffs(get_db(), apartment_id)
 
 
 def upsert_tariff(apartment_id, utility_type, rate, valid_from):
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""
-                INSERT INTO tariff (apartment_id, utility_type, rate, valid_from)
-                VALUES (?, ?, ?, ?) ON CONFLICT(apartment_id, utility_type, valid_from) 
-        DO
-                UPDATE SET rate=excluded.rate
-                """, (apartment_id, utility_type, rate, valid_from))
+    repository.upsert_tariff(conn, apartment_id, utility_type, rate, valid_from)
+    recompute_charges(conn, apartment_id, utility_type, valid_from)
+    bump_data_version(conn.cursor(), [apartment_id])
     conn.commit()
 
 
 def get_residents(apartment_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""
-                SELECT r.id, r.telegram_id, r.full_name, res.is_admin
-                FROM resident r
-                         JOIN residency res ON r.id = res.resident_id
-                WHERE res.apartment_id = ?
-                """, (apartment_id,))
-    return cur.fetchall()
+    return repository.get_residents(get_db(), apartment_id)
 
 
 def add_resident(apartment_id, telegram_id, full_name, is_admin):
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO resident (telegram_id, full_name) VALUES (?, ?)", (telegram_id, full_name))
-    resident_id = cur.lastrowid
-    cur.execute("INSERT INTO residency (resident_id, apartment_id, is_admin) VALUES (?, ?, ?)",
-                (resident_id, apartment_id, is_admin))
+    repository.add_residents(conn, apartment_id, [repository.NewResident(telegram_id, full_name, is_admin)])
+    bump_data_version(conn.cursor(), [apartment_id])
     conn.commit()
+    publish_identity_change(telegram_id)
+
+
+def get_summary(apartment_id):
+    return repository.get_summary(get_db(), apartment_id)
 
 
 def is_admin_db(telegram_id, apartment_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute("""
-                SELECT 1
-                FROM residency
-                WHERE resident_id = (SELECT id FROM resident WHERE telegram_id = ?)
-                  AND apartment_id = ?
-                  AND is_admin = 1
-                """, (telegram_id, apartment_id))
-    return cur.fetchone() is not None
+    return repository.is_admin(get_db(), telegram_id, apartment_id)
+
+
+def get_admin_apartments(telegram_id):
+    """Квартиры, в которых жилец — админ (выгрузка для управляющей компании)"""
+    return repository.get_admin_apartments(get_db(), telegram_id)
@@ -0,0 +1,76 @@
+# webapp/page_cache.py
+# Версия данных квартиры для страниц веб-панели. apartment_version растёт в той же
+# транзакции, что и запись тарифов, жильцов, показаний, начислений и платежей.
+# От версии зависят ETag/Last-Modified страниц (повторный просмотр — 304 без
+# запросов к данным) и ключи отрендеренных фрагментов в Redis.
+import logging
+
+import redis
+from decouple import config
+from flask import Response, make_response, request, session
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
+
+from .auth import redis_client
+from .repository import DataVersion
+
+FRAGMENT_CACHE_TTL = config("FRAGMENT_CACHE_TTL", default=24 * 3600, cast=int)
+# Новый деплой может менять шаблоны — старые фрагменты и ETag не должны подходить
+CACHE_RELEASE = config("RAILWAY_DEPLOYMENT_ID", default="dev")
+
+logger = logging.getLogger(__name__)
+
+_BUMP = """
+    INSERT INTO apartment_version (apartment_id, version, updated_at)
+    SELECT DISTINCT unnest(%s::int[]), 1, now()
+    ON CONFLICT (apartment_id) DO UPDATE SET version    = apartment_version.version + 1,
+                                             updated_at = now()
+"""
+
+
+def bump_data_version(cur, apartment_ids):
+    """Помечает данные квартир изменёнными. Коммит — на вызывающем"""
+    apartment_ids = sorted(set(apartment_ids))
+    if apartment_ids:
+        cur.execute(_BUMP, (apartment_ids,))
+
+
+def bump_all_versions(cur):
+    cur.execute("UPDATE apartment_version SET version = version + 1, updated_at = now()")
+
+
+def versioned_page(version: DataVersion, render, *parts):
+    """Ответ страницы с ETag/Last-Modified от версии; render вызывается только если у браузера копия устарела"""
+    if "_flashes" in session:
+        # Страница с одноразовым сообщением не должна попасть в кэш браузера
+        response = make_response(render())
+        response.cache_control.no_store = True
+        return response
+    etag = "-".join(str(p) for p in (CACHE_RELEASE, session["apartment_id"], version.version, *parts))
+    if not is_resource_modified(request.environ, etag=etag, last_modified=version.updated_at):
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.last_modified = version.updated_at
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def cached_fragment(name: str, apartment_id: int, version: DataVersion, render) -> Markup:
+    """HTML-фрагмент из Redis для данной версии; при промахе — render() и запись"""
+    key = f"fragment:{name}:{apartment_id}:{CACHE_RELEASE}:v{version.version}"
+    try:
+        cached = redis_client.get(key)
+    except redis.RedisError:
+        logger.warning("Fragment cache unavailable", exc_info=True)
+        cached = None
+    if cached is not None:
+        return Markup(cached.decode())
+    html = render()
+    try:
+        redis_client.setex(key, FRAGMENT_CACHE_TTL, html.encode())
+    except redis.RedisError:
+        logger.warning("Fragment cache unavailable", exc_info=True)
+    return Markup(html)
@@ -0,0 +1,216 @@
+# webapp/partitions.py
+# Помесячное секционирование истории: charge по period_end, payment по date,
+# meter_reading по reading_date. Секции <таблица>_pYYYYMM создаются заранее на
+# PARTITION_MONTHS_AHEAD месяцев; строка вне созданных секций попадает в
+# <таблица>_default и переезжает в свою секцию, когда та появится.
+# Архивация сдвигает archive_state.boundary за закрытые, полностью оплаченные
+# месяцы: горячие запросы долгов фильтруют period_end >= boundary и архивных
+# секций не открывают. Архивные секции остаются присоединёнными (выгрузки и API
+# их читают), но переносятся в ARCHIVE_TABLESPACE и замораживаются.
+# Вместе с архивацией удаляются ключи идемпотентности платежей раньше границы:
+# начисления архивных месяцев оплачены полностью, повтор такого платежа всё равно
+# будет отклонён как переплата.
+import logging
+from collections import namedtuple
+from datetime import date
+
+import click
+from decouple import config
+from flask.cli import AppGroup
+
+logger = logging.getLogger(__name__)
+
+PARTITIONED = {"charge": "period_end", "payment": "date", "meter_reading": "reading_date"}
+
+# Общий с миграциями ключ advisory-lock: реплики, стартующие одновременно, создают
+# секции по очереди, и вторая видит секции первой
+SCHEMA_LOCK_KEY = 720_451_001
+
+PARTITION_MONTHS_AHEAD = config("PARTITION_MONTHS_AHEAD", default=3, cast=int)
+ARCHIVE_AFTER_MONTHS = config("ARCHIVE_AFTER_MONTHS", default=24, cast=int)
+# Пусто — секции остаются в основном табличном пространстве, только замораживаются
+ARCHIVE_TABLESPACE = config("ARCHIVE_TABLESPACE", default="")
+
+ArchiveReport = namedtuple("ArchiveReport", "boundary partitions expired_keys")
+
+_BOUNDARY = "SELECT boundary FROM archive_state"
+
+_PARTITIONS = """
+    SELECT c.relname, COALESCE(t.spcname, '') AS tablespace
+    FROM pg_inherits i
+             JOIN pg_class c ON c.oid = i.inhrelid
+             LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace
+    WHERE i.inhparent = %s::regclass
+"""
+
+
+def add_months(month: date, n: int) -> date:
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month:%Y%m}"
+
+
+def get_archive_boundary(cur) -> date:
+    """Начисления с period_end раньше границы закрыты и лежат в архиве"""
+    cur.execute(_BOUNDARY)
+    row = cur.fetchone()
+    return row["boundary"] if row else date.min
+
+
+def list_partitions(cur, table: str) -> dict:
+    """{месяц: (имя секции, табличное пространство)} без секции по умолчанию"""
+    cur.execute(_PARTITIONS, (table,))
+    prefix = f"{table}_p"
+    partitions = {}
+    for row in cur.fetchall():
+        suffix = row["relname"][len(prefix):]
+        if row["relname"].startswith(prefix) and len(suffix) == 6 and suffix.isdigit():
+            month = date(int(suffix[:4]), int(suffix[4:]), 1)
+            partitions[month] = (row["relname"], row["tablespace"])
+    return partitions
+
+
+def create_partition(cur, table: str, month: date):
+    """Создаёт и присоединяет секцию месяца (без коммита).
+
+    Строки месяца, уже попавшие в секцию по умолчанию, переносятся в новую —
+    иначе ATTACH PARTITION откажет.
+    """
+    name, key, end = partition_name(table, month), PARTITIONED[table], add_months(month, 1)
+    cur.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    cur.execute(f"""
+                WITH moved AS (DELETE FROM {table}_default WHERE {key} >= %s AND {key} < %s RETURNING *)
+                INSERT INTO {name} SELECT * FROM moved
+                """, (month, end))
+    cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (month, end))
+    logger.info("Created partition %s", name)
+    return name
+
+
+def create_partitions(cur, first: date, last: date) -> list:
+    """Секции всех трёх таблиц за месяцы [first, last], которых ещё нет (без коммита)"""
+    created = []
+    for table in PARTITIONED:
+        existing = list_partitions(cur, table)
+        month = first.replace(day=1)
+        while month <= last:
+            if month not in existing:
+                created.append(create_partition(cur, table, month))
+            month = add_months(month, 1)
+    return created
+
+
+def history_partitions(cur):
+    """Шаг миграции: секции от первого месяца старых данных до месяцев впереди"""
+    this_month = date.today().replace(day=1)
+    first = this_month
+    for table, key in PARTITIONED.items():
+        cur.execute(f"SELECT MIN({key}) AS first FROM {table}_unpartitioned")
+        oldest = cur.fetchone()["first"]
+        if oldest and oldest < first:
+            first = oldest.replace(day=1)
+    create_partitions(cur, first, add_months(this_month, PARTITION_MONTHS_AHEAD))
+
+
+def ensure_partitions(conn, months_ahead: int = None) -> list:
+    """Заранее создаёт секции текущего и следующих месяцев; возвращает имена новых"""
+    this_month = date.today().replace(day=1)
+    ahead = PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_KEY,))
+        created = create_partitions(cur, this_month, add_months(this_month, ahead))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return created
+
+
+def _move_to_tablespace(cur, name: str, tablespace: str):
+    cur.execute(f'ALTER TABLE {name} SET TABLESPACE "{tablespace}"')
+    cur.execute("SELECT indexrelid::regclass::text AS name FROM pg_index WHERE indrelid = %s::regclass", (name,))
+    for index in cur.fetchall():
+        cur.execute(f'ALTER INDEX {index["name"]} SET TABLESPACE "{tablespace}"')
+
+
+def archive_partitions(conn, before: date, tablespace: str = ARCHIVE_TABLESPACE) -> ArchiveReport:
+    """Архивирует месяцы раньше before, но не дальше первого месяца с неоплаченным долгом.
+
+    Граница в archive_state только растёт; секции закрытых месяцев переносятся в
+    tablespace (если задан) и замораживаются VACUUM FREEZE, ключи идемпотентности
+    платежей раньше границы удаляются.
+    """
+    cur = conn.cursor()
+    before = before.replace(day=1)
+    cur.execute("SELECT MIN(period_end) AS oldest FROM charge WHERE amount - paid > 0.01 AND period_end < %s",
+                (before,))
+    oldest_debt = cur.fetchone()["oldest"]
+    if oldest_debt:
+        before = oldest_debt.replace(day=1)
+    cur.execute(f"{_BOUNDARY} FOR UPDATE")
+    boundary = cur.fetchone()["boundary"]
+    if before <= boundary:
+        conn.rollback()
+        return ArchiveReport(boundary, [], 0)
+    archived = []
+    for table in PARTITIONED:
+        for month, (name, current) in sorted(list_partitions(cur, table).items()):
+            if month >= before:
+                break
+            moved = bool(tablespace) and current != tablespace
+            if moved:
+                _move_to_tablespace(cur, name, tablespace)
+            if moved or month >= boundary:
+                archived.append(name)
+    cur.execute("UPDATE archive_state SET boundary = %s", (before,))
+    cur.execute("DELETE FROM payment_idempotency WHERE payment_date < %s", (before,))
+    expired_keys = cur.rowcount
+    conn.commit()
+    # VACUUM не выполняется в транзакции
+    conn.autocommit = True
+    try:
+        for name in archived:
+            cur.execute(f"VACUUM (FREEZE, ANALYZE) {name}")
+    finally:
+        conn.autocommit = False
+    return ArchiveReport(before, archived, expired_keys)
+
+
+partitions_cli = AppGroup("partitions", help="Секции и архив истории начислений, платежей и показаний")
+
+
+@partitions_cli.command("ensure")
+@click.option("--ahead", type=int, help="На сколько месяцев вперёд (по умолчанию PARTITION_MONTHS_AHEAD)")
+def ensure_command(ahead):
+    from .database import get_db
+    created = ensure_partitions(get_db(), ahead)
+    click.echo(f"Созданы секции: {', '.join(created)}" if created else "Все секции на месте")
+
+
+@partitions_cli.command("archive")
+@click.option("--before", type=click.DateTime(["%Y-%m-%d"]),
+              help="Архивировать месяцы раньше даты (по умолчанию ARCHIVE_AFTER_MONTHS назад)")
+@click.option("--tablespace", default=ARCHIVE_TABLESPACE, help="Холодное табличное пространство")
+def archive_command(before, tablespace):
+    from .database import get_db
+    before = before.date() if before else add_months(date.today().replace(day=1), -ARCHIVE_AFTER_MONTHS)
+    report = archive_partitions(get_db(), before, tablespace)
+    for name in report.partitions:
+        click.echo(f"{name}: в архиве")
+    click.echo(f"Граница архива: {report.boundary}, удалено ключей идемпотентности: {report.expired_keys}")
+
+
+@partitions_cli.command("list")
+def list_command():
+    from .database import get_db
+    cur = get_db().cursor()
+    boundary = get_archive_boundary(cur)
+    for table in PARTITIONED:
+        for month, (name, tablespace) in sorted(list_partitions(cur, table).items()):
+            state = "архив" if month < boundary else "горячая"
+            click.echo(f"{name}\t{state}\t{tablespace or '-'}")
+    get_db().rollback()
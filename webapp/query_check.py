@@ -0,0 +1,117 @@
+# webapp/query_check.py
+# EXPLAIN-проверка: горячие запросы бота и веб-панели должны уметь работать по индексам.
+# Планировщик на маленьких таблицах всё равно выберет Seq Scan, поэтому проверка идёт
+# с enable_seqscan = off: если Seq Scan остался — подходящего индекса нет.
+# Список собирается из тех же констант SQL, что выполняет код, поэтому не расходится с ним.
+import json
+
+from . import billing, export_jobs, importer, ledger, repository, rollups
+from .utils import excel_export
+from .views import api
+
+# Однострочные служебные таблицы и staging загрузки читаются целиком, индекс им не нужен
+_FULL_SCAN = {"archive_state", "import_staging"}
+
+_REPOSITORY_MODULES = (repository.apartments, repository.charges, repository.residents, repository.tariffs)
+
+# Пример параметров для каждого запроса repository; запрос без примера — ошибка проверки,
+# так что новый запрос не выпадет из неё незаметно
+_REPOSITORY_PARAMS = {
+    "apartment_by_id": (1,),
+    "apartment_data_version": (1,),
+    "apartment_debt": (1,),
+    "last_readings": (1,),
+    "last_payment": (1,),
+    "unpaid_charges": (1,),
+    "unpaid_page_after": (1, "2024-01-01", 1, 9),
+    "unpaid_page_before": (1, "2024-01-01", 1, 9),
+    "period_debt": (1, "2024-01-01", "2024-02-01"),
+    "charge_by_id": (1, "2024-01-01"),
+    "identity_by_telegram_id": (1,),
+    "get_or_create_resident": (1, "name", 1),
+    "residents_by_apartment": (1,),
+    "is_admin": (1, 1),
+    "admin_apartments": (1,),
+    "tariffs_by_apartment": (1,),
+    "upsert_tariff": (1, "electricity", 1.0, "2024-01-01"),
+}
+
+_SCOPE_PARAMS = {"apartment_id": 1, "utility_type": "electricity", "apartment_ids": [1],
+                 "utility_types": ["electricity"], "sinces": ["2024-01-01"],
+                 "start": "2024-01-01", "end": "2024-02-01"}
+
+
+def repository_queries():
+    for module in _REPOSITORY_MODULES:
+        for value in vars(module).values():
+            if isinstance(value, repository.Query):
+                yield value
+
+
+def hot_queries() -> dict:
+    """{имя: (sql, параметры)} горячих запросов бота и веб-панели"""
+    queries = {}
+    for query in repository_queries():
+        if query.name not in _REPOSITORY_PARAMS:
+            raise KeyError(f"query_check: нет примера параметров для запроса {query.name}")
+        queries[query.name] = (query.sql, _REPOSITORY_PARAMS[query.name])
+    queries.update({
+        "pay_charge": (ledger._PAY_CHARGE, {
+            "charge_id": 1, "period_end": "2024-01-01", "apartment_id": 1, "amount": 1.0, "resident_id": 1,
+            "receipt_path": None, "client_key": "key", "epsilon": ledger.EPSILON}),
+        "pay_period": (ledger._PAY_PERIOD, {
+            "apartment_id": 1, "start": "2024-01-01", "end": "2024-02-01", "resident_id": 1,
+            "client_key": "key", "expected": 1.0, "epsilon": ledger.EPSILON}),
+        "payment_by_client_key": (ledger._KEY_PAYMENT, ("key",)),
+        "reading_pairs": (billing._READING_PAIRS.format(scope=billing._SCOPE), _SCOPE_PARAMS),
+        "reading_pairs_many": (billing._READING_PAIRS.format(scope=billing._SCOPE_MANY), _SCOPE_PARAMS),
+        "delete_stale_charges": (billing._DELETE_STALE, _SCOPE_PARAMS),
+        "rollup_refresh": (rollups._REFRESH, ([1], ["electricity"], ["2024-01-01"])),
+        "rollup_version": (rollups._ROLLUP_VERSION, (1,)),
+        "rollup_series": (rollups._SERIES, (1, "2024-01-01", "electricity", "electricity")),
+        "rollup_utilities": (rollups._UTILITIES, (1,)),
+        "export_data_version": (export_jobs._DATA_VERSION, {"ids": [1]}),
+        "export_charges": (excel_export._CHARGES_SQL, ([1],)),
+        "import_taken": (importer._REJECT_TAKEN, ()),
+        "import_neighbours": (importer._NEIGHBOURS, ()),
+    })
+    for resource in (api.CHARGES, api.PAYMENTS, api.READINGS):
+        where = ["apartment_id = %s", f"({resource.key}, id) < (%s, %s)"]
+        queries[f"api_{resource.table}_page"] = (api.page_sql(resource, list(resource.fields), where),
+                                                 (1, "2024-01-01", 1, api.DEFAULT_LIMIT + 1))
+    return queries
+
+
+def _seq_scans(plan, found):
+    if plan.get("Node Type") == "Seq Scan" and plan["Relation Name"] not in _FULL_SCAN:
+        found.add(plan["Relation Name"])
+    for child in plan.get("Plans", ()):
+        _seq_scans(child, found)
+    return found
+
+
+def explain(cur, sql, params) -> dict:
+    cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    row = cur.fetchone()
+    plan = row["QUERY PLAN"] if isinstance(row, dict) else row[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+
+def check_hot_queries(conn, queries=None) -> dict:
+    """Возвращает {имя запроса: [таблицы с Seq Scan]} для запросов без индекса"""
+    queries = queries or hot_queries()
+    cur = conn.cursor()
+    problems = {}
+    try:
+        # Запросы загрузки читают временную таблицу — она исчезнет при откате
+        cur.execute(importer._CREATE_STAGING)
+        cur.execute("SET LOCAL enable_seqscan = off")
+        for name, (sql, params) in queries.items():
+            relations = _seq_scans(explain(cur, sql, params), set())
+            if relations:
+                problems[name] = sorted(relations)
+    finally:
+        conn.rollback()
+    return problems
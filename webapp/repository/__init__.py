@@ -0,0 +1,10 @@
+# webapp/repository/__init__.py
+# Общий для бота и веб-панели слой доступа к данным. Функции принимают соединение
+# первым аргументом (бот — из своего пула, веб — get_db()), параметры — %s,
+# горячие запросы готовятся на сервере один раз на соединение, строки — namedtuple.
+from .apartments import DataVersion, Summary, get_apartment, get_data_version, get_summary
+from .base import DB_PREPARE, Query, RepositoryConnection, execute
+from .charges import Charge, Debt, PeriodDebt, get_charge, get_period_debt, get_unpaid_charges, get_unpaid_page
+from .residents import (Apartment, Identity, NewResident, Resident, add_residents, get_admin_apartments,
+                        get_or_create_resident, get_residents, is_admin, load_identity)
+from .tariffs import Tariff, get_tariffs, upsert_tariff
@@ -0,0 +1,52 @@
+# webapp/repository/apartments.py
+# Квартира, сводка для главной и версия данных для кэша страниц (webapp.page_cache).
+from collections import namedtuple
+
+from ..metrics import timed_query
+from .base import Query, fetch_all, fetch_one, fetch_value
+from .residents import Apartment
+
+DataVersion = namedtuple("DataVersion", "version updated_at")
+Reading = namedtuple("Reading", "utility_type reading reading_date")
+Payment = namedtuple("Payment", "amount date")
+Summary = namedtuple("Summary", "debt readings last_payment")
+
+APARTMENT = Query("apartment_by_id", "SELECT id, name FROM apartment WHERE id = %s")
+
+DATA_VERSION = Query("apartment_data_version",
+                     "SELECT version, updated_at FROM apartment_version WHERE apartment_id = %s")
+
+DEBT = Query("apartment_debt", "SELECT charged - paid FROM apartment_balance WHERE apartment_id = %s")
+
+LAST_READINGS = Query("last_readings", """
+    SELECT DISTINCT ON (utility_type) utility_type, reading, reading_date
+    FROM meter_reading
+    WHERE apartment_id = %s
+    ORDER BY utility_type, reading_date DESC
+""")
+
+LAST_PAYMENT = Query("last_payment", """
+    SELECT amount, date
+    FROM payment
+    WHERE apartment_id = %s
+    ORDER BY date DESC, id DESC
+    LIMIT 1
+""")
+
+
+@timed_query
+def get_apartment(conn, apartment_id: int):
+    return fetch_one(conn, APARTMENT, (apartment_id,), Apartment)
+
+
+@timed_query
+def get_data_version(conn, apartment_id: int) -> DataVersion:
+    return fetch_one(conn, DATA_VERSION, (apartment_id,), DataVersion) or DataVersion(0, None)
+
+
+@timed_query
+def get_summary(conn, apartment_id: int) -> Summary:
+    """Сводка для главной: долг, последние показания по ресурсам и последний платёж"""
+    return Summary(fetch_value(conn, DEBT, (apartment_id,)) or 0,
+                   fetch_all(conn, LAST_READINGS, (apartment_id,), Reading),
+                   fetch_one(conn, LAST_PAYMENT, (apartment_id,), Payment))
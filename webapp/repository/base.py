@@ -0,0 +1,73 @@
+# webapp/repository/base.py
+# Основа слоя доступа к данным: запросы с именами, серверная подготовка (PREPARE)
+# горячих запросов и строки в виде namedtuple вместо словарей RealDictCursor.
+import re
+from collections import namedtuple
+
+from decouple import config
+from psycopg2 import errors, extensions
+
+from ..metrics import InstrumentedTupleCursor
+
+# За PgBouncer в режиме transaction подготовленные запросы теряются — там DB_PREPARE=False
+DB_PREPARE = config("DB_PREPARE", default=True, cast=bool)
+
+Query = namedtuple("Query", "name sql")
+
+_PLACEHOLDER = re.compile(r"%s")
+
+
+class RepositoryConnection(extensions.connection):
+    """Соединение, помнящее, какие запросы уже подготовлены на сервере"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def _numbered(sql: str):
+    counter = iter(range(1, sql.count("%s") + 1))
+    return _PLACEHOLDER.sub(lambda _: f"${next(counter)}", sql)
+
+
+def execute(cur, query: Query, params=()):
+    """Выполняет запрос; на RepositoryConnection — через PREPARE/EXECUTE.
+
+    План строится один раз на соединение, дальше сервер только подставляет параметры.
+    """
+    prepared = getattr(cur.connection, "prepared", None)
+    if not DB_PREPARE or prepared is None:
+        cur.execute(query.sql, params)
+        return cur
+    if query.name not in prepared:
+        # PREPARE не транзакционный: переживает откат и живёт до закрытия соединения
+        cur.execute(f"PREPARE {query.name} AS {_numbered(query.sql)}")
+        prepared.add(query.name)
+    try:
+        if params:
+            cur.execute(f"EXECUTE {query.name} ({', '.join(['%s'] * len(params))})", params)
+        else:
+            cur.execute(f"EXECUTE {query.name}")
+    except errors.InvalidSqlStatementName:
+        # Сессию сбросили (DISCARD ALL) — подготовим заново при следующем вызове
+        prepared.clear()
+        raise
+    return cur
+
+
+def cursor(conn):
+    return conn.cursor(cursor_factory=InstrumentedTupleCursor)
+
+
+def fetch_one(conn, query: Query, params, row_type):
+    row = execute(cursor(conn), query, params).fetchone()
+    return row_type._make(row) if row is not None else None
+
+
+def fetch_all(conn, query: Query, params, row_type) -> list:
+    return [row_type._make(row) for row in execute(cursor(conn), query, params).fetchall()]
+
+
+def fetch_value(conn, query: Query, params):
+    row = execute(cursor(conn), query, params).fetchone()
+    return row[0] if row is not None else None
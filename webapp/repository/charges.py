@@ -0,0 +1,90 @@
+# webapp/repository/charges.py
+# Начисления и долги. Условие долга — литерал «amount - paid > 0.01», совпадающий
+# с частичным индексом charge_unpaid_keyset_idx (параметр планировщик не сопоставит).
+# Долги до границы архива (archive_state) оплачены полностью: отсечение по ней
+# оставляет запросу только горячие секции charge.
+from collections import namedtuple
+from datetime import date
+
+from ..metrics import timed_query
+from .base import Query, fetch_all, fetch_one
+
+Charge = namedtuple("Charge", "id utility_type period_start period_end amount paid")
+Debt = namedtuple("Debt", "id utility_type period_end debt")
+PeriodDebt = namedtuple("PeriodDebt", "count debt")
+
+UNPAID = Query("unpaid_charges", """
+    SELECT id, utility_type, period_start, period_end, amount, paid
+    FROM charge
+    WHERE apartment_id = %s
+      AND amount - paid > 0.01
+      AND period_end >= (SELECT boundary FROM archive_state)
+    ORDER BY period_end, id
+""")
+
+UNPAID_AFTER = Query("unpaid_page_after", """
+    SELECT id, utility_type, period_end, amount - paid
+    FROM charge
+    WHERE apartment_id = %s
+      AND amount - paid > 0.01
+      AND period_end >= (SELECT boundary FROM archive_state)
+      AND (period_end, id) > (%s::date, %s::int)
+    ORDER BY period_end, id
+    LIMIT %s
+""")
+
+UNPAID_BEFORE = Query("unpaid_page_before", """
+    SELECT id, utility_type, period_end, amount - paid
+    FROM charge
+    WHERE apartment_id = %s
+      AND amount - paid > 0.01
+      AND period_end >= (SELECT boundary FROM archive_state)
+      AND (period_end, id) < (%s::date, %s::int)
+    ORDER BY period_end DESC, id DESC
+    LIMIT %s
+""")
+
+PERIOD_DEBT = Query("period_debt", """
+    SELECT COUNT(*), COALESCE(SUM(amount - paid), 0)
+    FROM charge
+    WHERE apartment_id = %s
+      AND amount - paid > 0.01
+      AND period_end >= %s::date
+      AND period_end < %s::date
+""")
+
+CHARGE = Query("charge_by_id", """
+    SELECT id, utility_type, period_start, period_end, amount, paid
+    FROM charge
+    WHERE id = %s
+      AND period_end = %s::date
+""")
+
+
+@timed_query
+def get_unpaid_charges(conn, apartment_id: int) -> list:
+    # paid поддерживается webapp.ledger, поэтому история платежей не пересканируется
+    return fetch_all(conn, UNPAID, (apartment_id,), Charge)
+
+
+@timed_query
+def get_unpaid_page(conn, apartment_id: int, limit: int, after=None, before=None):
+    """Страница долгов по keyset (period_end, id): после ключа after или перед ключом before.
+
+    Возвращает (строки по возрастанию, есть ли ещё в направлении листания).
+    """
+    if before:
+        rows = fetch_all(conn, UNPAID_BEFORE, (apartment_id, *before, limit + 1), Debt)
+        return rows[:limit][::-1], len(rows) > limit
+    rows = fetch_all(conn, UNPAID_AFTER, (apartment_id, *(after or (date.min, 0)), limit + 1), Debt)
+    return rows[:limit], len(rows) > limit
+
+
+@timed_query
+def get_period_debt(conn, apartment_id: int, start: date, end: date) -> PeriodDebt:
+    return fetch_one(conn, PERIOD_DEBT, (apartment_id, start, end), PeriodDebt)
+
+
+@timed_query
+def get_charge(conn, charge_id: int, period_end: date):
+    return fetch_one(conn, CHARGE, (charge_id, period_end), Charge)
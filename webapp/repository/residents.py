@@ -0,0 +1,113 @@
+# webapp/repository/residents.py
+# Жильцы, их квартиры и права админа.
+from collections import namedtuple
+
+from psycopg2.extras import execute_values
+
+from ..metrics import timed_query
+from .base import Query, cursor, fetch_all, fetch_one, fetch_value
+
+Identity = namedtuple("Identity", "resident_id apartment_id apartment_name is_admin")
+Resident = namedtuple("Resident", "id telegram_id full_name is_admin")
+Apartment = namedtuple("Apartment", "id name")
+NewResident = namedtuple("NewResident", "telegram_id full_name is_admin")
+
+IDENTITY = Query("identity_by_telegram_id", """
+    SELECT res.id, a.id, a.name, COALESCE(r.is_admin, FALSE)
+    FROM resident res
+             LEFT JOIN residency r ON r.resident_id = res.id
+             LEFT JOIN apartment a ON a.id = r.apartment_id
+    WHERE res.telegram_id = %s
+    ORDER BY r.id
+    LIMIT 1
+""")
+
+GET_OR_CREATE = Query("get_or_create_resident", """
+    WITH ins AS (INSERT INTO resident (telegram_id, full_name) VALUES (%s, %s)
+        ON CONFLICT (telegram_id) DO NOTHING
+        RETURNING id)
+    SELECT id FROM ins
+    UNION ALL
+    SELECT id FROM resident WHERE telegram_id = %s
+    LIMIT 1
+""")
+
+RESIDENTS = Query("residents_by_apartment", """
+    SELECT r.id, r.telegram_id, r.full_name, res.is_admin
+    FROM resident r
+             JOIN residency res ON r.id = res.resident_id
+    WHERE res.apartment_id = %s
+    ORDER BY r.full_name, r.id
+""")
+
+IS_ADMIN = Query("is_admin", """
+    SELECT EXISTS (SELECT 1
+                   FROM residency
+                   WHERE resident_id = (SELECT id FROM resident WHERE telegram_id = %s)
+                     AND apartment_id = %s
+                     AND is_admin)
+""")
+
+ADMIN_APARTMENTS = Query("admin_apartments", """
+    SELECT a.id, a.name
+    FROM apartment a
+             JOIN residency r ON r.apartment_id = a.id
+             JOIN resident res ON res.id = r.resident_id
+    WHERE res.telegram_id = %s
+      AND r.is_admin
+    ORDER BY a.id
+""")
+
+
+@timed_query
+def load_identity(conn, telegram_id: int):
+    """Жилец, его (первая) квартира и флаг админа; None — жилец неизвестен"""
+    row = fetch_one(conn, IDENTITY, (telegram_id,), Identity)
+    return row._replace(is_admin=bool(row.is_admin)) if row else None
+
+
+@timed_query
+def get_or_create_resident(conn, telegram_id: int, full_name: str) -> int:
+    return fetch_value(conn, GET_OR_CREATE, (telegram_id, full_name, telegram_id))
+
+
+@timed_query
+def get_residents(conn, apartment_id: int) -> list:
+    return fetch_all(conn, RESIDENTS, (apartment_id,), Resident)
+
+
+@timed_query
+def is_admin(conn, telegram_id: int, apartment_id: int) -> bool:
+    return fetch_value(conn, IS_ADMIN, (telegram_id, apartment_id))
+
+
+@timed_query
+def get_admin_apartments(conn, telegram_id: int) -> list:
+    """Квартиры, в которых жилец — админ (выгрузка для управляющей компании)"""
+    return fetch_all(conn, ADMIN_APARTMENTS, (telegram_id,), Apartment)
+
+
+@timed_query
+def add_residents(conn, apartment_id: int, residents) -> dict:
+    """Добавляет жильцов в квартиру двумя пакетными вставками (без коммита).
+
+    Уже известный по telegram_id жилец получает новое имя; возвращает {telegram_id: resident_id}.
+    """
+    # В одном INSERT ... ON CONFLICT DO UPDATE строка не может встретиться дважды
+    residents = {r.telegram_id: r for r in residents}
+    if not residents:
+        return {}
+    cur = cursor(conn)
+    rows = execute_values(cur, """
+                          INSERT INTO resident (telegram_id, full_name)
+                          VALUES %s
+                          ON CONFLICT (telegram_id) DO UPDATE SET full_name = EXCLUDED.full_name
+                          RETURNING telegram_id, id
+                          """, [(r.telegram_id, r.full_name) for r in residents.values()], fetch=True)
+    ids = dict(rows)
+    execute_values(cur, """
+                   INSERT INTO residency (resident_id, apartment_id, is_admin)
+                   VALUES %s
+                   ON CONFLICT (resident_id, apartment_id) DO UPDATE SET is_admin = EXCLUDED.is_admin
+                   """, [(ids[t], apartment_id, r.is_admin) for t, r in residents.items()])
+    return ids
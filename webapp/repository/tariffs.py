@@ -0,0 +1,32 @@
+# webapp/repository/tariffs.py
+# Тарифы квартиры.
+from collections import namedtuple
+
+from ..metrics import timed_query
+from .base import Query, cursor, execute, fetch_all
+
+Tariff = namedtuple("Tariff", "id utility_type rate valid_from")
+
+TARIFFS = Query("tariffs_by_apartment", """
+    SELECT id, utility_type, rate, valid_from
+    FROM tariff
+    WHERE apartment_id = %s
+    ORDER BY utility_type, valid_from DESC
+""")
+
+UPSERT = Query("upsert_tariff", """
+    INSERT INTO tariff (apartment_id, utility_type, rate, valid_from)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (apartment_id, utility_type, valid_from) DO UPDATE SET rate = EXCLUDED.rate
+""")
+
+
+@timed_query
+def get_tariffs(conn, apartment_id: int) -> list:
+    return fetch_all(conn, TARIFFS, (apartment_id,), Tariff)
+
+
+@timed_query
+def upsert_tariff(conn, apartment_id: int, utility_type: str, rate: float, valid_from):
+    """Тариф с даты valid_from (без коммита и пересчёта начислений)"""
+    execute(cursor(conn), UPSERT, (apartment_id, utility_type, rate, valid_from))
@@ -0,0 +1,132 @@
+# webapp/rollups.py
+# Помесячные итоги потребления и сумм по (квартира, ресурс) для графиков.
+# consumption_monthly обновляется инкрементально в той же транзакции, что и
+# начисления: пересчитываются только затронутые месяцы. rollup_version растёт при
+# каждом изменении итогов квартиры и служит ключом кэша графиков.
+from datetime import date
+
+import click
+from flask.cli import AppGroup
+
+from .database import get_db
+
+_REFRESH = """
+    WITH keys AS (SELECT DISTINCT apartment_id, utility_type, month
+                  FROM unnest(%s::int[], %s::text[], %s::date[]) AS k(apartment_id, utility_type, month)),
+         agg AS (SELECT k.apartment_id,
+                        k.utility_type,
+                        k.month,
+                        COUNT(c.id)                     AS charges,
+                        COALESCE(SUM(c.consumption), 0) AS consumption,
+                        COALESCE(SUM(c.amount), 0)      AS amount
+                 FROM keys k
+                          LEFT JOIN charge c
+                                    ON c.apartment_id = k.apartment_id
+                                        AND c.utility_type = k.utility_type
+                                        AND c.period_end >= k.month
+                                        AND c.period_end < k.month + INTERVAL '1 month'
+                 GROUP BY k.apartment_id, k.utility_type, k.month),
+         gone AS (DELETE FROM consumption_monthly m
+             USING agg
+             WHERE agg.charges = 0
+               AND m.apartment_id = agg.apartment_id
+               AND m.utility_type = agg.utility_type
+               AND m.month = agg.month)
+    INSERT
+    INTO consumption_monthly (apartment_id, utility_type, month, consumption, amount)
+    SELECT apartment_id, utility_type, month, consumption, amount
+    FROM agg
+    WHERE charges > 0
+    ON CONFLICT (apartment_id, utility_type, month) DO UPDATE
+        SET consumption = EXCLUDED.consumption,
+            amount      = EXCLUDED.amount
+"""
+
+_BUMP_VERSION = """
+    INSERT INTO rollup_version (apartment_id, version)
+    SELECT DISTINCT unnest(%s::int[]), 1
+    ON CONFLICT (apartment_id) DO UPDATE SET version = rollup_version.version + 1
+"""
+
+
+_ROLLUP_VERSION = "SELECT version FROM rollup_version WHERE apartment_id = %s"
+
+_SERIES = """
+    SELECT utility_type, month, consumption, amount
+    FROM consumption_monthly
+    WHERE apartment_id = %s
+      AND month >= %s
+      AND (%s::text IS NULL OR utility_type = %s)
+    ORDER BY utility_type, month
+"""
+
+_UTILITIES = "SELECT DISTINCT utility_type FROM consumption_monthly WHERE apartment_id = %s ORDER BY 1"
+
+
+def refresh_rollups(cur, keys):
+    """Пересчитывает месяцы, в которые попадают изменённые начисления.
+
+    keys — тройки (apartment_id, utility_type, period_end). Коммит — на вызывающем.
+    """
+    keys = {(apartment_id, utility_type, period_end.replace(day=1))
+            for apartment_id, utility_type, period_end in keys}
+    if not keys:
+        return
+    apartment_ids, utility_types, months = zip(*sorted(keys))
+    cur.execute(_REFRESH, (list(apartment_ids), list(utility_types), list(months)))
+    cur.execute(_BUMP_VERSION, (sorted(set(apartment_ids)),))
+
+
+def rebuild_rollups(conn) -> int:
+    """Полная перестройка итогов из charge; возвращает число строк"""
+    cur = conn.cursor()
+    cur.execute("DELETE FROM consumption_monthly")
+    cur.execute("""
+                INSERT INTO consumption_monthly (apartment_id, utility_type, month, consumption, amount)
+                SELECT apartment_id, utility_type, date_trunc('month', period_end)::date, SUM(consumption), SUM(amount)
+                FROM charge
+                GROUP BY 1, 2, 3
+                """)
+    rows = cur.rowcount
+    cur.execute("UPDATE rollup_version SET version = version + 1")
+    cur.execute("""
+                INSERT INTO rollup_version (apartment_id, version)
+                SELECT id, 1
+                FROM apartment
+                ON CONFLICT (apartment_id) DO NOTHING
+                """)
+    conn.commit()
+    return rows
+
+
+def get_rollup_version(cur, apartment_id: int) -> int:
+    cur.execute(_ROLLUP_VERSION, (apartment_id,))
+    row = cur.fetchone()
+    return row["version"] if row else 0
+
+
+def months_back(months: int, today: date = None) -> date:
+    """Первое число месяца, отстоящего на months - 1 от текущего"""
+    today = today or date.today()
+    index = today.year * 12 + today.month - 1 - (months - 1)
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def get_series(cur, apartment_id: int, since: date, utility_type: str = None) -> list:
+    """Помесячный ряд по квартире (и ресурсу) начиная с since"""
+    cur.execute(_SERIES, (apartment_id, since, utility_type, utility_type))
+    return cur.fetchall()
+
+
+def get_utilities(cur, apartment_id: int) -> list:
+    cur.execute(_UTILITIES, (apartment_id,))
+    return [r["utility_type"] for r in cur.fetchall()]
+
+
+rollup_cli = AppGroup("rollup", help="Помесячные итоги потребления")
+
+
+@rollup_cli.command("rebuild")
+def rebuild_command():
+    rows = rebuild_rollups(get_db())
+    click.echo(f"Итоги перестроены: {rows} строк")
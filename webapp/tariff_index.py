@@ -0,0 +1,98 @@
+# webapp/tariff_index.py
+# Индекс действующих тарифов в памяти: на каждую пару (квартира, ресурс) —
+# отсортированные даты valid_from и ставки. Тариф на дату ищется bisect'ом,
+# период, пересекающий смену тарифа, делится пропорционально дням. По нему
+# считает начисления billing: тарифы грузятся одним запросом на прогон, а после
+# записи тарифа перечитывается только изменившаяся пара (refresh).
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import date
+from itertools import groupby
+
+Segment = namedtuple("Segment", "start end rate")
+
+_TARIFFS_SQL = """
+    SELECT apartment_id, utility_type, valid_from, rate
+    FROM tariff
+    {where}
+    ORDER BY apartment_id, utility_type, valid_from
+"""
+
+_PAIRS_WHERE = """
+    WHERE (apartment_id, utility_type) IN (SELECT * FROM unnest(%s::int[], %s::text[]))
+"""
+
+
+class TariffIndex:
+    def __init__(self):
+        self._series = {}
+
+    def _build(self, rows):
+        for key, group in groupby(rows, key=lambda r: (r["apartment_id"], r["utility_type"])):
+            group = list(group)
+            self._series[key] = ([r["valid_from"] for r in group], [r["rate"] for r in group])
+
+    def load(self, conn):
+        """Загружает все тарифы одним запросом"""
+        cur = conn.cursor()
+        cur.execute(_TARIFFS_SQL.format(where=""))
+        self._series = {}
+        self._build(cur.fetchall())
+
+    def refresh(self, conn, pairs):
+        """Перечитывает тарифы только указанных пар (квартира, ресурс) одним запросом"""
+        pairs = set(pairs)
+        if not pairs:
+            return
+        apartment_ids, utility_types = zip(*pairs)
+        cur = conn.cursor()
+        cur.execute(_TARIFFS_SQL.format(where=_PAIRS_WHERE), (list(apartment_ids), list(utility_types)))
+        for key in pairs:
+            self._series.pop(key, None)
+        self._build(cur.fetchall())
+
+    def rate_on(self, apartment_id: int, utility_type: str, day: date):
+        """Ставка, действующая на дату, или None"""
+        series = self._series.get((apartment_id, utility_type))
+        if not series:
+            return None
+        i = bisect_right(series[0], day) - 1
+        return series[1][i] if i >= 0 else None
+
+    def segments(self, apartment_id: int, utility_type: str, start: date, end: date) -> list:
+        """Разбивает период (start, end] на отрезки с постоянной ставкой.
+
+        Дни до самого раннего тарифа не оцениваются и в отрезки не попадают.
+        """
+        series = self._series.get((apartment_id, utility_type))
+        if not series:
+            return []
+        dates, rates = series
+        start = max(start, dates[0])
+        if start >= end:
+            return []
+        lo = bisect_right(dates, start) - 1
+        hi = bisect_right(dates, end)
+        result = []
+        seg_start = start
+        for i in range(lo, hi):
+            seg_end = dates[i + 1] if i + 1 < hi else end
+            if seg_end > seg_start:
+                result.append(Segment(seg_start, seg_end, rates[i]))
+                seg_start = seg_end
+        return result
+
+    def average_rate(self, apartment_id: int, utility_type: str, start: date, end: date):
+        """Средняя по дням периода ставка; None — ни один день не покрыт тарифом.
+
+        Дни без тарифа входят в знаменатель: их доля потребления не оценивается.
+        """
+        segments = self.segments(apartment_id, utility_type, start, end)
+        if not segments:
+            return None
+        return sum((s.end - s.start).days * s.rate for s in segments) / (end - start).days
+
+    def price(self, apartment_id: int, utility_type: str, start: date, end: date, consumption: float):
+        """Стоимость потребления за период с учётом смены тарифа; None — тарифа нет"""
+        rate = self.average_rate(apartment_id, utility_type, start, end)
+        return None if rate is None else round(consumption * rate, 2)
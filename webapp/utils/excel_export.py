@@ -1,49 +1,51 @@
-import sqlite3
-import os
+# webapp/utils/excel_export.py
+# Потоковый экспорт: строки читаются именованным (серверным) курсором порциями
+# и сразу пишутся в write-only книгу openpyxl, поэтому память не зависит от
+# длины истории начислений.
 from openpyxl import Workbook
-from pathlib import Path
 
-DB_PATH = Path(__file__).parent.parent.parent / "payments.db"
+EXPORT_ITERSIZE = 2000
 
+UTIL_RU = {"electricity": "Электричество", "water_hot": "ГВС", "water_cold": "ХВС", "gas": "Газ"}
 
-def export_to_excel(apartment_id: int) -> str | None:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-                SELECT c.utility_type,
-                       c.period_start,
-                       c.period_end,
-                       c.amount,
-                       IFNULL(SUM(p.amount), 0) as paid
-                FROM charge c
-                         LEFT JOIN payment p ON c.id = p.charge_id
-                WHERE c.apartment_id = ?
-                GROUP BY c.id
-                ORDER BY c.period_end
-                """, (apartment_id,))
-    charges = cur.fetchall()
-    conn.close()
+_CHARGES_SQL = """
+    SELECT a.name AS apartment,
+           c.utility_type,
+           c.period_start,
+           c.period_end,
+           c.amount,
+           c.paid
+    FROM charge c
+             JOIN apartment a ON a.id = c.apartment_id
+    WHERE c.apartment_id = ANY (%s)
+    ORDER BY c.apartment_id, c.period_end
+"""
 
-    if not charges:
-        return None
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Начисления"
-    ws.append(["Ресурс", "Период", "Начислено", "Оплачено", "Остаток"])
+def export_to_excel(conn, apartment_ids, out) -> int:
+    """Пишет xlsx с начислениями квартир в файловый объект out; возвращает число строк"""
+    apartment_ids = list(apartment_ids)
+    with_apartment = len(apartment_ids) > 1
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Начисления")
+    header = ["Ресурс", "Период", "Начислено", "Оплачено", "Остаток"]
+    ws.append(["Квартира"] + header if with_apartment else header)
 
-    util_ru = {"electricity": "Электричество", "water_hot": "ГВС", "water_cold": "ХВС", "gas": "Газ"}
-    for ch in charges:
-        debt = ch["amount"] - ch["paid"]
-        period = f"{ch['period_start']} – {ch['period_end']}"
-        ws.append([
-            util_ru.get(ch["utility_type"], ch["utility_type"]),
-            period,
-            ch["amount"],
-            ch["paid"],
-            debt
-        ])
+    rows = 0
+    with conn.cursor(name="excel_export") as cur:
+        cur.itersize = EXPORT_ITERSIZE
+        cur.execute(_CHARGES_SQL, (apartment_ids,))
+        for ch in cur:
+            row = [
+                UTIL_RU.get(ch["utility_type"], ch["utility_type"]),
+                f"{ch['period_start']} – {ch['period_end']}",
+                ch["amount"],
+                ch["paid"],
+                ch["amount"] - ch["paid"],
+            ]
+            ws.append([ch["apartment"]] + row if with_apartment else row)
+            rows += 1
+    conn.commit()
 
-    filename = f"/tmp/export_{apartment_id}.xlsx"
-    wb.save(filename)
-    return filename
+    wb.save(out)
+    return rows
@@ -1,24 +1,86 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session
-from ..auth import get_session
-from ..models import get_apartment, get_tariffs, get_residents, is_admin_db
-from ..forms import TariffForm, ResidentForm
-from ..utils.excel_export import export_to_excel
-import os
+import hmac
+import time
+from functools import wraps
+
+from decouple import Csv, config
+from flask import (Blueprint, Response, render_template, request, redirect, url_for, flash, session, jsonify,
+                   abort)
+from ..auth import get_session, revoke_session, is_revoked, SESSION_MODE, SESSION_RECHECK_SECONDS
+from ..database import get_db, pool_stats
+from ..metrics import render_latest
+from ..models import get_apartment, get_tariffs, get_residents, get_summary, is_admin_db, get_admin_apartments
+from ..forms import TariffForm, ResidentForm, ImportForm, UTILITY_CHOICES
+from ..export_jobs import submit_export, get_job, result_size, iter_result
+from ..importer import import_file
+from ..charts import get_chart, MIMETYPES
+from ..rollups import get_rollup_version, get_series, get_utilities, months_back
+from ..page_cache import versioned_page, cached_fragment
+from ..repository import get_data_version
 
 main = Blueprint('main', __name__)
 
+# /health/db и /metrics — только для мониторинга: с адресов из списка (X-Forwarded-For
+# не учитывается) или с заголовком Authorization: Bearer <INTERNAL_TOKEN>
+INTERNAL_TOKEN = config("INTERNAL_TOKEN", default="")
+INTERNAL_ALLOWED_IPS = config("INTERNAL_ALLOWED_IPS", default="127.0.0.1,::1", cast=Csv())
+
+
+def internal_only(view):
+    """Служебная страница: чужим отвечаем 404, как будто её нет"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        auth = request.headers.get("Authorization", "")
+        token_ok = bool(INTERNAL_TOKEN) and hmac.compare_digest(auth, f"Bearer {INTERNAL_TOKEN}")
+        if not token_ok and request.remote_addr not in INTERNAL_ALLOWED_IPS:
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
+
 
 @main.before_request
 def load_session():
     token = request.args.get("token") or session.get("token")
+    if not token:
+        return
+    if (SESSION_MODE == "cookie" and token == session.get("token") and not is_revoked(token)
+            and time.time() - session.get("checked_at", 0) < SESSION_RECHECK_SECONDS
+            and session.get("expires_at", 0) > time.time()):
+        # Данные уже проверены и подписаны в cookie — Redis не трогаем
+        return
+    sess = get_session(token)
+    if not sess:
+        session.clear()
+        return
+    # Пишем в session только изменения: иначе Flask перевыпускает cookie на каждый запрос
+    claims = {"token": token, "apartment_id": sess["apartment_id"], "telegram_id": sess["telegram_id"]}
+    if SESSION_MODE == "cookie":
+        claims["expires_at"] = sess["expires_at"]
+        claims["checked_at"] = time.time()
+    for key, value in claims.items():
+        if session.get(key) != value:
+            session[key] = value
+
+
+@main.route("/logout")
+def logout():
+    token = session.get("token")
     if token:
-        sess = get_session(token)
-        if sess:
-            session["token"] = token
-            session["apartment_id"] = sess["apartment_id"]
-            session["telegram_id"] = sess["telegram_id"]
-        else:
-            session.clear()
+        revoke_session(token)
+    session.clear()
+    return redirect(url_for("main.login"))
+
+
+@main.route("/health/db")
+@internal_only
+def health_db():
+    return jsonify(pool_stats())
+
+
+@main.route("/metrics")
+@internal_only
+def metrics():
+    body, content_type = render_latest()
+    return Response(body, content_type=content_type)
 
 
 @main.route("/login")
@@ -31,8 +93,81 @@ def dashboard():
     if "apartment_id" not in session:
         return redirect(url_for("main.login"))
     apartment_id = session["apartment_id"]
-    apartment = get_apartment(apartment_id)
-    return render_template("dashboard.html", apartment=apartment)
+    months = _chart_months()
+    version = get_data_version(get_db(), apartment_id)
+
+    def render():
+        names = dict(UTILITY_CHOICES)
+        summary = cached_fragment("summary", apartment_id, version, lambda: render_template(
+            "_summary.html", summary=get_summary(apartment_id), utility_names=names))
+        return render_template("dashboard.html", apartment=get_apartment(apartment_id), summary=summary,
+                               utilities=get_utilities(get_db().cursor(), apartment_id),
+                               utility_names=names, months=months)
+
+    return versioned_page(version, render, months)
+
+
+CHART_METRICS = {"consumption": "потребление", "amount": "сумма, руб"}
+
+
+def _chart_months():
+    return min(max(request.args.get("months", 24, type=int), 1), 120)
+
+
+def _not_modified(version, *parts):
+    """ETag из версии итогов: неизменившийся график браузер берёт из своего кэша"""
+    etag = "-".join(str(p) for p in (version, *parts))
+    if request.if_none_match.contains(etag):
+        return etag, Response(status=304, headers={"ETag": f'"{etag}"'})
+    return etag, None
+
+
+@main.route("/charts/<utility_type>.<fmt>")
+def consumption_chart(utility_type, fmt):
+    if "apartment_id" not in session:
+        abort(401)
+    names = dict(UTILITY_CHOICES)
+    metric = request.args.get("metric", "consumption")
+    if utility_type not in names or fmt not in MIMETYPES or metric not in CHART_METRICS:
+        abort(404)
+    apartment_id = session["apartment_id"]
+    months = _chart_months()
+    cur = get_db().cursor()
+    version = get_rollup_version(cur, apartment_id)
+    etag, cached = _not_modified(version, utility_type, metric, months_back(months).isoformat(), fmt)
+    if cached:
+        return cached
+    title = f"{names[utility_type]}: {CHART_METRICS[metric]}"
+    body = get_chart(cur, apartment_id, utility_type, months, metric, fmt, title, version)
+    response = Response(body, mimetype=MIMETYPES[fmt])
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@main.route("/api/consumption")
+def consumption_series():
+    if "apartment_id" not in session:
+        abort(401)
+    apartment_id = session["apartment_id"]
+    utility_type = request.args.get("utility")
+    months = _chart_months()
+    cur = get_db().cursor()
+    version = get_rollup_version(cur, apartment_id)
+    since = months_back(months)
+    etag, cached = _not_modified(version, utility_type or "all", since.isoformat(), "json")
+    if cached:
+        return cached
+    series = {}
+    for row in get_series(cur, apartment_id, since, utility_type):
+        series.setdefault(row["utility_type"], []).append(
+            {"month": row["month"].isoformat(), "consumption": row["consumption"], "amount": row["amount"]})
+    response = jsonify(version=version, series=series)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 
 @main.route("/tariffs")
@@ -40,8 +175,14 @@ def tariffs():
     if "apartment_id" not in session:
         return redirect(url_for("main.login"))
     apartment_id = session["apartment_id"]
-    tariffs = get_tariffs(apartment_id)
-    return render_template("tariffs.html", tariffs=tariffs)
+    version = get_data_version(get_db(), apartment_id)
+
+    def render():
+        table = cached_fragment("tariffs", apartment_id, version, lambda: render_template(
+            "_tariffs_table.html", tariffs=get_tariffs(apartment_id)))
+        return render_template("tariffs.html", table=table)
+
+    return versioned_page(version, render)
 
 
 @main.route("/tariff/new", methods=["GET", "POST"])
@@ -61,8 +202,15 @@ def new_tariff():
 def residents():
     if "apartment_id" not in session:
         return redirect(url_for("main.login"))
-    residents = get_residents(session["apartment_id"])
-    return render_template("residents.html", residents=residents)
+    apartment_id = session["apartment_id"]
+    version = get_data_version(get_db(), apartment_id)
+
+    def render():
+        table = cached_fragment("residents", apartment_id, version, lambda: render_template(
+            "_residents_table.html", residents=get_residents(apartment_id)))
+        return render_template("residents.html", table=table)
+
+    return versioned_page(version, render)
 
 
 @main.route("/residents/add", methods=["POST"])
@@ -85,15 +233,105 @@ def add_resident():
     return redirect(url_for("main.residents"))
 
 
+@main.route("/import", methods=["GET", "POST"])
+def bulk_import():
+    if "apartment_id" not in session:
+        return redirect(url_for("main.login"))
+    allowed = {a.id for a in get_admin_apartments(session["telegram_id"])}
+    if not allowed:
+        flash("Недостаточно прав", "error")
+        return redirect(url_for("main.dashboard"))
+    form = ImportForm()
+    report = None
+    if form.validate_on_submit():
+        upload = form.file.data
+        report = import_file(get_db(), form.kind.data, upload.stream, upload.filename, allowed,
+                             session["telegram_id"])
+        flash(f"Загружено строк: {report.loaded}, отклонено: {report.rejected}",
+              "error" if report.rejected else "success")
+    return render_template("import.html", form=form, report=report)
+
+
+def _no_export_data():
+    flash("Нет данных для экспорта", "error")
+    return redirect(url_for("main.dashboard"))
+
+
+def _start_export(apartment_ids, download_name):
+    job_id = submit_export(get_db(), apartment_ids, session["telegram_id"], download_name)
+    if job_id is None:
+        return _no_export_data()
+    return redirect(url_for("main.export_status", job_id=job_id))
+
+
 @main.route("/export/excel")
 def export_excel():
     if "apartment_id" not in session:
         return redirect(url_for("main.login"))
-    filepath = export_to_excel(session["apartment_id"])
-    # if not is_admin_db(session["telegram_id"], session["apartment_id"]):
-    #     flash("Недостаточно прав", "error")
-    #     return redirect(url_for("main.residents"))
     if not is_admin_db(session["telegram_id"], session["apartment_id"]):
-        flash("Нет данных для экспорта", "error")
+        flash("Недостаточно прав", "error")
+        return redirect(url_for("main.dashboard"))
+    return _start_export([session["apartment_id"]], "export.xlsx")
+
+
+@main.route("/export/excel/all")
+def export_excel_all():
+    if "apartment_id" not in session:
+        return redirect(url_for("main.login"))
+    apartments = get_admin_apartments(session["telegram_id"])
+    if not apartments:
+        flash("Недостаточно прав", "error")
         return redirect(url_for("main.dashboard"))
-    return send_file(filepath, as_attachment=True, download_name="export.xlsx")
+    return _start_export([a.id for a in apartments], "export_all.xlsx")
+
+
+def _own_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return None
+    allowed = {a.id for a in get_admin_apartments(session["telegram_id"])}
+    return job if set(job["apartment_ids"]) <= allowed else None
+
+
+@main.route("/export/jobs/<job_id>")
+def export_status(job_id):
+    if "apartment_id" not in session:
+        return redirect(url_for("main.login"))
+    job = _own_job(job_id)
+    if job is None:
+        abort(404)
+    if job["status"] == "empty":
+        return _no_export_data()
+    return render_template("export_status.html", job=job)
+
+
+@main.route("/export/jobs/<job_id>/status")
+def export_status_json(job_id):
+    if "apartment_id" not in session:
+        abort(401)
+    job = _own_job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(status=job["status"], rows=job.get("rows"), error=job.get("error"))
+
+
+@main.route("/export/jobs/<job_id>/download")
+def export_download(job_id):
+    if "apartment_id" not in session:
+        return redirect(url_for("main.login"))
+    job = _own_job(job_id)
+    if job is None or job["status"] != "done":
+        abort(404)
+    size = result_size(job["cache_key"])
+    if not size:
+        flash("Файл выгрузки устарел, запустите экспорт заново", "error")
+        return redirect(url_for("main.dashboard"))
+    response = Response(iter_result(job["cache_key"], size),
+                        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    response.headers["Content-Length"] = str(size)
+    response.headers["Content-Disposition"] = f'attachment; filename="{job["download_name"]}"'
+    return response
+
+
+# Маршруты JSON API регистрируются на том же blueprint
+from . import api  # noqa: E402,F401
@@ -0,0 +1,196 @@
+# webapp/views/api.py
+# JSON API только для чтения: начисления, платежи и показания квартиры из сессии.
+# Пагинация keyset по (дата, id) от новых к старым — страница читается по индексу
+# (apartment_id, дата, id) без OFFSET; fields= ограничивает набор полей.
+import base64
+import binascii
+import json
+from collections import namedtuple
+from datetime import date
+
+from flask import request, session, jsonify
+
+from . import main
+from ..database import get_db
+from ..forms import UTILITY_CHOICES
+from ..metrics import timed_query
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+UTILITIES = {code for code, _ in UTILITY_CHOICES}
+
+Resource = namedtuple("Resource", "table key fields has_utility")
+
+CHARGES = Resource("charge", "period_end", {
+    "id": "id",
+    "utility_type": "utility_type",
+    "period_start": "period_start",
+    "period_end": "period_end",
+    "consumption": "consumption",
+    "tariff_used": "tariff_used",
+    "amount": "amount",
+    "paid": "paid",
+    "debt": "ROUND((amount - paid)::numeric, 2)::float8",
+}, True)
+
+PAYMENTS = Resource("payment", "date", {
+    "id": "id",
+    "charge_id": "charge_id",
+    "amount": "amount",
+    "date": "date",
+    "created_at": "created_at",
+    "confirmed_by": "confirmed_by",
+    "has_receipt": "receipt_path IS NOT NULL",
+}, False)
+
+READINGS = Resource("meter_reading", "reading_date", {
+    "id": "id",
+    "utility_type": "utility_type",
+    "reading_date": "reading_date",
+    "reading": "reading",
+    "submitted_by": "submitted_by",
+}, True)
+
+# Совпадает с условием частичного индекса charge_unpaid_keyset_idx; долгов в архиве нет
+_STATUS = {
+    "unpaid": "amount - paid > 0.01 AND period_end >= (SELECT boundary FROM archive_state)",
+    "paid": "amount - paid <= 0.01",
+}
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def encode_cursor(key_value: date, row_id: int) -> str:
+    raw = json.dumps([key_value.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        key_value, row_id = json.loads(raw)
+        return date.fromisoformat(key_value), int(row_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise BadRequest("bad cursor") from None
+
+
+def _parse_date(name: str):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise BadRequest(f"bad {name}: expected YYYY-MM-DD") from None
+
+
+def _parse_fields(resource: Resource) -> list:
+    value = request.args.get("fields")
+    if not value:
+        return list(resource.fields)
+    fields = [f.strip() for f in value.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in resource.fields]
+    if unknown:
+        raise BadRequest(f"unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def _parse_limit() -> int:
+    try:
+        limit = int(request.args.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise BadRequest("bad limit") from None
+    return min(max(limit, 1), MAX_LIMIT)
+
+
+def page_sql(resource: Resource, fields, where) -> str:
+    """Запрос страницы: поля только из белого списка ресурса, ключ и id — для курсора"""
+    columns = ", ".join(f"{resource.fields[f]} AS {f}" for f in fields)
+    return f"""
+        SELECT {columns}, {resource.key} AS _key, id AS _id
+        FROM {resource.table}
+        WHERE {" AND ".join(where)}
+        ORDER BY {resource.key} DESC, id DESC
+        LIMIT %s
+    """
+
+
+def _page(resource: Resource, apartment_id: int, extra_where=()):
+    fields = _parse_fields(resource)
+    limit = _parse_limit()
+    where = ["apartment_id = %s", *extra_where]
+    params = [apartment_id]
+
+    if resource.has_utility and request.args.get("utility"):
+        utility = request.args["utility"]
+        if utility not in UTILITIES:
+            raise BadRequest(f"unknown utility: {utility}")
+        where.append("utility_type = %s")
+        params.append(utility)
+    date_from, date_to = _parse_date("from"), _parse_date("to")
+    if date_from:
+        where.append(f"{resource.key} >= %s")
+        params.append(date_from)
+    if date_to:
+        where.append(f"{resource.key} <= %s")
+        params.append(date_to)
+    if request.args.get("cursor"):
+        key_value, row_id = decode_cursor(request.args["cursor"])
+        where.append(f"({resource.key}, id) < (%s, %s)")
+        params.extend((key_value, row_id))
+
+    cur = get_db().cursor()
+    cur.execute(page_sql(resource, fields, where), (*params, limit + 1))
+    rows = cur.fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]["_key"], rows[limit - 1]["_id"]) if len(rows) > limit else None
+    items = [{f: _jsonable(row[f]) for f in fields} for row in rows[:limit]]
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def _jsonable(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+@timed_query
+def list_charges(apartment_id: int):
+    status = request.args.get("status")
+    if status and status not in _STATUS:
+        raise BadRequest("status must be paid or unpaid")
+    return _page(CHARGES, apartment_id, [_STATUS[status]] if status else [])
+
+
+@timed_query
+def list_payments(apartment_id: int):
+    return _page(PAYMENTS, apartment_id)
+
+
+@timed_query
+def list_readings(apartment_id: int):
+    return _page(READINGS, apartment_id)
+
+
+def _api(list_func):
+    if "apartment_id" not in session:
+        return jsonify(error="unauthorized"), 401
+    try:
+        return jsonify(list_func(session["apartment_id"]))
+    except BadRequest as e:
+        return jsonify(error=str(e)), 400
+
+
+@main.route("/api/charges")
+def api_charges():
+    return _api(list_charges)
+
+
+@main.route("/api/payments")
+def api_payments():
+    return _api(list_payments)
+
+
+@main.route("/api/readings")
+def api_readings():
+    return _api(list_readings)